@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Stand-in for ProteoWizard msaccess, so filesummary.py can be benchmarked without the vendor binary.
+
+Accepts the same command line as msaccess_runner.run_msaccess and writes a run_summary table to stdout,
+counting MS levels with a regex over the file. Set FAKE_MSACCESS_DELAY to add a fixed per-file delay
+(seconds) and FAKE_MSACCESS_HANG to a substring of a path to make that file hang, for exercising timeouts.
+"""
+import os
+import re
+import sys
+import time
+
+MS_LEVEL_PATTERN = re.compile(rb'name="ms level" value="(\d+)"|msLevel="(\d+)"|MSLEVEL=(\d+)')
+
+# Bytes read per block, a match can only span a block boundary within the overlap
+READ_SIZE = 16 * 1024 * 1024
+OVERLAP_BYTES = 64
+
+def count_ms_levels(spectrum_file):
+    ms_levels = {}
+    data = b''
+    with open(spectrum_file, 'rb') as f:
+        while True:
+            block = f.read(READ_SIZE)
+            data += block
+            # Matches starting in the last OVERLAP_BYTES are left for the next block, unless this is the end of the file
+            limit = len(data) if len(block) < READ_SIZE else len(data) - OVERLAP_BYTES
+            for match in MS_LEVEL_PATTERN.finditer(data):
+                if match.start() >= limit:
+                    break
+                ms_level = int(b''.join(group for group in match.groups() if group))
+                ms_levels[ms_level] = ms_levels.get(ms_level, 0) + 1
+            data = data[limit:]
+            if len(block) < READ_SIZE:
+                return ms_levels
+
+def main():
+    spectra_files = [x for x in sys.argv[1:] if not x.startswith('-') and not x.startswith('run_summary')]
+
+    print("Filename\tVendor\tModel\tMS1s\tMS2s")
+    for spectrum_file in spectra_files:
+        if os.environ.get('FAKE_MSACCESS_HANG') and os.environ['FAKE_MSACCESS_HANG'] in spectrum_file:
+            time.sleep(24 * 60 * 60)
+        if os.environ.get('FAKE_MSACCESS_DELAY'):
+            time.sleep(float(os.environ['FAKE_MSACCESS_DELAY']))
+
+        ms_levels = count_ms_levels(spectrum_file)
+        print(f"{os.path.basename(spectrum_file)}\tThermo Scientific\tQ Exactive\t{ms_levels.get(1, 0)}\t{ms_levels.get(2, 0)}")
+
+if __name__ == "__main__":
+    main()
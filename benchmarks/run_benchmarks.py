@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic_corpus
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_FOLDER = os.path.join(os.path.dirname(BENCHMARK_FOLDER), "bin", "scripts")
+sys.path.insert(0, SCRIPTS_FOLDER)
+
+import ontology_cache
+
+# Bump when the layout of the results JSON changes
+BENCHMARK_RESULTS_VERSION = 1
+
+# A stage regresses when its throughput drops below baseline / max_slowdown, or its peak RSS grows above baseline * max_rss_growth
+DEFAULT_MAX_SLOWDOWN = 1.25
+DEFAULT_MAX_RSS_GROWTH = 1.25
+
+# Backend stages, as (name, corpus format, extra xmlsummary_single.py arguments)
+XML_STAGES = [("xml_stream_mzML", "mzML", []),
+              ("xml_stream_indexed_mzML", "indexed_mzML", []),
+              ("xml_index_mzML", "indexed_mzML", ["--use_index"]),
+              ("xml_stream_mzXML", "mzXML", []),
+              ("xml_index_mzXML", "indexed_mzXML", ["--use_index"]),
+              ("xml_mgf", "mgf", []),
+             ]
+MERGE_STAGES = ["merge_tsv", "merge_topk", "merge_parquet"]
+ALL_STAGES = [stage[0] for stage in XML_STAGES] + ["msaccess"] + MERGE_STAGES
+
+MERGE_HEADERS = ["Filename", "Original_Path", "Ion_Source", "Mass_Analyzer", "Mass_Detector", "Model", "Vendor",
+                 "MS1s", "MS2s", "MS3+"]
+
+
+############## Measurement ##################
+def run_measured(command, log_filename, env=None):
+    """Runs a command in its own process and measures it.
+
+    Returns:
+        tuple: (wall seconds, peak RSS in bytes of the process, return code)
+    """
+    with open(log_filename, "a") as log_file:
+        log_file.write(" ".join(command) + "\n")
+        log_file.flush()
+        start_time = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=env)
+        # wait4 gives the resource usage of exactly this child, unlike getrusage(RUSAGE_CHILDREN)
+        _, status, resource_usage = os.wait4(process.pid, 0)
+        elapsed_seconds = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource_usage.ru_maxrss if sys.platform == "darwin" else resource_usage.ru_maxrss * 1024
+    return elapsed_seconds, peak_rss, process.returncode
+
+def measure_stage(command, num_files, num_bytes, repeats, log_filename, env=None):
+    """Runs a stage repeats times, keeping the fastest time and the largest peak RSS."""
+    timings = []
+    peak_rss_list = []
+    for _ in range(repeats):
+        elapsed_seconds, peak_rss, returncode = run_measured(command, log_filename, env=env)
+        if returncode != 0:
+            raise RuntimeError(f"Benchmark command failed with exit code {returncode}, see {log_filename}: {' '.join(command)}")
+        timings.append(elapsed_seconds)
+        peak_rss_list.append(peak_rss)
+
+    seconds = min(timings)
+    return {"files": num_files,
+            "bytes": num_bytes,
+            "seconds": round(seconds, 4),
+            "files_per_second": round(num_files / seconds, 3),
+            "mb_per_second": round(num_bytes / seconds / 1e6, 3),
+            "peak_rss_mb": round(max(peak_rss_list) / 1e6, 1),
+            "repeats": repeats}
+
+
+############## Inputs ##################
+def generate_corpus(corpus_folder, args):
+    """Generates one folder of synthetic files per format, returning the files of each format."""
+    formats = sorted({stage[1] for stage in XML_STAGES})
+    corpus_files = {}
+    for fmt in formats:
+        format_folder = os.path.join(corpus_folder, fmt)
+        os.makedirs(format_folder, exist_ok=True)
+        corpus_files[fmt] = []
+        for file_index in range(args.num_files):
+            common = dict(num_spectra=args.num_spectra, peaks_per_spectrum=args.peaks_per_spectrum,
+                          ms3_every=args.ms3_every, seed=file_index)
+            if fmt in ("mzML", "indexed_mzML"):
+                output_filename = os.path.join(format_folder, f"{fmt}_{file_index}.mzML")
+                synthetic_corpus.write_mzML(output_filename, indexed=(fmt == "indexed_mzML"),
+                                            num_instrument_configurations=args.num_instrument_configurations, **common)
+            elif fmt in ("mzXML", "indexed_mzXML"):
+                output_filename = os.path.join(format_folder, f"{fmt}_{file_index}.mzXML")
+                synthetic_corpus.write_mzXML(output_filename, indexed=(fmt == "indexed_mzXML"), **common)
+            else:
+                output_filename = os.path.join(format_folder, f"mgf_{file_index}.mgf")
+                synthetic_corpus.write_MGF(output_filename, missing_mslevel_every=7, **common)
+            corpus_files[fmt].append(output_filename)
+    return corpus_files
+
+def write_benchmark_ontology(output_filename):
+    """Writes a compiled ontology with just the synthetic instrument models, so no PSI-MS download is needed."""
+    model_names = sorted(name for _, name in synthetic_corpus.INSTRUMENT_MODELS)
+    compiled = {"version": ontology_cache.COMPILED_ONTOLOGY_VERSION,
+                "obo_sha256": "synthetic",
+                "model_names": model_names,
+                "vendor_names": [],
+                "id_to_name": {accession: name for accession, name in synthetic_corpus.INSTRUMENT_MODELS}}
+    with open(output_filename, "w") as output_file:
+        json.dump(compiled, output_file)
+
+def write_manifest(spectra_files, manifest_filename):
+    with open(manifest_filename, "w", newline="") as manifest_file:
+        writer = csv.writer(manifest_file, delimiter="\t", lineterminator="\n")
+        writer.writerow(["path", "original_path"])
+        for spectrum_file in spectra_files:
+            writer.writerow([spectrum_file, spectrum_file])
+
+def write_merge_inputs(merge_folder, num_merge_files, rows_per_file, seed=0):
+    """Writes per-batch summary tables like the ones chunkResults and mergeResults combine."""
+    rng = random.Random(seed)
+    os.makedirs(merge_folder, exist_ok=True)
+    models = [name for _, name in synthetic_corpus.INSTRUMENT_MODELS]
+    merge_files = []
+    for file_index in range(num_merge_files):
+        merge_filename = os.path.join(merge_folder, f"batched_results_{file_index:05d}.tsv")
+        with open(merge_filename, "w", newline="") as merge_file:
+            writer = csv.writer(merge_file, delimiter="\t", lineterminator="\n")
+            writer.writerow(MERGE_HEADERS)
+            for row_index in range(rows_per_file):
+                dataset = f"MSV{rng.randrange(1000):09d}"
+                filename = f"{dataset}/peak/file_{file_index}_{row_index}.mzML"
+                writer.writerow([filename, f"/data/{filename}", "electrospray ionization", "orbitrap",
+                                 "inductive detector", rng.choice(models), "Thermo Scientific",
+                                 rng.randrange(5000), rng.randrange(50000), "0", "0"])
+        merge_files.append(merge_filename)
+    return merge_files
+
+def _total_bytes(files):
+    return sum(os.path.getsize(x) for x in files)
+
+
+############## Stages ##################
+def run_benchmarks(args, work_folder):
+    stages = [x.strip() for x in args.stages.split(",") if x.strip()] if args.stages else ALL_STAGES
+    unknown_stages = set(stages) - set(ALL_STAGES)
+    if len(unknown_stages) > 0:
+        raise ValueError(f"Unknown stages {sorted(unknown_stages)}, known stages are {ALL_STAGES}")
+
+    log_filename = os.path.join(work_folder, "benchmark.log")
+    corpus_folder = os.path.join(work_folder, "corpus")
+    print("Generating corpus in", corpus_folder)
+    corpus_files = generate_corpus(corpus_folder, args)
+
+    ontology_filename = os.path.join(work_folder, "benchmark_ontology.compiled.json")
+    write_benchmark_ontology(ontology_filename)
+
+    results = {}
+    for stage_name, fmt, extra_arguments in XML_STAGES:
+        if stage_name not in stages:
+            continue
+        manifest_filename = os.path.join(work_folder, f"{stage_name}_manifest.tsv")
+        write_manifest(corpus_files[fmt], manifest_filename)
+        command = [sys.executable, os.path.join(SCRIPTS_FOLDER, "xmlsummary_single.py"),
+                   "--manifest", manifest_filename,
+                   "--result_file", os.path.join(work_folder, f"{stage_name}_summary.tsv"),
+                   "--error_name", os.path.join(work_folder, f"{stage_name}_errors.tsv"),
+                   "--ontology_file", ontology_filename,
+                   "--parallelism", str(args.parallelism)] + extra_arguments
+        results[stage_name] = measure_stage(command, len(corpus_files[fmt]), _total_bytes(corpus_files[fmt]),
+                                            args.repeats, log_filename)
+        print(stage_name, results[stage_name])
+
+    if "msaccess" in stages:
+        all_files = [x for files in corpus_files.values() for x in files]
+        command = [sys.executable, os.path.join(SCRIPTS_FOLDER, "filesummary.py"),
+                   corpus_folder,
+                   os.path.join(work_folder, "msaccess_summary.tsv"),
+                   args.msaccess_binary,
+                   "--parallelism", str(args.parallelism)]
+        results["msaccess"] = measure_stage(command, len(all_files), _total_bytes(all_files), args.repeats, log_filename)
+        print("msaccess", results["msaccess"])
+
+    merge_stages = [x for x in MERGE_STAGES if x in stages]
+    if len(merge_stages) > 0:
+        merge_folder = os.path.join(work_folder, "merge_inputs")
+        merge_files = write_merge_inputs(merge_folder, args.merge_files, args.merge_rows_per_file)
+        merge_command = [sys.executable, os.path.join(SCRIPTS_FOLDER, "tsv_merger.py"), merge_folder,
+                         os.path.join(work_folder, "merged_results.tsv")]
+        merge_arguments = {"merge_tsv": [],
+                           "merge_topk": ["--topk", "10", "--key_column", "Model", "--sort_column", "MS2s"],
+                           "merge_parquet": ["--parquet_output", os.path.join(work_folder, "merged_results_parquet"),
+                                             "--dataset_root", "/data"]}
+        for stage_name in merge_stages:
+            results[stage_name] = measure_stage(merge_command + merge_arguments[stage_name], len(merge_files),
+                                                _total_bytes(merge_files), args.repeats, log_filename)
+            print(stage_name, results[stage_name])
+
+    return results
+
+
+############## Baseline Comparison ##################
+def compare_to_baseline(results, baseline_results, max_slowdown=DEFAULT_MAX_SLOWDOWN, max_rss_growth=DEFAULT_MAX_RSS_GROWTH):
+    """Compares stages that are in both runs.
+
+    Returns:
+        list: Human readable description of every regression, empty if there are none
+    """
+    regressions = []
+    for stage_name, result in results.items():
+        baseline = baseline_results.get(stage_name)
+        if baseline is None:
+            continue
+        if result["files_per_second"] < baseline["files_per_second"] / max_slowdown:
+            regressions.append(f"{stage_name}: {result['files_per_second']} files/s, baseline {baseline['files_per_second']} files/s")
+        if result["peak_rss_mb"] > baseline["peak_rss_mb"] * max_rss_growth:
+            regressions.append(f"{stage_name}: peak RSS {result['peak_rss_mb']} MB, baseline {baseline['peak_rss_mb']} MB")
+    return regressions
+
+def print_table(results, baseline_results=None):
+    print("\t".join(["Stage", "Files/s", "MB/s", "Peak_RSS_MB", "Baseline_Files/s", "Baseline_Peak_RSS_MB"]))
+    for stage_name, result in results.items():
+        baseline = (baseline_results or {}).get(stage_name, {})
+        print("\t".join(str(x) for x in [stage_name, result["files_per_second"], result["mb_per_second"], result["peak_rss_mb"],
+                                          baseline.get("files_per_second", ""), baseline.get("peak_rss_mb", "")]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every summarization backend and merge stage on a synthetic corpus')
+    parser.add_argument('--output', default=None, help='JSON file to save the results to')
+    parser.add_argument('--baseline', default=None, help='Results JSON of an earlier run to compare against')
+    parser.add_argument('--max_slowdown', default=DEFAULT_MAX_SLOWDOWN, type=float, help='Fail when files/s drops below baseline divided by this')
+    parser.add_argument('--max_rss_growth', default=DEFAULT_MAX_RSS_GROWTH, type=float, help='Fail when peak RSS grows above baseline times this')
+    parser.add_argument('--stages', default=None, help=f'Comma separated stages to run, defaults to all of {",".join(ALL_STAGES)}')
+    parser.add_argument('--repeats', default=3, type=int, help='Runs per stage, the fastest is reported')
+    parser.add_argument('--parallelism', default=1, type=int, help='Workers passed to xmlsummary_single.py and filesummary.py')
+    parser.add_argument('--msaccess_binary', default=os.path.join(BENCHMARK_FOLDER, "fake_msaccess.py"), help='msaccess used for the msaccess stage')
+
+    # Corpus, all files are generated deterministically so runs with the same settings are comparable
+    parser.add_argument('--num_files', default=4, type=int, help='Files per format')
+    parser.add_argument('--num_spectra', default=2000, type=int, help='Spectra per file')
+    parser.add_argument('--peaks_per_spectrum', default=50, type=int, help='Peaks per spectrum')
+    parser.add_argument('--num_instrument_configurations', default=3, type=int, help='instrumentConfigurations per mzML file')
+    parser.add_argument('--ms3_every', default=3, type=int, help='Every n-th MS2 becomes an MS3 (0 disables)')
+    parser.add_argument('--merge_files', default=50, type=int, help='Summary tables merged by the merge stages')
+    parser.add_argument('--merge_rows_per_file', default=2000, type=int, help='Rows per merged summary table')
+
+    parser.add_argument('--work_folder', default=None, help='Folder for the corpus and outputs, a temporary folder by default')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary work folder')
+    args = parser.parse_args()
+
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix="filesummary_benchmark_")
+    os.makedirs(work_folder, exist_ok=True)
+    try:
+        results = run_benchmarks(args, work_folder)
+    finally:
+        if args.work_folder is None and not args.keep:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    corpus_settings = {key: getattr(args, key) for key in ["num_files", "num_spectra", "peaks_per_spectrum", "num_instrument_configurations",
+                                                           "ms3_every", "merge_files", "merge_rows_per_file", "parallelism"]}
+    output = {"version": BENCHMARK_RESULTS_VERSION,
+              "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "settings": corpus_settings,
+              "results": results}
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2)
+
+    baseline_results = None
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("settings") != corpus_settings:
+            print("Warning: baseline was run with different settings", baseline.get("settings"))
+        baseline_results = baseline["results"]
+
+    print_table(results, baseline_results)
+
+    if baseline_results is not None:
+        regressions = compare_to_baseline(results, baseline_results, args.max_slowdown, args.max_rss_growth)
+        for regression in regressions:
+            print("Regression", regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
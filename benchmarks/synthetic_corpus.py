@@ -0,0 +1,234 @@
+import argparse
+import base64
+import hashlib
+import os
+import random
+import struct
+
+
+MZML_NS = "http://psi.hupo.org/ms/mzml"
+MZXML_NS = "http://sashimi.sourceforge.net/schema_revision/mzXML_3.2"
+
+# A handful of real PSI-MS instrument models so the ontology lookup has something to find
+INSTRUMENT_MODELS = [("MS:1001742", "LTQ Orbitrap Velos"),
+                     ("MS:1001911", "Q Exactive"),
+                     ("MS:1002523", "Q Exactive HF"),
+                     ("MS:1000703", "micrOTOF-Q II"),
+                    ]
+
+
+def _ms_level(spectrum_index, ms2_per_ms1, ms3_every):
+    """Deterministic MS level pattern: one MS1 followed by ms2_per_ms1 MS2 scans, with every n-th MS2 being MS3."""
+    position = spectrum_index % (ms2_per_ms1 + 1)
+    if position == 0:
+        return 1
+    if ms3_every and position % ms3_every == 0:
+        return 3
+    return 2
+
+
+def _encoded_peaks(rng, peaks_per_spectrum, fmt, byte_order='<'):
+    values = [rng.uniform(50.0, 2000.0) for _ in range(peaks_per_spectrum)]
+    return base64.b64encode(struct.pack(byte_order + fmt * peaks_per_spectrum, *values)).decode('ascii')
+
+
+def write_mzML(output_filename, num_spectra=100, peaks_per_spectrum=50, indexed=True,
+               num_instrument_configurations=2, ms2_per_ms1=5, ms3_every=0, seed=0):
+    """Writes a synthetic mzML file.
+
+    Instrument configurations alternate between a referenceableParamGroup for the model, a local cvParam,
+    and the old mzXML-style userParam tagging so all of the code paths in the parser are exercised.
+    """
+    rng = random.Random(seed)
+    chunks = []
+    offsets = []
+    position = 0
+
+    def emit(text):
+        nonlocal position
+        data = text.encode('utf-8')
+        chunks.append(data)
+        position += len(data)
+
+    emit('<?xml version="1.0" encoding="utf-8"?>\n')
+    if indexed:
+        emit(f'<indexedmzML xmlns="{MZML_NS}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+    emit(f'<mzML xmlns="{MZML_NS}" id="synthetic" version="1.1.0">\n')
+    emit('<cvList count="2">\n'
+         '<cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" version="4.1.0" URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>\n'
+         '<cv id="UO" fullName="Unit Ontology" URI="http://ontologies.berkeleybop.org/uo.obo"/>\n'
+         '</cvList>\n')
+    emit('<fileDescription><fileContent>'
+         '<cvParam cvRef="MS" accession="MS:1000579" name="MS1 spectrum" value=""/>'
+         '<cvParam cvRef="MS" accession="MS:1000580" name="MSn spectrum" value=""/>'
+         '</fileContent></fileDescription>\n')
+    model_accession, model_name = INSTRUMENT_MODELS[seed % len(INSTRUMENT_MODELS)]
+    emit('<referenceableParamGroupList count="1">\n'
+         '<referenceableParamGroup id="CommonInstrumentParams">'
+         f'<cvParam cvRef="MS" accession="{model_accession}" name="{model_name}" value=""/>'
+         '<cvParam cvRef="MS" accession="MS:1000529" name="instrument serial number" value="SN0001"/>'
+         '</referenceableParamGroup>\n'
+         '</referenceableParamGroupList>\n')
+    emit(f'<instrumentConfigurationList count="{num_instrument_configurations}">\n')
+    for config_index in range(num_instrument_configurations):
+        emit(f'<instrumentConfiguration id="IC{config_index + 1}">')
+        style = config_index % 3
+        if style == 0:
+            emit('<referenceableParamGroupRef ref="CommonInstrumentParams"/>')
+        elif style == 1:
+            other_accession, other_name = INSTRUMENT_MODELS[(seed + config_index) % len(INSTRUMENT_MODELS)]
+            emit(f'<cvParam cvRef="MS" accession="{other_accession}" name="{other_name}" value=""/>')
+        else:
+            emit('<userParam name="msModel" value="Synthetic Model"/>'
+                 '<userParam name="msManufacturer" value="Synthetic Vendor"/>')
+        emit('<componentList count="3">'
+             '<source order="1"><cvParam cvRef="MS" accession="MS:1000073" name="electrospray ionization" value=""/></source>'
+             '<analyzer order="2"><cvParam cvRef="MS" accession="MS:1000484" name="orbitrap" value=""/></analyzer>'
+             '<detector order="3"><cvParam cvRef="MS" accession="MS:1000624" name="inductive detector" value=""/></detector>'
+             '</componentList>')
+        emit('</instrumentConfiguration>\n')
+    emit('</instrumentConfigurationList>\n')
+    emit('<softwareList count="1"><software id="synthetic" version="1.0"/></softwareList>\n')
+    emit('<dataProcessingList count="1"><dataProcessing id="synthetic_processing"/></dataProcessingList>\n')
+    emit('<run id="synthetic_run" defaultInstrumentConfigurationRef="IC1">\n')
+    emit(f'<spectrumList count="{num_spectra}" defaultDataProcessingRef="synthetic_processing">\n')
+    for spectrum_index in range(num_spectra):
+        ms_level = _ms_level(spectrum_index, ms2_per_ms1, ms3_every)
+        polarity = ('MS:1000130', 'positive scan') if spectrum_index % 4 else ('MS:1000129', 'negative scan')
+        spectrum_id = f"controllerType=0 controllerNumber=1 scan={spectrum_index + 1}"
+        offsets.append((spectrum_id, position))
+        mz_array = _encoded_peaks(rng, peaks_per_spectrum, 'd')
+        intensity_array = _encoded_peaks(rng, peaks_per_spectrum, 'f')
+        emit(f'<spectrum index="{spectrum_index}" id="{spectrum_id}" defaultArrayLength="{peaks_per_spectrum}">\n'
+             f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{ms_level}"/>\n'
+             f'<cvParam cvRef="MS" accession="{polarity[0]}" name="{polarity[1]}" value=""/>\n'
+             '<cvParam cvRef="MS" accession="MS:1000127" name="centroid spectrum" value=""/>\n'
+             '<scanList count="1"><cvParam cvRef="MS" accession="MS:1000795" name="no combination" value=""/>'
+             f'<scan><cvParam cvRef="MS" accession="MS:1000016" name="scan start time" value="{spectrum_index * 0.01:.4f}" unitCvRef="UO" unitAccession="UO:0000031" unitName="minute"/></scan>'
+             '</scanList>\n'
+             '<binaryDataArrayList count="2">\n'
+             f'<binaryDataArray encodedLength="{len(mz_array)}">'
+             '<cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>'
+             '<cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>'
+             '<cvParam cvRef="MS" accession="MS:1000514" name="m/z array" value=""/>'
+             f'<binary>{mz_array}</binary></binaryDataArray>\n'
+             f'<binaryDataArray encodedLength="{len(intensity_array)}">'
+             '<cvParam cvRef="MS" accession="MS:1000521" name="32-bit float" value=""/>'
+             '<cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>'
+             '<cvParam cvRef="MS" accession="MS:1000515" name="intensity array" value=""/>'
+             f'<binary>{intensity_array}</binary></binaryDataArray>\n'
+             '</binaryDataArrayList>\n'
+             '</spectrum>\n')
+    emit('</spectrumList>\n</run>\n</mzML>\n')
+    if indexed:
+        index_list_offset = position
+        emit('<indexList count="1">\n<index name="spectrum">\n')
+        for spectrum_id, offset in offsets:
+            emit(f'<offset idRef="{spectrum_id}">{offset}</offset>\n')
+        emit('</index>\n</indexList>\n')
+        emit(f'<indexListOffset>{index_list_offset}</indexListOffset>\n')
+        checksum = hashlib.sha1(b''.join(chunks) + b'<fileChecksum>').hexdigest()
+        emit(f'<fileChecksum>{checksum}</fileChecksum>\n</indexedmzML>\n')
+
+    with open(output_filename, 'wb') as output_file:
+        output_file.writelines(chunks)
+
+
+def write_mzXML(output_filename, num_spectra=100, peaks_per_spectrum=50, indexed=True, ms2_per_ms1=5, ms3_every=0, seed=0):
+    """Writes a synthetic mzXML 3.2 file with an optional scan index footer."""
+    rng = random.Random(seed)
+    chunks = []
+    offsets = []
+    position = 0
+
+    def emit(text):
+        nonlocal position
+        data = text.encode('utf-8')
+        chunks.append(data)
+        position += len(data)
+
+    _, model_name = INSTRUMENT_MODELS[seed % len(INSTRUMENT_MODELS)]
+    emit('<?xml version="1.0" encoding="ISO-8859-1"?>\n')
+    emit(f'<mzXML xmlns="{MZXML_NS}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+    emit(f'<msRun scanCount="{num_spectra}" startTime="PT0S" endTime="PT{num_spectra * 0.6:.1f}S">\n')
+    emit('<parentFile fileName="synthetic.raw" fileType="RAWData" fileSha1="0000000000000000000000000000000000000000"/>\n')
+    emit('<msInstrument msInstrumentID="1">\n'
+         '<msManufacturer category="msManufacturer" value="Thermo Scientific"/>\n'
+         f'<msModel category="msModel" value="{model_name}"/>\n'
+         '<msIonisation category="msIonisation" value="electrospray ionization"/>\n'
+         '<msMassAnalyzer category="msMassAnalyzer" value="orbitrap"/>\n'
+         '<msDetector category="msDetector" value="inductive detector"/>\n'
+         '</msInstrument>\n')
+    emit('<dataProcessing centroided="1"><software type="conversion" name="synthetic" version="1.0"/></dataProcessing>\n')
+    for spectrum_index in range(num_spectra):
+        ms_level = _ms_level(spectrum_index, ms2_per_ms1, ms3_every)
+        polarity = '+' if spectrum_index % 4 else '-'
+        offsets.append((spectrum_index + 1, position))
+        peaks = _encoded_peaks(rng, peaks_per_spectrum * 2, 'f', byte_order='>')
+        emit(f'<scan num="{spectrum_index + 1}" scanType="Full" centroided="1" msLevel="{ms_level}" '
+             f'peaksCount="{peaks_per_spectrum}" polarity="{polarity}" retentionTime="PT{spectrum_index * 0.6:.4f}S">\n'
+             f'<peaks compressionType="none" compressedLen="0" precision="32" byteOrder="network" contentType="m/z-int">{peaks}</peaks>\n'
+             '</scan>\n')
+    emit('</msRun>\n')
+    if indexed:
+        index_offset = position
+        emit('<index name="scan">\n')
+        for scan_number, offset in offsets:
+            emit(f'<offset id="{scan_number}">{offset}</offset>\n')
+        emit('</index>\n')
+        emit(f'<indexOffset>{index_offset}</indexOffset>\n')
+    emit('<sha1>0000000000000000000000000000000000000000</sha1>\n</mzXML>\n')
+
+    with open(output_filename, 'wb') as output_file:
+        output_file.writelines(chunks)
+
+
+def write_MGF(output_filename, num_spectra=100, peaks_per_spectrum=50, ms2_per_ms1=5, ms3_every=0,
+              missing_mslevel_every=0, seed=0):
+    """Writes a synthetic MGF file. Every missing_mslevel_every-th spectrum has no MSLEVEL line."""
+    rng = random.Random(seed)
+    with open(output_filename, 'w') as output_file:
+        for spectrum_index in range(num_spectra):
+            ms_level = _ms_level(spectrum_index, ms2_per_ms1, ms3_every)
+            output_file.write("BEGIN IONS\n")
+            output_file.write(f"PEPMASS={rng.uniform(100.0, 1500.0):.4f}\n")
+            output_file.write(f"CHARGE={'1-' if spectrum_index % 4 == 0 else '1+'}\n")
+            if not (missing_mslevel_every and spectrum_index % missing_mslevel_every == 0):
+                output_file.write(f"MSLEVEL={ms_level}\n")
+            output_file.write(f"RTINSECONDS={spectrum_index * 0.6:.3f}\n")
+            output_file.write(f"SCANS={spectrum_index + 1}\n")
+            for _ in range(peaks_per_spectrum):
+                output_file.write(f"{rng.uniform(50.0, 2000.0):.4f}\t{rng.uniform(0.0, 1e6):.1f}\n")
+            output_file.write("END IONS\n\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a deterministic synthetic spectrum corpus')
+    parser.add_argument('output_folder', help='Folder to write the corpus to')
+    parser.add_argument('--num_files', default=3, type=int, help='Number of files per format')
+    parser.add_argument('--num_spectra', default=100, type=int, help='Spectra per file')
+    parser.add_argument('--peaks_per_spectrum', default=50, type=int, help='Peaks per spectrum')
+    parser.add_argument('--num_instrument_configurations', default=3, type=int, help='instrumentConfigurations per mzML file')
+    parser.add_argument('--ms3_every', default=0, type=int, help='Every n-th MS2 becomes an MS3 (0 disables)')
+    parser.add_argument('--formats', default='mzML,indexed_mzML,mzXML,indexed_mzXML,mgf', help='Comma separated formats to generate')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    formats = [x.strip() for x in args.formats.split(',') if x.strip()]
+    for file_index in range(args.num_files):
+        common = dict(num_spectra=args.num_spectra, peaks_per_spectrum=args.peaks_per_spectrum,
+                      ms3_every=args.ms3_every, seed=file_index)
+        for fmt in formats:
+            if fmt in ('mzML', 'indexed_mzML'):
+                write_mzML(os.path.join(args.output_folder, f"{fmt}_{file_index}.mzML"), indexed=(fmt == 'indexed_mzML'),
+                           num_instrument_configurations=args.num_instrument_configurations, **common)
+            elif fmt in ('mzXML', 'indexed_mzXML'):
+                write_mzXML(os.path.join(args.output_folder, f"{fmt}_{file_index}.mzXML"), indexed=(fmt == 'indexed_mzXML'), **common)
+            elif fmt == 'mgf':
+                write_MGF(os.path.join(args.output_folder, f"mgf_{file_index}.mgf"), missing_mslevel_every=7, **common)
+            else:
+                raise ValueError(f"Unknown format {fmt}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,49 @@
 import pandas as pd
 import argparse
+from pathlib import PurePosixPath
+import sys
+
+# Rows of the summary that are joined at a time
+DEFAULT_CHUNK_ROWS = 200000
+
+
+def normalize_paths(filenames, path_to_spectra):
+    """Makes summary filenames relative to path_to_spectra, with vectorized string operations.
+
+    Matches Path(x).relative_to(path_to_spectra) for files inside path_to_spectra. Files outside of it are
+    left as they are (after normalization) and will simply not match any USI.
+    """
+    def normalize(paths):
+        # Only the few paths with //, ./ or a trailing / need the (slow) per path normalization
+        needs_normalization = paths.str.contains(r"//|(?:^|/)\.(?:/|$)|/$", regex=True)
+        if needs_normalization.any():
+            paths = paths.where(~needs_normalization, paths[needs_normalization].map(lambda x: str(PurePosixPath(x))))
+        return paths
+
+    prefix = str(PurePosixPath(path_to_spectra))
+    filenames = normalize(filenames.astype(str))
+    if prefix in ("", "."):
+        return filenames
+
+    prefix = prefix + "/"
+    inside_spectra = filenames.str.startswith(prefix)
+    return filenames.where(~inside_spectra, filenames.str.slice(len(prefix)))
+
+def read_usi_index(input_usi_summary):
+    """Reads the USI table once and indexes its usi by target_path.
+
+    The hash table of the index is built on first use and reused for every chunk of the summary.
+    """
+    df_usi = pd.read_csv(input_usi_summary, sep="\t", usecols=["usi", "target_path"], dtype=str, keep_default_na=False)
+    df_usi = df_usi[df_usi["target_path"] != ""]
+    return df_usi.set_index("target_path")[["usi"]]
+
+def join_chunk(df, usi_index, path_to_spectra):
+    df["filename"] = normalize_paths(df["Filename"], path_to_spectra)
+    # Same as a left merge, a file with several USIs gets one row per USI
+    df = df.join(usi_index, on="filename", how="left")
+    df["target_path"] = df["filename"].where(df["usi"].notna())
+    return df
 
 
 def main():
@@ -9,35 +53,51 @@ def main():
     parser.add_argument('input_usi_summary', help='')
     parser.add_argument('path_to_spectra', help='')
     parser.add_argument('output_summary', help='')
+    parser.add_argument('--chunk_rows', default=DEFAULT_CHUNK_ROWS, type=int, help='Rows of the summary joined at a time')
 
     args = parser.parse_args()
 
     #reading input files
     try:
-        df = pd.read_csv(args.input_summary, sep="\t")
-    except:
-        pd.DataFrame().to_csv(args.output_summary, sep="\t", index=False)
-        exit(0)
+        usi_index = read_usi_index(args.input_usi_summary)
+    except pd.errors.EmptyDataError:
+        # The rows are still written with the USI columns, left empty, so the output has the same header either way
+        print("Empty USI summary, writing the summary with empty USI columns")
+        usi_index = pd.DataFrame({"usi": pd.Series(dtype=str)}, index=pd.Index([], dtype=str, name="target_path"))
+    except ValueError as e:
+        # usecols raises a ValueError when the USI table does not have the expected columns
+        print("Invalid USI summary", args.input_usi_summary, e, file=sys.stderr)
+        raise
 
+    # Streaming the summary through the USI index
     try:
-        df_usi = pd.read_csv(args.input_usi_summary, sep="\t")
-    except:
-        df.to_csv(args.output_summary, sep="\t", index=False)
-        exit(0)
+        summary_chunks = pd.read_csv(args.input_summary, sep="\t", dtype=str, keep_default_na=False, chunksize=args.chunk_rows)
+    except pd.errors.EmptyDataError:
+        # Not even a header, the output still gets the columns of a joined summary
+        summary_chunks = [pd.DataFrame({"Filename": pd.Series(dtype=str)})]
+
+    number_of_rows = 0
+    number_unmatched = 0
+    header_written = False
+    with open(args.output_summary, "w", newline="") as output_file:
+        for df in summary_chunks:
+            if "Filename" not in df.columns:
+                raise KeyError(f"Summary {args.input_summary} has no Filename column, columns are {list(df.columns)}")
 
-    # clean up the summary to make it relative to the path to spectra, using pathlib
-    from pathlib import Path
-    path_to_spectra = Path(args.path_to_spectra)
+            df = join_chunk(df, usi_index, args.path_to_spectra)
+            number_of_rows += len(df)
+            number_unmatched += int(df["usi"].isna().sum())
 
-    df["filename"] = df["Filename"].apply(lambda x: str(Path(x).relative_to(path_to_spectra)))
+            df.to_csv(output_file, sep="\t", index=False, header=not header_written)
+            header_written = True
 
-    # Merging the two columns
-    df_usi = df_usi[["usi", "target_path"]]
-    df = df.merge(df_usi, left_on="filename", right_on="target_path", how="left")
+        if not header_written:
+            # A header without rows may not yield any chunk, the header is written with the USI columns all the same
+            df = pd.read_csv(args.input_summary, sep="\t", dtype=str, keep_default_na=False, nrows=0)
+            join_chunk(df, usi_index, args.path_to_spectra).to_csv(output_file, sep="\t", index=False)
 
-    # Writing the output
-    df.to_csv(args.output_summary, sep="\t", index=False)
+    print("Rows", number_of_rows, "without a matching USI", number_unmatched)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
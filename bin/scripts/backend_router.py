@@ -0,0 +1,123 @@
+import os
+import subprocess
+import zlib
+
+from lxml import etree
+
+import msaccess_runner
+import perf_log
+import spectrum_io
+import xmlsummary_single
+
+# Below this size a streaming parse costs about as much as seeking through the index, so the index is not tried first
+INDEX_MIN_BYTES = 16 * 1024 * 1024
+# Failures of a backend on a file that the next backend may not have: unreadable, truncated, or malformed files,
+# files a parser does not support, and msaccess failing or timing out
+BACKEND_ERRORS = (OSError, EOFError, ValueError, NotImplementedError, zlib.error, etree.LxmlError, subprocess.SubprocessError)
+
+def _has_index_footer(input_file, file_format):
+    """Cheap check for an index, only the footer is read. Whether the index itself is usable is up to the xml_index backend."""
+    footer_pattern = xmlsummary_single.MZML_INDEX_FOOTER_PATTERN if file_format == 'mzML' else xmlsummary_single.MZXML_INDEX_FOOTER_PATTERN
+    file_size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as f:
+        f.seek(max(0, file_size - xmlsummary_single.INDEX_FOOTER_BYTES))
+        return footer_pattern.search(f.read()) is not None
+
+def plan_backends(input_file, extra_metrics=(), msaccess_binary=None, metadata_only=False):
+    """Backends to try for a file, cheapest first.
+
+    xml_index is only planned for uncompressed, indexed mzML/mzXML of at least INDEX_MIN_BYTES and when no per-spectrum
+    extra metric is requested, xml_stream and then xml_full (the whole document with a recovering parser, for files the
+    streaming parse rejects) for any mzML/mzXML, mgf_scan for MGF, and msaccess for every file as a last resort when a
+    binary is given (it only fills the Vendor, Model, MS1s and MS2s columns).
+    metadata_only plans the header only backends, xml_header for mzML/mzXML and mgf_header for MGF, and no msaccess,
+    which reads every spectrum.
+
+    Returns:
+        list: Backend names
+    """
+    file_format, compression = spectrum_io.spectrum_format(input_file)
+    if metadata_only:
+        if file_format in ('mzML', 'mzXML'):
+            return ['xml_header']
+        if file_format == 'mgf':
+            return ['mgf_header']
+        return []
+    backends = []
+    if file_format in ('mzML', 'mzXML'):
+        try:
+            use_index = (compression is None and
+                         not xmlsummary_single.ExtraMetrics(extra_metrics).per_spectrum and
+                         os.path.getsize(input_file) >= INDEX_MIN_BYTES and
+                         _has_index_footer(input_file, file_format))
+        except OSError:
+            use_index = False # The xml_stream backend reports the error
+        if use_index:
+            backends.append('xml_index')
+        backends.append('xml_stream')
+        backends.append('xml_full')
+    elif file_format == 'mgf':
+        backends.append('mgf_scan')
+    if msaccess_binary is not None:
+        backends.append('msaccess')
+    return backends
+
+def _parse_count(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+def _msaccess_row(run_summaries, input_file, original_path):
+    """Converts the run_summary rows of msaccess into a summary row, several runs are joined by '|' like instrument configurations."""
+    if len(run_summaries) == 0:
+        raise ValueError("msaccess produced no run summary")
+    output_dictionary = {}
+    output_dictionary['Filename'] = os.path.basename(input_file)
+    output_dictionary['Original_Path'] = original_path
+    output_dictionary['Ion_Source'] = ''
+    output_dictionary['Mass_Analyzer'] = ''
+    output_dictionary['Mass_Detector'] = ''
+    output_dictionary['Model'] = '|'.join(x.get('Model') or '' for x in run_summaries)
+    output_dictionary['Vendor'] = '|'.join(x.get('Vendor') or '' for x in run_summaries)
+    output_dictionary['MS1s'] = sum(_parse_count(x.get('MS1s')) for x in run_summaries)
+    output_dictionary['MS2s'] = sum(_parse_count(x.get('MS2s')) for x in run_summaries)
+    # msaccess does not report these
+    output_dictionary[f"MS{xmlsummary_single.MAX_MS_LEVEL}+"] = ''
+    return output_dictionary
+
+def _summarize_with_backend(backend, input_file, original_path, ontology_file, extra_metrics, msaccess_binary, msaccess_timeout):
+    if backend == 'msaccess':
+        perf_log.set_backend('msaccess')
+        perf_log.phase('spectrum_count')
+        run_summaries = msaccess_runner.run_msaccess(msaccess_binary, input_file, timeout=msaccess_timeout)
+        return _msaccess_row(run_summaries, input_file, original_path)
+    use_index = backend == 'xml_index'
+    return xmlsummary_single.summarize_file(input_file, original_path, ontology_file=ontology_file, use_index=use_index,
+                          extra_metrics=extra_metrics, require_index=use_index,
+                          metadata_only=backend in ('xml_header', 'mgf_header'), full_tree=backend == 'xml_full')
+
+def summarize_routed(input_file, original_path, ontology_file=None, extra_metrics=(), msaccess_binary=None,
+                     msaccess_timeout=msaccess_runner.DEFAULT_MSACCESS_TIMEOUT, metadata_only=False):
+    """Summarizes a file with the cheapest backend of plan_backends, falling back to the next one whenever a backend fails.
+
+    A backend fails with one of BACKEND_ERRORS, any other exception is a bug and is raised to the caller, which writes
+    it to the error table like a file that failed every backend.
+
+    Returns:
+        tuple: (summary row with the Backend that produced it, None) if any backend succeeded,
+               otherwise (None, error message with the failure of every backend tried)
+    """
+    errors = []
+    for backend in plan_backends(input_file, extra_metrics, msaccess_binary, metadata_only):
+        try:
+            output_dictionary = _summarize_with_backend(backend, input_file, original_path, ontology_file, extra_metrics,
+                                                        msaccess_binary, msaccess_timeout)
+        except BACKEND_ERRORS as backend_error:
+            errors.append(f"{backend}: {type(backend_error).__name__}: {backend_error}")
+            continue
+        output_dictionary[xmlsummary_single.BACKEND_COLUMN] = backend
+        return output_dictionary, None
+    if len(errors) == 0:
+        return None, "Unknown filetype"
+    return None, '; '.join(errors)
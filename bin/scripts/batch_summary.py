@@ -0,0 +1,175 @@
+import concurrent.futures
+import csv
+import os
+
+import backend_router
+import ontology_cache
+import perf_log
+import xmlsummary_single
+from result_cache import ResultCache
+
+# Exit status of a batch whose worker process was killed, the status of a task killed by the kernel OOM killer (SIGKILL),
+# so the workflow retries the batch with more memory
+WORKER_KILLED_EXIT_CODE = 137
+
+def open_result_cache(cache_db, ontology_file=None, use_fingerprint=False, extra_metrics=(), metadata_only=False):
+    """Opens the persistent result cache, rows are invalidated by PARSER_VERSION, the extra metrics, metadata_only and the ontology hash."""
+    ontology_hash = ontology_cache.load_ontology(ontology_file).obo_sha256 if ontology_file is not None else ''
+    # Rows without the requested extra metric columns, or without counts, are stale
+    version = xmlsummary_single.PARSER_VERSION + ''.join(f"+{x}" for x in extra_metrics) + ("+metadata" if metadata_only else "")
+    return ResultCache(cache_db, 'xmlsummary', version, ontology_hash=ontology_hash, use_fingerprint=use_fingerprint)
+
+def _retarget_row(output_dictionary, input_file, original_path):
+    """Copies a cached row for the file at input_file/original_path, which may differ from the file it was computed on."""
+    output_dictionary = dict(output_dictionary)
+    output_dictionary['Filename'] = os.path.basename(input_file)
+    output_dictionary['Original_Path'] = original_path
+    return output_dictionary
+
+def read_manifest(manifest_file):
+    """Reads a tab separated manifest with a 'path' column and an optional 'original_path' column.
+
+    Returns:
+        list: (path, original_path) tuples, original_path defaults to path
+    """
+    with open(manifest_file, 'r', newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        return [(row['path'], row.get('original_path') or row['path']) for row in reader]
+
+def _init_batch_worker(ontology_file):
+    # Load the ontology once per worker rather than once per file
+    if ontology_file is not None:
+        ontology_cache.load_ontology(ontology_file)
+
+def _summarize_batch_entry(batch_entry):
+    """Summarizes one manifest entry inside a worker, turning any failure into an error row.
+
+    Returns:
+        tuple: (summary row or None, error row or None, perf record or None)
+    """
+    input_file, original_path, ontology_file, use_index, extra_metrics, metadata_only, route, record_perf = batch_entry
+    perf_record = perf_log.begin(input_file, original_path) if record_perf else None
+    output_dictionary = None
+    error_dictionary = None
+    try:
+        if route is not None:
+            output_dictionary, error = backend_router.summarize_routed(input_file, original_path, ontology_file=ontology_file,
+                                                                       extra_metrics=extra_metrics, metadata_only=metadata_only, **route)
+        else:
+            output_dictionary = xmlsummary_single.summarize_file(input_file, original_path, ontology_file=ontology_file, use_index=use_index,
+                                                                 extra_metrics=extra_metrics, metadata_only=metadata_only)
+            error = "Unknown filetype"
+        if output_dictionary is None:
+            error_dictionary = {'Filename': os.path.basename(input_file),
+                                'Original_Path': original_path,
+                                'Error': error}
+    except Exception as any_exception:
+        error_dictionary = {'Filename': os.path.basename(input_file),
+                            'Original_Path': original_path,
+                            'Error': f"{type(any_exception).__name__}: {any_exception}"}
+    if perf_record is not None and error_dictionary is not None:
+        perf_record.error = error_dictionary['Error']
+    return output_dictionary, error_dictionary, perf_log.end()
+
+def _reused_perf_record(input_file, original_path, backend):
+    """Perf record of a file whose row was reused rather than summarized."""
+    perf_record = perf_log.PerfRecord(input_file, original_path, measure_process=False)
+    perf_record.backend = backend
+    return perf_record.finish().to_dict()
+
+def process_batch(manifest_file, output_filename, error_filename, ontology_file=None, use_index=False, parallelism=1,
+                  cache_db=None, use_fingerprint=False, perf_log_file=None, extra_metrics=(), route=None, metadata_only=False):
+    """Summarizes every file in a manifest within this interpreter using a pool of workers.
+
+    Rows are written to one combined TSV in manifest order, files that fail are written to the error table.
+    With a cache, files that are unchanged since they were cached are not summarized again, and with fingerprints
+    identical files under different paths are summarized once and fanned out to every path.
+    With perf_log_file, a perf record per file is appended to it as JSON lines.
+    extra_metrics (from parse_extra_metrics) adds their columns to every row, metadata_only only reads the headers and
+    leaves the MS level columns empty.
+    With route (a dict of msaccess_binary and msaccess_timeout), every file is summarized by backend_router.summarize_routed and
+    rows name their Backend, the error table then only lists files that failed every backend.
+
+    Returns:
+        tuple: (number of files summarized, number of files that failed)
+
+    Raises:
+        concurrent.futures.process.BrokenProcessPool: If a worker was killed (e.g., by the OOM killer), nothing is
+            written then, but the rows summarized so far are in the cache
+    """
+    manifest_entries = read_manifest(manifest_file)
+    output_rows = [None] * len(manifest_entries)
+    error_rows = [None] * len(manifest_entries)
+    perf_records = [None] * len(manifest_entries)
+    record_perf = perf_log_file is not None
+
+    cache = open_result_cache(cache_db, ontology_file, use_fingerprint, extra_metrics, metadata_only) if cache_db is not None else None
+
+    # Files still to summarize, grouped so that each group is summarized once
+    pending_groups = {}
+    for entry_index, (input_file, original_path) in enumerate(manifest_entries):
+        if cache is not None:
+            cached_row = cache.lookup(original_path, stat_path=input_file)
+            if cached_row is not None:
+                output_rows[entry_index] = _retarget_row(cached_row, input_file, original_path)
+                if record_perf:
+                    perf_records[entry_index] = _reused_perf_record(input_file, original_path, 'cache')
+                continue
+        group_key = entry_index
+        if cache is not None and use_fingerprint:
+            try:
+                group_key = cache.fingerprint(input_file)
+            except OSError:
+                pass # Missing files are reported by the summarizer
+        pending_groups.setdefault(group_key, []).append(entry_index)
+
+    group_indices = list(pending_groups.values())
+    batch_entries = [(*manifest_entries[indices[0]], ontology_file, use_index, extra_metrics, metadata_only, route, record_perf) for indices in group_indices]
+    print(f"{len(manifest_entries) - sum(len(x) for x in group_indices)} files cached, summarizing {len(batch_entries)}")
+
+    if parallelism > 1 and len(batch_entries) > 1:
+        # Unlike multiprocessing.Pool, which replaces a killed worker and waits forever for the entry it lost, the
+        # executor fails the remaining entries with BrokenProcessPool
+        pool = concurrent.futures.ProcessPoolExecutor(parallelism, initializer=_init_batch_worker, initargs=(ontology_file,))
+        results = pool.map(_summarize_batch_entry, batch_entries, chunksize=max(1, len(batch_entries) // (parallelism * 4)))
+    else:
+        pool = None
+        _init_batch_worker(ontology_file)
+        results = map(_summarize_batch_entry, batch_entries)
+
+    try:
+        for indices, (output_dictionary, error_dictionary, perf_record) in zip(group_indices, results):
+            if record_perf:
+                perf_records[indices[0]] = perf_record
+                # Identical files under other paths reuse the row of the first one
+                for entry_index in indices[1:]:
+                    perf_records[entry_index] = _reused_perf_record(*manifest_entries[entry_index], 'fingerprint')
+            for entry_index in indices:
+                input_file, original_path = manifest_entries[entry_index]
+                if output_dictionary is None:
+                    error_rows[entry_index] = _retarget_row(error_dictionary, input_file, original_path)
+                    continue
+                output_rows[entry_index] = _retarget_row(output_dictionary, input_file, original_path)
+                if cache is not None:
+                    cache.store(original_path, output_rows[entry_index], output_dictionary.get(xmlsummary_single.BACKEND_COLUMN, 'xml'), stat_path=input_file)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if cache is not None:
+            cache.close()
+
+    with open(output_filename, 'w', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=xmlsummary_single.output_headers(extra_metrics, route is not None), delimiter='\t', extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(x for x in output_rows if x is not None)
+    with open(error_filename, 'w', newline='') as error_file:
+        error_writer = csv.DictWriter(error_file, fieldnames=xmlsummary_single.ERROR_HEADERS, delimiter='\t')
+        error_writer.writeheader()
+        error_writer.writerows(x for x in error_rows if x is not None)
+    if record_perf:
+        perf_log.write_records(perf_log_file, perf_records)
+
+    number_summarized = sum(x is not None for x in output_rows)
+    number_failed = sum(x is not None for x in error_rows)
+    print(f"Summarized {number_summarized} files, {number_failed} failed")
+    return number_summarized, number_failed
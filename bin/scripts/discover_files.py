@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+import argparse
+import concurrent.futures
+import csv
+import os
+import queue
+import sys
+
+import spectrum_io
+
+# Directories listed concurrently. Listing is dominated by filesystem latency (especially on network filesystems), not CPU
+DEFAULT_PARALLELISM = 16
+
+# original_path is the path a file is reported under, which only differs from path for USI downloads (see discover_with_downloads)
+MANIFEST_HEADERS = ["path", "size", "mtime", "format", "original_path"]
+
+# How symbolic links are treated:
+#   none:  symlinks are skipped entirely
+#   files: symlinks to files are listed, symlinks to directories are not descended into
+#   all:   symlinked directories are descended into as well, every directory is visited once even if it is linked several times
+SYMLINK_POLICIES = ['none', 'files', 'all']
+
+class DiscoveryStats:
+    def __init__(self):
+        self.directories = 0
+        self.entries = 0
+        self.matched = 0
+        self.skipped_size = 0
+        self.skipped_symlinks = 0
+        self.errors = 0
+
+    def __str__(self):
+        return (f"Directories {self.directories} entries {self.entries} matched {self.matched} "
+                f"skipped by size {self.skipped_size} skipped symlinks {self.skipped_symlinks} errors {self.errors}")
+
+def _directory_key(path):
+    """Identity of a directory, so a directory reached through several symlinks is only walked once."""
+    stat_result = os.stat(path)
+    return stat_result.st_dev, stat_result.st_ino
+
+def _manifest_entry(path, stat_result, file_format, compression):
+    """Manifest row of a file, format includes the compression, e.g. mzML.gz."""
+    return {'path': path,
+            'size': stat_result.st_size,
+            'mtime': stat_result.st_mtime,
+            'format': file_format + (compression or ''),
+            'original_path': path}
+
+def _scan_directory(directory, formats, min_size, max_size, symlinks):
+    """Lists one directory, filtering files by extension before they are stat'ed and by size after.
+
+    Returns:
+        tuple: (manifest entries, subdirectories to walk, DiscoveryStats of this directory)
+    """
+    entries = []
+    subdirectories = []
+    stats = DiscoveryStats()
+    stats.directories = 1
+    try:
+        with os.scandir(directory) as directory_entries:
+            for directory_entry in directory_entries:
+                stats.entries += 1
+                try:
+                    is_symlink = directory_entry.is_symlink()
+                    if is_symlink and symlinks == 'none':
+                        stats.skipped_symlinks += 1
+                        continue
+                    # The file type usually comes with the listing itself, so directories cost no stat
+                    if directory_entry.is_dir(follow_symlinks=True):
+                        if is_symlink and symlinks != 'all':
+                            stats.skipped_symlinks += 1
+                        else:
+                            subdirectories.append(directory_entry.path)
+                        continue
+
+                    file_format, compression = spectrum_io.spectrum_format(directory_entry.name)
+                    if file_format is None or (formats is not None and file_format not in formats):
+                        continue
+                    # Only matching files are stat'ed, for symlinks this is the target
+                    stat_result = directory_entry.stat(follow_symlinks=True)
+                except FileNotFoundError:
+                    # Broken symlink, or the file was removed while we were listing
+                    stats.errors += 1
+                    continue
+                except OSError as os_error:
+                    print("Error", directory_entry.path, os_error, file=sys.stderr)
+                    stats.errors += 1
+                    continue
+
+                if stat_result.st_size < min_size or (max_size is not None and stat_result.st_size > max_size):
+                    stats.skipped_size += 1
+                    continue
+                entries.append(_manifest_entry(directory_entry.path, stat_result, file_format, compression))
+    except OSError as os_error:
+        print("Error", directory, os_error, file=sys.stderr)
+        stats.errors += 1
+    stats.matched = len(entries)
+    return entries, subdirectories, stats
+
+def discover_spectrum_files(roots, formats=None, min_size=0, max_size=None, symlinks='files', parallelism=DEFAULT_PARALLELISM, stats=None):
+    """Walks every root once, listing directories concurrently, and yields the spectrum files as manifest entries.
+
+    Files are yielded in the order their directories are listed, which is not deterministic.
+
+    Args:
+        roots (list): Directories to walk, a root that is a file is checked against the filters directly
+        formats (set): Format names from spectrum_io.SPECTRUM_FORMATS to keep, all of them if None
+        min_size (int): Files smaller than this many bytes are skipped
+        max_size (int): Files larger than this many bytes are skipped, no limit if None
+        symlinks (str): One of SYMLINK_POLICIES
+        stats (DiscoveryStats): Filled with the counts of the walk, if given
+    """
+    if symlinks not in SYMLINK_POLICIES:
+        raise ValueError(f"Unknown symlink policy {symlinks}, supported are {SYMLINK_POLICIES}")
+    stats = stats if stats is not None else DiscoveryStats()
+
+    visited_directories = set()
+    def should_walk(directory):
+        if symlinks != 'all':
+            # Without following directory symlinks the walk is a tree, so nothing can be visited twice
+            return True
+        try:
+            directory_key = _directory_key(directory)
+        except OSError:
+            return False
+        if directory_key in visited_directories:
+            return False
+        visited_directories.add(directory_key)
+        return True
+
+    # Listed directories are handed back through a queue, waiting on a set of futures would be quadratic in the number of directories
+    completed = queue.SimpleQueue()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+        number_pending = 0
+        def walk(directory):
+            nonlocal number_pending
+            if should_walk(directory):
+                executor.submit(_scan_directory, directory, formats, min_size, max_size, symlinks).add_done_callback(completed.put)
+                number_pending += 1
+
+        for root in roots:
+            if os.path.isdir(root):
+                walk(root)
+                continue
+            file_format, compression = spectrum_io.spectrum_format(root)
+            if file_format is None or (formats is not None and file_format not in formats):
+                continue
+            try:
+                stat_result = os.stat(root)
+            except OSError as os_error:
+                print("Error", root, os_error, file=sys.stderr)
+                stats.errors += 1
+                continue
+            if stat_result.st_size >= min_size and (max_size is None or stat_result.st_size <= max_size):
+                stats.matched += 1
+                yield _manifest_entry(root, stat_result, file_format, compression)
+
+        while number_pending > 0:
+            entries, subdirectories, directory_stats = completed.get().result()
+            number_pending -= 1
+            for subdirectory in subdirectories:
+                walk(subdirectory)
+            for attribute in vars(directory_stats):
+                setattr(stats, attribute, getattr(stats, attribute) + getattr(directory_stats, attribute))
+            yield from entries
+
+def published_copy_path(path, usi_folder, spectra_folder):
+    """Path that a file of the USI download folder has once the folder itself is published into the spectra folder.
+
+    E.g. usi_downloads/nest/a.mzML is published to <spectra_folder>/usi_downloads/nest/a.mzML, for a relative or absolute usi_folder.
+    """
+    usi_folder = os.path.normpath(usi_folder)
+    return os.path.normpath(os.path.join(spectra_folder, os.path.basename(usi_folder), os.path.relpath(path, usi_folder)))
+
+def discover_with_downloads(spectra_folder, usi_folder=None, **discover_args):
+    """Discovers the spectrum files of spectra_folder and of a USI download folder that is published into it.
+
+    Downloads are listed from usi_folder, where they are complete as soon as the download finished, but are reported
+    (original_path) under the path they are published to. Published copies already in spectra_folder are dropped.
+
+    Returns:
+        list: Manifest entries, downloads first
+    """
+    entries = list(discover_spectrum_files([spectra_folder], **discover_args))
+    if usi_folder is None:
+        return entries
+
+    usi_entries = list(discover_spectrum_files([usi_folder], **discover_args))
+    for entry in usi_entries:
+        entry['original_path'] = published_copy_path(entry['path'], usi_folder, spectra_folder)
+    published_copies = set(x['original_path'] for x in usi_entries)
+    return usi_entries + [x for x in entries if os.path.normpath(x['path']) not in published_copies]
+
+def write_manifest(entries, manifest_file, sort_by_path=True):
+    """Writes manifest entries as a TSV sorted by path, so the same tree always gives the same manifest.
+
+    A path listed more than once (e.g., a root inside another root) is written once. With sort_by_path False the
+    entries keep their order, e.g. the dispatch order of a batch.
+
+    Returns:
+        int: Number of entries written
+    """
+    entries = list({x['path']: x for x in entries}.values())
+    if sort_by_path:
+        entries.sort(key=lambda x: x['path'])
+    with open(manifest_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_HEADERS, delimiter='\t', extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(entries)
+    return len(entries)
+
+def read_manifest(manifest_file):
+    """Reads a manifest written by write_manifest.
+
+    Returns:
+        list: Manifest entries with size as int and mtime as float, original_path defaults to path
+    """
+    with open(manifest_file, 'r', newline='') as f:
+        entries = list(csv.DictReader(f, delimiter='\t'))
+    for entry in entries:
+        entry['size'] = int(entry['size'])
+        entry['mtime'] = float(entry['mtime'])
+        entry['original_path'] = entry.get('original_path') or entry['path']
+    return entries
+
+def _parse_formats(formats):
+    if not formats:
+        return None
+    supported_formats = {x.lower(): x for x in spectrum_io.SPECTRUM_FORMATS.values()}
+    parsed_formats = set()
+    for file_format in formats.split(','):
+        file_format = file_format.strip().lower()
+        if file_format not in supported_formats:
+            raise ValueError(f"Unknown format {file_format}, supported are {list(supported_formats.values())}")
+        parsed_formats.add(supported_formats[file_format])
+    return parsed_formats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Walk directories once and write a manifest of the spectrum files in them')
+    parser.add_argument('roots', nargs='+', help='Directories (or files) to discover spectrum files in')
+    parser.add_argument('manifest', help='Output manifest (TSV with path, size, mtime, format)')
+    parser.add_argument('--formats', default=None, help='Comma separated formats to keep (mzML, mzXML, mgf), all by default')
+    parser.add_argument('--min_size', default=0, type=int, help='Skip files smaller than this many bytes')
+    parser.add_argument('--max_size', default=None, type=int, help='Skip files larger than this many bytes')
+    parser.add_argument('--symlinks', default='files', choices=SYMLINK_POLICIES, help='none: skip symlinks, files: list symlinked files but do not descend into symlinked directories, all: also descend into symlinked directories')
+    parser.add_argument('--parallelism', default=DEFAULT_PARALLELISM, type=int, help='Directories listed concurrently')
+    parser.add_argument('--usi_folder', default=None, help='USI download folder that is published into the (single) root, its files are listed from here and reported under their published path')
+    args = parser.parse_args()
+
+    stats = DiscoveryStats()
+    discover_args = {'formats': _parse_formats(args.formats),
+                     'min_size': args.min_size,
+                     'max_size': args.max_size,
+                     'symlinks': args.symlinks,
+                     'parallelism': args.parallelism,
+                     'stats': stats}
+    if args.usi_folder is not None:
+        if len(args.roots) != 1:
+            parser.error("--usi_folder needs exactly one root, the spectra folder it is published into")
+        # Listed by real path, so other tasks can read the downloads wherever the folder was staged
+        entries = discover_with_downloads(args.roots[0], os.path.realpath(args.usi_folder), **discover_args)
+    else:
+        entries = discover_spectrum_files(args.roots, **discover_args)
+    number_of_files = write_manifest(entries, args.manifest)
+    print(stats)
+    print("Number of Files", number_of_files)
+
+if __name__ == "__main__":
+    main()
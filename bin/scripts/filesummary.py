@@ -2,133 +2,268 @@
 
 
 import sys
-import getopt
 import os
-import json
 import argparse
-import uuid
-from collections import defaultdict
+import concurrent.futures
+import subprocess
 
-import ming_parallel_library
 import csv
-import re
-import pandas as pd
-import glob
+import json
+import time
+
+import discover_files
+import msaccess_runner
+import perf_log
+from result_cache import ResultCache
 
-def summary_wrapper(search_param_dict):
-    summary_files(search_param_dict["spectrum_file"], search_param_dict["tempresults_folder"], search_param_dict["args"])
+# Bump whenever a change alters the summary rows, cached rows from other versions are then recomputed
+MSACCESS_SUMMARY_VERSION = "1"
 
-def summary_files(spectrum_file, tempresults_folder, args):
-    summary_filename = os.path.join(tempresults_folder, "{}.summary".format(str(uuid.uuid4())))
-    cmd = "export LC_ALL=C && {} \"{}\" -x \"run_summary delimiter=tab\" > {}".format(args.msaccess_binary, spectrum_file, summary_filename)
-    
-    print(cmd)
+OUTPUT_HEADERS = ["Filename", "Vendor", "Model", "MS1s", "MS2s"]
 
-    os.system(cmd)
+def summary_files(spectrum_file, args):
+    """Summarizes a single file with msaccess.
 
+    Returns:
+        tuple: (output rows for the file, empty if msaccess failed, timed out, or produced nothing,
+                perf record of the file if args.perf_log is set, otherwise None)
+    """
+    # Files are summarized concurrently in threads, so only the msaccess process itself is measured
+    perf_record = perf_log.begin(spectrum_file, measure_process=False) if args.perf_log is not None else None
+    perf_log.set_backend('msaccess')
+    # msaccess reads the metadata and counts the spectra in a single pass
+    perf_log.phase('spectrum_count')
     try:
+        result_list = msaccess_runner.run_msaccess(args.msaccess_binary, spectrum_file, timeout=args.timeout, perf_record=perf_record)
+    except subprocess.TimeoutExpired:
+        print("Timeout", spectrum_file)
+        if perf_record is not None:
+            perf_record.error = "Timeout"
+        return [], perf_log.end()
+    except OSError as os_error:
+        print("Error", spectrum_file, os_error)
+        if perf_record is not None:
+            perf_record.error = f"{type(os_error).__name__}: {os_error}"
+        return [], perf_log.end()
+
+    output_list = []
+    for result in result_list:
+        output_dict = {}
         # We should rewrite it such that the filenames are full relative paths
-        results_df = pd.read_csv(summary_filename, sep="\t")
-        results_df["Filename"] = spectrum_file
+        output_dict["Filename"] = spectrum_file
+        output_dict["Vendor"] = result.get("Vendor") or "Unknown"
+        output_dict["Model"] = result.get("Model") or "Unknown"
+        output_dict["MS1s"] = result.get("MS1s") or 0
+        output_dict["MS2s"] = result.get("MS2s") or 0
+        output_list.append(output_dict)
+    if perf_record is not None and len(output_list) == 0:
+        perf_record.error = "No run summary"
+    return output_list, perf_log.end()
+
+def summary_batch(spectrum_files, args):
+    """Summarizes several files with as few msaccess invocations as possible, see msaccess_runner.run_msaccess_batch.
+
+    Returns:
+        list: (spectrum file, output rows, perf record) per file, like summary_files. Each file is attributed an equal
+              share of the wall time and the peak RSS of the msaccess invocation that summarized it
+    """
+    if len(spectrum_files) == 1:
+        return [(spectrum_files[0], *summary_files(spectrum_files[0], args))]
+
+    results = []
+    for spectrum_file, result_list, error, invocation in msaccess_runner.run_msaccess_batch(args.msaccess_binary, spectrum_files,
+                                                                                             timeout=args.timeout,
+                                                                                             measure=args.perf_log is not None):
+        output_list = [{"Filename": spectrum_file,
+                        "Vendor": result.get("Vendor") or "Unknown",
+                        "Model": result.get("Model") or "Unknown",
+                        "MS1s": result.get("MS1s") or 0,
+                        "MS2s": result.get("MS2s") or 0} for result in result_list]
+        perf_record = None
+        if args.perf_log is not None:
+            seconds = invocation.seconds / invocation.number_of_files
+            perf_record = perf_log.PerfRecord(spectrum_file, measure_process=False)
+            perf_record.backend = 'msaccess_batch' if invocation.number_of_files > 1 else 'msaccess'
+            perf_record.error = error if len(output_list) == 0 else None
+            perf_record = perf_record.finish().to_dict()
+            perf_record["seconds"] = round(seconds, 6)
+            perf_record["phases"] = {"spectrum_count": round(seconds, 6)}
+            perf_record["peak_rss"] = invocation.peak_rss
+        results.append((spectrum_file, output_list, perf_record))
+    return results
+
+def missing_summary(spectrum_file):
+    output_dict = {}
+    output_dict["Filename"] = spectrum_file
+    output_dict["Vendor"] = "Unknown"
+    output_dict["Model"] = "Unknown"
+    output_dict["MS1s"] = -1
+    output_dict["MS2s"] = -1
+    return output_dict
+
+def read_journal(journal_file):
+    """Reads the files an earlier attempt of this task completed from its checkpoint journal.
+
+    A record cut off by a crash (the last line) is skipped, that file is simply summarized again. So are records
+    without the ok flag, journals written before it also held files that had failed.
+
+    Returns:
+        dict: path -> journal record with path, size, mtime, ok and rows, the last record of a path wins
+    """
+    journal = {}
+    if not os.path.exists(journal_file):
+        return journal
+    with open(journal_file, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                if record.get('ok'):
+                    journal[record['path']] = record
+            except (ValueError, KeyError):
+                print("Skipping incomplete journal record in", journal_file)
+    return journal
 
-        results_df.to_csv(summary_filename, sep="\t", index=False)
-    except:
-        pass
+def append_journal(journal_file, record):
+    """Appends a completed file to the checkpoint journal, synced to disk so it survives the task being killed."""
+    with open(journal_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def run_summaries(spectra_files, args, result_callback):
+    """Summarizes files concurrently, calling result_callback(spectrum_file, output_list, perf_record) as each one completes.
+
+    Files are passed to msaccess in batches of args.batch_size, and only a bounded number of batches are in flight at
+    once, so memory does not grow with the number of files.
+    """
+    batch_iterator = iter(msaccess_runner.make_batches(spectra_files, args.batch_size))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallelism) as executor:
+        in_flight = set()
+        while True:
+            while len(in_flight) < args.parallelism * 2:
+                batch = next(batch_iterator, None)
+                if batch is None:
+                    break
+                in_flight.add(executor.submit(summary_batch, batch, args))
+            if len(in_flight) == 0:
+                break
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                for spectrum_file, output_list, perf_record in future.result():
+                    result_callback(spectrum_file, output_list, perf_record)
 
 def main():
     parser = argparse.ArgumentParser(description='Running library search parallel')
     parser.add_argument('spectra_folder', help='spectrafolder')
     parser.add_argument('result_file', help='output folder for parameters')
     parser.add_argument('msaccess_binary', help='output folder for parameters')
-    parser.add_argument('--parallelism', default=1, type=int, help='Parallelism')
+    parser.add_argument('--parallelism', default=None, type=int, help='Number of concurrent msaccess processes, defaults to the available cores')
+    parser.add_argument('--timeout', default=msaccess_runner.DEFAULT_MSACCESS_TIMEOUT, type=int, help='Seconds before msaccess is killed per file, a batch is given this times its number of files')
+    parser.add_argument('--batch_size', default=1, type=int, help='Files passed to a single msaccess invocation, a batch that fails is split until the failing file runs on its own')
     parser.add_argument('--usi_folder', default=None, help='Folder for USI Files')
+    parser.add_argument('--manifest', default=None, help='Manifest from discover_files.py, its files are summarized instead of walking spectra_folder and usi_folder')
+    parser.add_argument('--cache_db', default=None, help='SQLite result cache, unchanged files are not summarized again')
+    parser.add_argument('--fingerprint', action='store_true', help='Also match cached files by content fingerprint')
+    parser.add_argument('--perf_log', default=None, help='Append per-file timings, file size, and msaccess peak RSS to this JSON lines file')
+    parser.add_argument('--journal', default=None, help='Checkpoint journal (JSON lines), completed files are appended to it and skipped when the task is restarted')
     args = parser.parse_args()
 
-    valid_extensions = [".mzml", ".mzxml", ".mgf"]
+    # mzML, mzXML, and MGF files, also when gzip or bzip2 compressed.
+    # The download folder is also published into the spectra folder, downloaded files are only summarized once
+    if args.manifest is not None:
+        spectra_entries = discover_files.read_manifest(args.manifest)
+    else:
+        spectra_entries = discover_files.discover_with_downloads(args.spectra_folder, args.usi_folder)
+    spectra_entries.sort(key=lambda x: x['path'])
+    spectra_files = [x['path'] for x in spectra_entries]
+    # Path each file is reported under in the Filename column
+    original_paths = {x['path']: x['original_path'] for x in spectra_entries}
 
-    spectra_files = glob.glob(os.path.join(args.spectra_folder, "**", "*"), recursive=True)
-    spectra_files = [x for x in spectra_files if os.path.splitext(x)[-1].lower() in valid_extensions]
+    print("Number of Files", len(spectra_files))
 
-    if args.usi_folder is not None:
-        usi_spectra_files = glob.glob(os.path.join(args.usi_folder, "**", "*"), recursive=True)
+    # Files completed by an earlier attempt, only while the file is unchanged
+    journaled_records = []
+    if args.journal is not None:
+        journal = read_journal(args.journal)
+        journaled_records = [journal[x['path']] for x in spectra_entries
+                             if x['path'] in journal and (journal[x['path']]['size'], journal[x['path']]['mtime']) == (x['size'], x['mtime'])]
+        journaled_files = set(x['path'] for x in journaled_records)
+        spectra_files = [x for x in spectra_files if x not in journaled_files]
+        print("Journaled Files", len(journaled_records))
+    file_stats = {x['path']: (x['size'], x['mtime']) for x in spectra_entries}
 
-        usi_spectra_files = [x for x in usi_spectra_files if os.path.splitext(x)[-1].lower() in valid_extensions]
+    if args.parallelism is None or args.parallelism < 1:
+        args.parallelism = msaccess_runner.available_cores()
 
-        # Now we should remove the spectra files that are in the USI folder
-        usi_spectra_files_set = [os.path.join(args.spectra_folder, x) for x in usi_spectra_files]
-        usi_spectra_files_set = set(usi_spectra_files_set)
-        spectra_files = [x for x in spectra_files if x not in usi_spectra_files_set]
+    # Reusing the rows of files that have not changed since the last run
+    cached_result_list = []
+    files_to_summarize = spectra_files
+    cache = None
+    if args.cache_db is not None:
+        cache = ResultCache(args.cache_db, 'msaccess', MSACCESS_SUMMARY_VERSION, use_fingerprint=args.fingerprint)
+        files_to_summarize = []
+        for spectrum_file in spectra_files:
+            cached_rows = cache.lookup_rows(spectrum_file)
+            if cached_rows is None:
+                files_to_summarize.append(spectrum_file)
+            else:
+                for cached_result in cached_rows:
+                    cached_result["Filename"] = original_paths[spectrum_file]
+                    cached_result_list.append(cached_result)
+        print("Cached Files", len(cached_result_list))
 
-        spectra_files = usi_spectra_files + spectra_files
+    print("Parallel to execute", len(files_to_summarize), "with parallelism", args.parallelism)
 
-    spectra_files.sort()
+    with open(args.result_file, "w", newline="") as result_file:
+        writer = csv.DictWriter(result_file, fieldnames=OUTPUT_HEADERS, delimiter="\t")
+        writer.writeheader()
 
-    print("Number of Files", len(spectra_files))
+        def write_result(output_dict):
+            # Fixing all the file paths to make sure they start with the spectra folder
+            if not output_dict["Filename"].startswith(args.spectra_folder):
+                output_dict["Filename"] = os.path.join(args.spectra_folder, output_dict["Filename"])
+            writer.writerow(output_dict)
 
-    tempresults_folder = "tempresults"
-    try:
-        os.mkdir(tempresults_folder)
-    except:
-        print("folder make error")
-
-    parameter_list = []
-    for spectrum_file in spectra_files:
-        param_dict = {}
-        param_dict["spectrum_file"] = spectrum_file
-        param_dict["tempresults_folder"] = tempresults_folder
-        param_dict["args"] = args
-
-        parameter_list.append(param_dict)
-
-    print("Parallel to execute", len(parameter_list))
-    ming_parallel_library.run_parallel_job(summary_wrapper, parameter_list, 10)
-
-
-    """Merging Files and adding full path"""
-    all_result_files = glob.glob(os.path.join(tempresults_folder, "*"))
-    full_result_list = []
-    for input_file in all_result_files:
-        try:
-            results_df = pd.read_csv(input_file, sep="\t")
-            result_list = results_df.to_dict(orient="records")
-            for result in result_list:
-                output_dict = {}
-                output_dict["Filename"] = result["Filename"]
-                output_dict["Vendor"] = result.get("Vendor", "Unknown")
-                output_dict["Model"] = result.get("Model", "Unknown")
-                output_dict["MS1s"] = result.get("MS1s", 0)
-                output_dict["MS2s"] = result.get("MS2s", 0)
-                full_result_list.append(output_dict)
-        except:
-            print("Error", input_file)
-
-    # Adding in missing filenames
-    summary_df = pd.DataFrame(full_result_list)
+        def write_reused_result(output_dict, backend):
+            write_result(output_dict)
+            if args.perf_log is not None:
+                perf_record = perf_log.PerfRecord(output_dict["Filename"], measure_process=False)
+                perf_record.backend = backend
+                perf_log.write_records(args.perf_log, [perf_record.finish().to_dict()])
 
-    try:
-        files_set = set(summary_df["Filename"].tolist())
-    except:
-        files_set = set()
-
-    for spectrum_file in spectra_files:
-        if spectrum_file not in files_set:
-            output_dict = {}
-            output_dict["Filename"] = spectrum_file
-            output_dict["Vendor"] = "Unknown"
-            output_dict["Model"] = "Unknown"
-            output_dict["MS1s"] = -1
-            output_dict["MS2s"] = -1
-            
-            full_result_list.append(output_dict)
-
-    # Fixing all the file paths to make sure they start with the spectra folder
-    for result in full_result_list:
-        # Checking if it starts with spectra_folder
-        if not result["Filename"].startswith(args.spectra_folder):
-            result["Filename"] = os.path.join(args.spectra_folder, result["Filename"])
-
-    summary_df = pd.DataFrame(full_result_list)
-    summary_df.to_csv(args.result_file, sep="\t", index=False)
+        for journaled_record in journaled_records:
+            for output_dict in journaled_record['rows']:
+                write_reused_result(output_dict, 'journal')
+
+        for cached_result in cached_result_list:
+            write_reused_result(cached_result, 'cache')
+
+        def handle_result(spectrum_file, output_list, perf_record):
+            write_start_time = time.perf_counter()
+            for output_dict in output_list:
+                output_dict["Filename"] = original_paths[spectrum_file]
+            # Every run of a multi-run file (e.g., a .wiff with several samples) is cached together
+            if cache is not None and len(output_list) > 0:
+                cache.store_rows(spectrum_file, output_list, 'msaccess')
+            summarized = len(output_list) > 0
+            # Files without a summary are still listed so they are not silently dropped
+            if not summarized:
+                output_list = [missing_summary(original_paths[spectrum_file])]
+            for output_dict in output_list:
+                write_result(output_dict)
+            result_file.flush()
+            # Only summarized files are journaled, a failure may be transient (e.g., a timeout on a busy node) and is retried on restart
+            if args.journal is not None and summarized:
+                size, mtime = file_stats[spectrum_file]
+                append_journal(args.journal, {'path': spectrum_file, 'size': size, 'mtime': mtime, 'ok': True, 'rows': output_list})
+
+            if perf_record is not None:
+                write_seconds = time.perf_counter() - write_start_time
+                perf_record["phases"]["write"] = round(write_seconds, 6)
+                perf_record["seconds"] = round(perf_record["seconds"] + write_seconds, 6)
+                perf_log.write_records(args.perf_log, [perf_record])
+
+        run_summaries(files_to_summarize, args, handle_result)
 
 
 
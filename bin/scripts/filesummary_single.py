@@ -1,19 +1,18 @@
 #!/usr/bin/python
 
-import os
 import argparse
 
 import pandas as pd
-import glob
 
-def summary_wrapper(search_param_dict):
-    summary_files(search_param_dict["spectrum_file"], search_param_dict["tempresults_folder"], search_param_dict["args"])
+import msaccess_runner
 
-def summary_files(spectrum_file, tempresults_folder, msaccess_binary):
-    summary_filename = os.path.join(tempresults_folder, os.path.basename(spectrum_file) + ".summary")
-    cmd = "export LC_ALL=C && {} {} -x \"run_summary delimiter=tab\" > {}".format(msaccess_binary, spectrum_file, summary_filename)
-    print(cmd)
-    os.system(cmd)
+def summary_files(spectrum_file, msaccess_binary, timeout=msaccess_runner.DEFAULT_MSACCESS_TIMEOUT):
+    """Runs msaccess run_summary on the file, without a shell and reading the table directly from its stdout."""
+    try:
+        return msaccess_runner.run_msaccess(msaccess_binary, spectrum_file, timeout=timeout)
+    except Exception as any_exception:
+        print("Error", spectrum_file, any_exception)
+        return []
 
 def main():
     parser = argparse.ArgumentParser(description='Running library search parallel')
@@ -21,35 +20,22 @@ def main():
     parser.add_argument('relative_spectrum_path', help='relative_spectrum_path')
     parser.add_argument('result_file', help='result_file')
     parser.add_argument('msaccess_binary', help='ms access binary')
+    parser.add_argument('--timeout', default=msaccess_runner.DEFAULT_MSACCESS_TIMEOUT, type=int, help='Seconds before msaccess is killed')
     args = parser.parse_args()
 
-    tempresults_folder = "tempresults"
-    try:
-        os.mkdir(tempresults_folder)
-    except:
-        print("folder make error")
-
-    summary_files(args.input_spectrum_file, tempresults_folder, args.msaccess_binary)
-
+    result_list = summary_files(args.input_spectrum_file, args.msaccess_binary, timeout=args.timeout)
 
-    """Merging Files and adding full path"""
-    all_result_files = glob.glob(os.path.join(tempresults_folder, "*"))
+    """Adding full path"""
     full_result_list = []
-    for input_file in all_result_files:
-        try:
-            results_df = pd.read_csv(input_file, sep="\t")
-            result_list = results_df.to_dict(orient="records")
-            for result in result_list:
-                output_dict = {}
-                output_dict["Filename"] = args.relative_spectrum_path
-                output_dict["Vendor"] = result.get("Vendor", "Unknown")
-                output_dict["Model"] = result.get("Model", "Unknown")
-                output_dict["MS1s"] = result.get("MS1s", 0)
-                output_dict["MS2s"] = result.get("MS2s", 0)
-
-                full_result_list.append(output_dict)
-        except:
-            print("Error", input_file)
+    for result in result_list:
+        output_dict = {}
+        output_dict["Filename"] = args.relative_spectrum_path
+        output_dict["Vendor"] = result.get("Vendor") or "Unknown"
+        output_dict["Model"] = result.get("Model") or "Unknown"
+        output_dict["MS1s"] = result.get("MS1s") or 0
+        output_dict["MS2s"] = result.get("MS2s") or 0
+
+        full_result_list.append(output_dict)
 
     if len(full_result_list) > 0:
         pd.DataFrame(full_result_list).to_csv(args.result_file, sep="\t", index=False)
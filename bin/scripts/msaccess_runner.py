@@ -0,0 +1,209 @@
+import csv
+import io
+import os
+import subprocess
+import threading
+import time
+
+import perf_log
+
+# A file that takes longer than this is considered hung and its msaccess is killed
+DEFAULT_MSACCESS_TIMEOUT = 1800
+
+def available_cores():
+    """Number of cores this process may run on, which can be less than the machine has under a scheduler."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _run_measured(command, environment, timeout):
+    """Like subprocess.run, but also returns the resource usage of the child from os.wait4.
+
+    subprocess reaps its children with waitpid, which discards their resource usage, so the child is waited on here instead.
+
+    Returns:
+        subprocess.CompletedProcess, resource.struct_rusage
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment)
+    outputs = {}
+    # Both pipes are drained while waiting, so a chatty msaccess cannot block on a full pipe
+    readers = [threading.Thread(target=lambda name, stream: outputs.__setitem__(name, stream.read()), args=(name, stream))
+               for name, stream in [("stdout", process.stdout), ("stderr", process.stderr)]]
+    for reader in readers:
+        reader.start()
+
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    poll_seconds = 0.001
+    while True:
+        pid, status, resource_usage = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            process.kill()
+            os.wait4(process.pid, 0)
+            process.returncode = -9
+            for reader in readers:
+                reader.join()
+            # Like subprocess.run, the output written before the kill is kept on the exception
+            raise subprocess.TimeoutExpired(command, timeout, output=outputs.get("stdout"), stderr=outputs.get("stderr"))
+        time.sleep(poll_seconds)
+        poll_seconds = min(poll_seconds * 2, 0.05)
+
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    for reader in readers:
+        reader.join()
+    process.stdout.close()
+    process.stderr.close()
+    return subprocess.CompletedProcess(command, process.returncode, outputs["stdout"], outputs["stderr"]), resource_usage
+
+def _run_msaccess_command(msaccess_binary, spectrum_files, timeout, measure):
+    """Runs msaccess run_summary on files without a shell.
+
+    Returns:
+        tuple: (subprocess.CompletedProcess, peak RSS of msaccess in bytes, or None if not measured)
+    """
+    environment = dict(os.environ, LC_ALL="C")
+    command = [msaccess_binary, *spectrum_files, "-x", "run_summary delimiter=tab"]
+    if not measure:
+        completed_process = subprocess.run(command,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE,
+                                           env=environment,
+                                           timeout=timeout)
+        return completed_process, None
+    completed_process, resource_usage = _run_measured(command, environment, timeout)
+    return completed_process, perf_log.child_peak_rss(resource_usage)
+
+def run_msaccess(msaccess_binary, spectrum_file, timeout=DEFAULT_MSACCESS_TIMEOUT, perf_record=None):
+    """Runs msaccess run_summary on a single file and parses its output directly from stdout.
+
+    msaccess is run without a shell, and is killed if it does not finish within timeout seconds.
+
+    Args:
+        perf_record (perf_log.PerfRecord): If given, the peak RSS of the msaccess process is recorded in it
+
+    Returns:
+        list: One dict per row of the run_summary table, empty if msaccess produced no table
+
+    Raises:
+        subprocess.TimeoutExpired: If msaccess did not finish in time
+    """
+    completed_process, peak_rss = _run_msaccess_command(msaccess_binary, [spectrum_file], timeout, perf_record is not None)
+    if perf_record is not None:
+        perf_record.peak_rss = peak_rss
+    if completed_process.returncode != 0:
+        print("msaccess failed", spectrum_file, completed_process.returncode, completed_process.stderr.decode(errors="replace").strip())
+
+    return parse_run_summary(completed_process.stdout.decode(errors="replace"))
+
+class MsaccessInvocation:
+    """One msaccess process of a batched run, shared by the files it summarized."""
+    def __init__(self, number_of_files, seconds, peak_rss):
+        self.number_of_files = number_of_files
+        self.seconds = seconds
+        self.peak_rss = peak_rss
+
+def make_batches(spectrum_files, batch_size):
+    """Splits files into batches of up to batch_size files for a single msaccess invocation each.
+
+    run_summary rows are matched back to their file by file name, so a batch never holds two files with the same name.
+    """
+    batches = []
+    batch = []
+    batch_names = set()
+    for spectrum_file in spectrum_files:
+        if len(batch) >= max(1, batch_size) or os.path.basename(spectrum_file) in batch_names:
+            batches.append(batch)
+            batch = []
+            batch_names = set()
+        batch.append(spectrum_file)
+        batch_names.add(os.path.basename(spectrum_file))
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+def split_run_summary(run_summaries, spectrum_files):
+    """Assigns the rows of a combined run_summary table to the files of the batch by their Filename column.
+
+    Returns:
+        dict: spectrum file -> its rows, files without a matching row are left out
+    """
+    files_by_name = {}
+    for spectrum_file in spectrum_files:
+        files_by_name[spectrum_file] = spectrum_file
+        files_by_name[os.path.basename(spectrum_file)] = spectrum_file
+    rows_by_file = {}
+    for run_summary in run_summaries:
+        spectrum_file = files_by_name.get(run_summary.get("Filename") or "")
+        if spectrum_file is None:
+            spectrum_file = files_by_name.get(os.path.basename(run_summary.get("Filename") or ""))
+        if spectrum_file is not None:
+            rows_by_file.setdefault(spectrum_file, []).append(run_summary)
+    return rows_by_file
+
+def run_msaccess_batch(msaccess_binary, spectrum_files, timeout=DEFAULT_MSACCESS_TIMEOUT, measure=False):
+    """Summarizes a batch of files with as few msaccess invocations as possible, yielding each file as it is done.
+
+    The whole batch is passed to one msaccess, which is given timeout seconds per file. When it exits with an error
+    the batch is split in halves that are run again, so a file that breaks msaccess ends up on its own without costing
+    the rest of the batch. When it times out, the files it wrote rows for before it was killed are done and every other
+    file is run on its own, so a hung file costs one more timeout rather than one per halving. Files that a successful
+    batch produced no rows for are retried on their own.
+
+    Yields:
+        tuple: (spectrum file, run_summary rows, error message or None, MsaccessInvocation that produced the rows)
+    """
+    pending_batches = [list(spectrum_files)]
+    while len(pending_batches) > 0:
+        batch = pending_batches.pop()
+        start_time = time.perf_counter()
+        partial_output = None
+        try:
+            completed_process, peak_rss = _run_msaccess_command(msaccess_binary, batch, timeout * len(batch) if timeout is not None else None, measure)
+            returncode = completed_process.returncode
+            error = None if returncode == 0 else f"msaccess exited with {returncode}: {completed_process.stderr.decode(errors='replace').strip()}"
+        except subprocess.TimeoutExpired as timeout_expired:
+            completed_process, peak_rss = None, None
+            error = "Timeout"
+            partial_output = timeout_expired.output
+        invocation = MsaccessInvocation(len(batch), time.perf_counter() - start_time, peak_rss)
+
+        if len(batch) == 1:
+            # A single file owns every row msaccess wrote, whatever name it gave it
+            run_summaries = parse_run_summary(completed_process.stdout.decode(errors="replace")) if completed_process is not None else []
+            if error is not None:
+                print("msaccess failed", batch[0], error)
+            elif len(run_summaries) == 0:
+                error = "No run summary"
+            yield batch[0], run_summaries, error, invocation
+            continue
+
+        if completed_process is None:
+            # Only complete lines of the table, the last one may have been cut off by the kill
+            partial_text = (partial_output or b'').decode(errors="replace")
+            rows_by_file = split_run_summary(parse_run_summary(partial_text[:partial_text.rfind('\n') + 1]), batch)
+            print("msaccess batch of", len(batch), "files timed out, running the", len(batch) - len(rows_by_file), "unfinished files on their own")
+            for spectrum_file in batch:
+                if spectrum_file in rows_by_file:
+                    yield spectrum_file, rows_by_file[spectrum_file], None, invocation
+            pending_batches.extend([x] for x in reversed(batch) if x not in rows_by_file)
+            continue
+
+        if error is not None:
+            print("msaccess batch of", len(batch), "files failed, splitting it:", error)
+            pending_batches.append(batch[len(batch) // 2:])
+            pending_batches.append(batch[:len(batch) // 2])
+            continue
+
+        rows_by_file = split_run_summary(parse_run_summary(completed_process.stdout.decode(errors="replace")), batch)
+        for spectrum_file in batch:
+            if spectrum_file in rows_by_file:
+                yield spectrum_file, rows_by_file[spectrum_file], None, invocation
+        # Pushed in reverse, so they are retried in batch order
+        pending_batches.extend([x] for x in reversed(batch) if x not in rows_by_file)
+
+def parse_run_summary(run_summary_text):
+    """Parses the tab delimited run_summary table written by msaccess."""
+    reader = csv.DictReader(io.StringIO(run_summary_text), delimiter="\t")
+    return [row for row in reader if any(row.values())]
@@ -0,0 +1,133 @@
+import argparse
+from collections import namedtuple
+import hashlib
+import json
+import os
+
+# Bump when the layout of the compiled ontology changes so stale artifacts are rebuilt
+COMPILED_ONTOLOGY_VERSION = 1
+
+INSTRUMENT_MODEL_ID = 'MS:1000031'
+INSTRUMENT_VENDOR_IDS = ['MS:1001269'] # Seems that this is not always used
+
+OntologyLookup = namedtuple('OntologyLookup', ['obo_sha256', 'model_names', 'vendor_names', 'id_to_name'])
+
+# Loaded ontologies, keyed by the absolute path they were requested with, so each process parses at most once
+_LOADED_ONTOLOGIES = {}
+
+def obo_sha256(obo_file):
+    sha256 = hashlib.sha256()
+    with open(obo_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def cache_folder():
+    """Folder for compiled ontologies, $XDG_CACHE_HOME/filesummary_workflow (~/.cache/filesummary_workflow by default).
+
+    Under Nextflow the home folder of a task is usually shared, the workflow passes a compiled ontology instead.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'filesummary_workflow')
+
+def compiled_ontology_path(obo_file, obo_hash, output_folder=None):
+    """Location of the compiled artifact for an OBO file in the cache folder, keyed by the hash of the OBO.
+
+    The artifact is never written next to the OBO, which may be the copy committed in bin/ontology.
+    """
+    output_folder = output_folder if output_folder is not None else cache_folder()
+    return os.path.join(output_folder, f"{os.path.basename(obo_file)}.{obo_hash[:16]}.compiled.json")
+
+def compile_ontology(obo_file):
+    """Parses a PSI-MS OBO file once and extracts everything process_mzML needs.
+
+    Returns:
+        dict: JSON serializable compiled ontology
+    """
+    # Only needed when compiling, loading a compiled ontology does not pay for these imports
+    import obonet
+    import networkx
+
+    graph = obonet.read_obo(str(obo_file))
+    # Get all ids
+    model_ids = networkx.ancestors(graph, INSTRUMENT_MODEL_ID)
+
+    # Convert to names
+    id_to_name = {id_: data.get('name') for id_, data in graph.nodes(data=True)}
+
+    return {'version': COMPILED_ONTOLOGY_VERSION,
+            'obo_sha256': obo_sha256(obo_file),
+            'model_names': sorted(id_to_name[x] for x in model_ids if id_to_name.get(x) is not None),
+            'vendor_names': sorted(id_to_name[x] for x in INSTRUMENT_VENDOR_IDS if id_to_name.get(x) is not None),
+            'id_to_name': id_to_name}
+
+def write_compiled_ontology(obo_file, output_file):
+    compiled = compile_ontology(obo_file)
+    # Write to a temporary name first so concurrent readers never see a partial file
+    temp_file = f"{output_file}.{os.getpid()}.tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(compiled, f)
+    os.replace(temp_file, output_file)
+    return compiled
+
+def _to_lookup(compiled):
+    return OntologyLookup(obo_sha256=compiled['obo_sha256'],
+                          model_names=frozenset(compiled['model_names']),
+                          vendor_names=frozenset(compiled['vendor_names']),
+                          id_to_name=compiled['id_to_name'])
+
+def _read_compiled(compiled_file, expected_hash=None):
+    """Reads a compiled ontology, returning None if it is unreadable, outdated, or built from another OBO."""
+    try:
+        with open(compiled_file, 'r') as f:
+            compiled = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if compiled.get('version') != COMPILED_ONTOLOGY_VERSION:
+        return None
+    if expected_hash is not None and compiled.get('obo_sha256') != expected_hash:
+        return None
+    return compiled
+
+def load_ontology(ontology_file):
+    """Lazily loads the ontology lookup for either a compiled .json artifact or a raw .obo file.
+
+    For an OBO file the compiled artifact in the cache folder (see cache_folder) is used when its hash matches,
+    otherwise the OBO is compiled and the artifact is written for the next caller (if the folder is writable).
+
+    Returns:
+        OntologyLookup: Frozensets of model and vendor names for O(1) membership, plus the id to name map
+    """
+    key = os.path.abspath(str(ontology_file))
+    if key in _LOADED_ONTOLOGIES:
+        return _LOADED_ONTOLOGIES[key]
+
+    if key.endswith('.json'):
+        compiled = _read_compiled(key)
+        if compiled is None:
+            raise ValueError(f"Invalid or outdated compiled ontology {ontology_file}")
+    else:
+        obo_hash = obo_sha256(key)
+        compiled_file = compiled_ontology_path(key, obo_hash)
+        compiled = _read_compiled(compiled_file, expected_hash=obo_hash)
+        if compiled is None:
+            try:
+                os.makedirs(os.path.dirname(compiled_file), exist_ok=True)
+                compiled = write_compiled_ontology(key, compiled_file)
+            except OSError:
+                compiled = compile_ontology(key)
+
+    _LOADED_ONTOLOGIES[key] = _to_lookup(compiled)
+    return _LOADED_ONTOLOGIES[key]
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the PSI-MS ontology into a lookup artifact for xmlsummary_single.py')
+    parser.add_argument('obo_file', help='psi-ms.obo')
+    parser.add_argument('output_file', help='Compiled ontology (JSON)')
+    args = parser.parse_args()
+
+    compiled = write_compiled_ontology(args.obo_file, args.output_file)
+    print(f"Compiled {len(compiled['model_names'])} instrument models from {args.obo_file} (sha256 {compiled['obo_sha256']})")
+
+if __name__ == "__main__":
+    main()
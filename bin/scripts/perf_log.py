@@ -0,0 +1,149 @@
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+
+import spectrum_io
+
+# Phases a file's wall time is split into, in the order they happen
+PHASES = ["open", "metadata_parse", "spectrum_count", "write"]
+
+VM_HWM_PATTERN = re.compile(r'VmHWM:\s+(\d+)\s+kB')
+RCHAR_PATTERN = re.compile(r'rchar:\s+(\d+)')
+
+# Record of the file the current thread is summarizing, so parsers can mark phases without threading it through every call
+_active = threading.local()
+
+def _read_proc_file(proc_file):
+    try:
+        with open(proc_file, 'r') as f:
+            return f.read()
+    except OSError:
+        return ''
+
+def _bytes_read():
+    """Bytes this process has read through read syscalls so far, or None where /proc/self/io is not available."""
+    match = RCHAR_PATTERN.search(_read_proc_file('/proc/self/io'))
+    return int(match.group(1)) if match is not None else None
+
+def _reset_peak_rss():
+    """Resets the peak RSS of this process on Linux, so the peak can be attributed to a single file."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _peak_rss():
+    """Peak RSS of this process in bytes, since the last reset where supported."""
+    match = VM_HWM_PATTERN.search(_read_proc_file('/proc/self/status'))
+    if match is not None:
+        return int(match.group(1)) * 1024
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def child_peak_rss(resource_usage):
+    """Peak RSS in bytes from the rusage of a child process, e.g. from os.wait4."""
+    return resource_usage.ru_maxrss if sys.platform == 'darwin' else resource_usage.ru_maxrss * 1024
+
+def _file_format(path):
+    """Lower case format of a file including its compression, e.g. mzml or mzml.gz."""
+    uncompressed_path, compression = spectrum_io.split_compression(path)
+    return os.path.splitext(uncompressed_path)[1].lstrip('.').lower() + (compression or '')
+
+class PerfRecord:
+    """Wall time per phase, bytes read, file size and peak RSS of summarizing a single file.
+
+    Args:
+        path (str): File being summarized
+        original_path (str): Path the file is reported under, defaults to path
+        measure_process (bool): Attribute this process' bytes read and peak RSS to the file. Only meaningful when the
+            process summarizes one file at a time, backends running in a child process set these from the child instead
+    """
+    def __init__(self, path, original_path=None, measure_process=True):
+        self.path = path
+        self.original_path = original_path if original_path is not None else path
+        self.measure_process = measure_process
+        self.backend = None
+        self.error = None
+        self.bytes_read = None
+        self.peak_rss = None
+        self.seconds = None
+        self.phases = {}
+        try:
+            self.file_size = os.path.getsize(path)
+        except OSError:
+            self.file_size = None
+
+        if measure_process:
+            _reset_peak_rss()
+            self._bytes_read_start = _bytes_read()
+        self._start_time = time.perf_counter()
+        self._phase = None
+        self._phase_start_time = None
+        self.start_phase('open')
+
+    def start_phase(self, phase):
+        """Ends the current phase and starts the next one. Phases may repeat, e.g. a second parse after an index fallback."""
+        now = time.perf_counter()
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0.0) + (now - self._phase_start_time)
+        self._phase = phase
+        self._phase_start_time = now
+
+    def finish(self):
+        self.start_phase(None)
+        self.seconds = time.perf_counter() - self._start_time
+        if self.measure_process:
+            bytes_read_end = _bytes_read()
+            if bytes_read_end is not None and self._bytes_read_start is not None:
+                self.bytes_read = bytes_read_end - self._bytes_read_start
+            self.peak_rss = _peak_rss()
+        return self
+
+    def to_dict(self):
+        return {'path': self.path,
+                'original_path': self.original_path,
+                'format': _file_format(self.path),
+                'backend': self.backend,
+                'file_size': self.file_size,
+                'bytes_read': self.bytes_read,
+                'peak_rss': self.peak_rss,
+                'seconds': round(self.seconds, 6) if self.seconds is not None else None,
+                'phases': {phase: round(self.phases[phase], 6) for phase in PHASES if phase in self.phases},
+                'error': self.error}
+
+def begin(path, original_path=None, measure_process=True):
+    """Starts recording a file and makes it the active record of this thread."""
+    _active.record = PerfRecord(path, original_path=original_path, measure_process=measure_process)
+    return _active.record
+
+def end():
+    """Finishes the active record of this thread, returning it as a dict (None if nothing was being recorded)."""
+    record = getattr(_active, 'record', None)
+    _active.record = None
+    if record is None:
+        return None
+    return record.finish().to_dict()
+
+def phase(phase_name):
+    """Marks the start of a phase of the active record, a no-op when instrumentation is off."""
+    record = getattr(_active, 'record', None)
+    if record is not None:
+        record.start_phase(phase_name)
+
+def set_backend(backend):
+    record = getattr(_active, 'record', None)
+    if record is not None:
+        record.backend = backend
+
+def write_records(perf_log_file, records):
+    """Appends records as JSON lines."""
+    with open(perf_log_file, 'a') as f:
+        for record in records:
+            if record is not None:
+                f.write(json.dumps(record) + '\n')
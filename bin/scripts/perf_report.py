@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+import argparse
+import glob
+import json
+import os
+import statistics
+
+import perf_log
+
+# A file is a memory outlier when its peak RSS is this many times the median of its backend
+DEFAULT_RSS_OUTLIER_FACTOR = 3.0
+
+def read_perf_records(perf_files):
+    """Reads every record from JSON lines perf logs, skipping lines that are not valid JSON (e.g., a task killed mid-write)."""
+    records = []
+    for perf_file in perf_files:
+        with open(perf_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line == '':
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print("Skipping invalid perf record in", perf_file)
+    return records
+
+def _percentile(sorted_values, fraction):
+    """Nearest rank percentile of already sorted values."""
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize_group(records):
+    """Throughput, phase totals and memory of a group of records."""
+    total_seconds = sum(x.get('seconds') or 0.0 for x in records)
+    total_bytes = sum(x.get('file_size') or 0 for x in records)
+    peak_rss_values = sorted(x['peak_rss'] for x in records if x.get('peak_rss') is not None)
+    seconds_values = sorted(x.get('seconds') or 0.0 for x in records)
+
+    phase_seconds = {}
+    for record in records:
+        for phase, seconds in (record.get('phases') or {}).items():
+            phase_seconds[phase] = phase_seconds.get(phase, 0.0) + seconds
+
+    return {'files': len(records),
+            'errors': sum(1 for x in records if x.get('error')),
+            'seconds': round(total_seconds, 3),
+            'bytes': total_bytes,
+            'bytes_read': sum(x.get('bytes_read') or 0 for x in records),
+            'files_per_second': round(len(records) / total_seconds, 3) if total_seconds > 0 else None,
+            'mb_per_second': round(total_bytes / total_seconds / 1e6, 3) if total_seconds > 0 else None,
+            'seconds_p50': _percentile(seconds_values, 0.5),
+            'seconds_p95': _percentile(seconds_values, 0.95),
+            'peak_rss_p50': _percentile(peak_rss_values, 0.5),
+            'peak_rss_p95': _percentile(peak_rss_values, 0.95),
+            'peak_rss_max': peak_rss_values[-1] if len(peak_rss_values) > 0 else None,
+            'phase_seconds': {phase: round(phase_seconds[phase], 3) for phase in perf_log.PHASES if phase in phase_seconds}}
+
+def _group_by(records, key):
+    groups = {}
+    for record in records:
+        groups.setdefault(record.get(key) or 'unknown', []).append(record)
+    return groups
+
+def memory_outliers(records, factor=DEFAULT_RSS_OUTLIER_FACTOR):
+    """Files whose peak RSS is more than factor times the median peak RSS of their backend, largest first."""
+    outliers = []
+    for backend, backend_records in _group_by(records, 'backend').items():
+        peak_rss_values = [x['peak_rss'] for x in backend_records if x.get('peak_rss') is not None]
+        if len(peak_rss_values) == 0:
+            continue
+        median_peak_rss = statistics.median(peak_rss_values)
+        for record in backend_records:
+            if record.get('peak_rss') is not None and record['peak_rss'] > factor * median_peak_rss:
+                outliers.append(dict(record, backend_median_peak_rss=median_peak_rss))
+    outliers.sort(key=lambda x: x['peak_rss'], reverse=True)
+    return outliers
+
+def build_report(records, top=20, rss_outlier_factor=DEFAULT_RSS_OUTLIER_FACTOR):
+    # Reused rows say nothing about summarizer performance, but are counted
+    summarized_records = [x for x in records if x.get('backend') not in ('cache', 'fingerprint', 'journal')]
+
+    return {'files': len(records),
+            'reused_files': len(records) - len(summarized_records),
+            'overall': summarize_group(summarized_records),
+            'by_format': {key: summarize_group(value) for key, value in sorted(_group_by(summarized_records, 'format').items())},
+            'by_backend': {key: summarize_group(value) for key, value in sorted(_group_by(summarized_records, 'backend').items())},
+            'slowest_files': sorted(summarized_records, key=lambda x: x.get('seconds') or 0.0, reverse=True)[:top],
+            'largest_peak_rss': sorted([x for x in summarized_records if x.get('peak_rss') is not None],
+                                       key=lambda x: x['peak_rss'], reverse=True)[:top],
+            'memory_outliers': memory_outliers(summarized_records, rss_outlier_factor)[:top]}
+
+def _megabytes(value):
+    return '' if value is None else f"{value / 1e6:.1f}"
+
+def print_report(report):
+    print("Files", report['files'], "reused", report['reused_files'])
+    print("\t".join(["Group", "Files", "Errors", "Files/s", "MB/s", "Seconds_p95", "Peak_RSS_MB_p95", "Peak_RSS_MB_max", "Phase_seconds"]))
+    for group_name in ['by_format', 'by_backend']:
+        for key, group in report[group_name].items():
+            print("\t".join(str(x) for x in [f"{group_name[3:]}={key}", group['files'], group['errors'], group['files_per_second'],
+                                              group['mb_per_second'], group['seconds_p95'], _megabytes(group['peak_rss_p95']),
+                                              _megabytes(group['peak_rss_max']), json.dumps(group['phase_seconds'])]))
+    print("Slowest files")
+    for record in report['slowest_files']:
+        print("\t".join(str(x) for x in [record.get('seconds'), record.get('backend'), _megabytes(record.get('file_size')), record.get('original_path')]))
+    print("Memory outliers")
+    for record in report['memory_outliers']:
+        print("\t".join(str(x) for x in [_megabytes(record.get('peak_rss')), record.get('backend'), _megabytes(record.get('file_size')), record.get('original_path')]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate per-file perf logs into a report of slow files, throughput, and memory')
+    parser.add_argument('input_folder', help='Folder of perf JSON lines files (*.jsonl), or a single perf log')
+    parser.add_argument('output_report', help='Report (JSON)')
+    parser.add_argument('--top', default=20, type=int, help='Number of files listed as slowest and as memory outliers')
+    parser.add_argument('--rss_outlier_factor', default=DEFAULT_RSS_OUTLIER_FACTOR, type=float, help='Peak RSS over this many times the median of the backend is an outlier')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input_folder):
+        perf_files = sorted(glob.glob(os.path.join(args.input_folder, "*.jsonl")))
+    else:
+        perf_files = [args.input_folder]
+
+    records = read_perf_records(perf_files)
+    report = build_report(records, top=args.top, rss_outlier_factor=args.rss_outlier_factor)
+
+    with open(args.output_report, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    print_report(report)
+
+if __name__ == "__main__":
+    main()
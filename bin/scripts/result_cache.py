@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+# Bytes hashed from the start and end of a file for its content fingerprint
+FINGERPRINT_BLOCK_BYTES = 1 << 20
+
+# Concurrent tasks may share the cache, wait for their writes instead of failing
+CACHE_TIMEOUT_SECONDS = 300
+
+# Bump when the layout of the summaries table changes, an older cache is dropped and refilled
+CACHE_SCHEMA_VERSION = 2
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS summaries (
+    path TEXT NOT NULL,
+    summarizer TEXT NOT NULL,
+    version TEXT NOT NULL,
+    ontology_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    fingerprint TEXT,
+    backend TEXT,
+    rows TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (path, summarizer, version)
+);
+CREATE INDEX IF NOT EXISTS summaries_fingerprint ON summaries (fingerprint, summarizer, version);
+"""
+
+def file_fingerprint(path):
+    """Content fingerprint of a file: sha256 over its size and its first and last FINGERPRINT_BLOCK_BYTES.
+
+    This is cheap regardless of file size and, combined with the size, identifies copies of the same
+    raw file in different datasets.
+    """
+    size = os.path.getsize(path)
+    sha256 = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        sha256.update(f.read(FINGERPRINT_BLOCK_BYTES))
+        if size > FINGERPRINT_BLOCK_BYTES:
+            f.seek(max(FINGERPRINT_BLOCK_BYTES, size - FINGERPRINT_BLOCK_BYTES))
+            sha256.update(f.read(FINGERPRINT_BLOCK_BYTES))
+    return sha256.hexdigest()
+
+class ResultCache:
+    """Persistent SQLite cache of per-file summary rows.
+
+    Rows are keyed by (path, summarizer, version), so runs with different versions or modes (e.g., metadata only or
+    other extra metrics) keep their own rows side by side. Rows are only returned while the file's size and mtime are
+    unchanged and the ontology hash matches the one they were produced with. A file may have several rows
+    (e.g., a .wiff with several samples), they are stored and returned together.
+
+    Args:
+        cache_db (str): Path to the SQLite database, created if it does not exist
+        summarizer (str): Which summarizer the rows belong to, e.g. xmlsummary or msaccess
+        version (str): Parser version and mode, rows from any other version are not returned
+        ontology_hash (str): Hash of the ontology the rows were resolved with, if any
+        use_fingerprint (bool): Also match files by content fingerprint, so identical files under different paths are summarized once
+    """
+    def __init__(self, cache_db, summarizer, version, ontology_hash='', use_fingerprint=False):
+        self.summarizer = summarizer
+        self.version = str(version)
+        self.ontology_hash = ontology_hash or ''
+        self.use_fingerprint = use_fingerprint
+        self._fingerprints = {}
+
+        self.connection = sqlite3.connect(cache_db, timeout=CACHE_TIMEOUT_SECONDS)
+        with self.connection:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] < CACHE_SCHEMA_VERSION:
+                # Caches of an older layout are only dropped, never migrated
+                self.connection.execute("DROP TABLE IF EXISTS summaries")
+                self.connection.execute(f"PRAGMA user_version = {CACHE_SCHEMA_VERSION}")
+        self.connection.executescript(CACHE_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def fingerprint(self, stat_path):
+        if stat_path not in self._fingerprints:
+            self._fingerprints[stat_path] = file_fingerprint(stat_path)
+        return self._fingerprints[stat_path]
+
+    def lookup_rows(self, path, stat_path=None):
+        """Returns the cached rows of a file, or None if they are missing or stale.
+
+        Args:
+            path (str): Key of the file, normally its original path
+            stat_path (str): Where the file can be read now (e.g., a staged symlink), defaults to path
+        """
+        stat_path = stat_path if stat_path is not None else path
+        try:
+            file_stat = os.stat(stat_path)
+        except OSError:
+            return None
+
+        result = self.connection.execute("SELECT rows FROM summaries WHERE path = ? AND summarizer = ? AND version = ? "
+                                         "AND ontology_hash = ? AND size = ? AND mtime_ns = ?",
+                                         (path, self.summarizer, self.version, self.ontology_hash,
+                                          file_stat.st_size, file_stat.st_mtime_ns)).fetchone()
+        if result is not None:
+            return json.loads(result[0])
+
+        if self.use_fingerprint:
+            result = self.connection.execute("SELECT rows FROM summaries WHERE fingerprint = ? AND summarizer = ? AND version = ? "
+                                             "AND ontology_hash = ? AND size = ? LIMIT 1",
+                                             (self.fingerprint(stat_path), self.summarizer, self.version, self.ontology_hash,
+                                              file_stat.st_size)).fetchone()
+            if result is not None:
+                return json.loads(result[0])
+        return None
+
+    def lookup(self, path, stat_path=None):
+        """Returns the cached row of a file that has a single row, or None if it is missing or stale."""
+        rows = self.lookup_rows(path, stat_path)
+        return rows[0] if rows else None
+
+    def store_rows(self, path, rows, backend, stat_path=None):
+        """Stores all summary rows of a file, replacing whatever this version cached for it."""
+        stat_path = stat_path if stat_path is not None else path
+        try:
+            file_stat = os.stat(stat_path)
+        except OSError:
+            return
+        fingerprint = self.fingerprint(stat_path) if self.use_fingerprint else None
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (path, self.summarizer, self.version, self.ontology_hash,
+                                     file_stat.st_size, file_stat.st_mtime_ns, fingerprint, backend,
+                                     json.dumps(list(rows)), time.time()))
+
+    def store(self, path, row, backend, stat_path=None):
+        """Stores the single summary row of a file."""
+        self.store_rows(path, [row], backend, stat_path=stat_path)
@@ -0,0 +1,331 @@
+#!/usr/bin/python
+
+import argparse
+import ast
+import csv
+import os
+import sqlite3
+import time
+
+import tsv_merger
+
+# Model name -> instrument class (qtof, orbitrap, ...), an empty class is unknown
+INSTRUMENT_MAPPING_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instrument_mapping_dict.txt")
+
+# Concurrent runs may share the rollup database, wait for their writes instead of failing
+ROLLUP_TIMEOUT_SECONDS = 300
+
+# Value of a grouping column that could not be determined
+UNKNOWN = "Unknown"
+
+# Rows whose stored files are looked up in one query, below SQLite's limit of 999 parameters per statement
+ROWS_PER_LOOKUP = 500
+
+############## Normalization ##################
+# Lowercase substrings of vendor names (mzXML msManufacturer, msaccess, PSI-MS vendor model terms) -> normalized vendor
+VENDOR_ALIASES = [
+    ("thermo", "Thermo Fisher Scientific"),
+    ("finnigan", "Thermo Fisher Scientific"),
+    ("bruker", "Bruker"),
+    ("waters", "Waters"),
+    ("micromass", "Waters"),
+    ("agilent", "Agilent"),
+    ("sciex", "SCIEX"),
+    ("applied biosystems", "SCIEX"),
+    ("shimadzu", "Shimadzu"),
+]
+# Lowercase substrings of model names -> vendor, for rows that carry a model but no vendor (the usual case for mzML)
+MODEL_VENDOR_ALIASES = [
+    ("exactive", "Thermo Fisher Scientific"),
+    ("orbitrap", "Thermo Fisher Scientific"),
+    ("ltq", "Thermo Fisher Scientific"),
+    ("lcq", "Thermo Fisher Scientific"),
+    ("tsq", "Thermo Fisher Scientific"),
+    ("velos", "Thermo Fisher Scientific"),
+    ("maxis", "Bruker"),
+    ("impact", "Bruker"),
+    ("microtof", "Bruker"),
+    ("esquire", "Bruker"),
+    ("timstof", "Bruker"),
+    ("solarix", "Bruker"),
+    ("qtrap", "SCIEX"),
+    ("tripletof", "SCIEX"),
+    ("it-tof", "Shimadzu"),
+    ("xevo", "Waters"),
+    ("synapt", "Waters"),
+]
+
+############## Rollups ##################
+# Columns every file is grouped by, derived from its merged_results.tsv row
+FILE_COLUMNS = ["Dataset", "Vendor", "Model", "Instrument_Class", "Mass_Analyzer", "Month"]
+# Summed per group, merged_results.tsv column -> rollup column. Every file also counts once in Files
+MEASURE_COLUMNS = {"MS1s": "MS1s", "MS2s": "MS2s", "MS3+": "MS3_Plus"}
+# Rollup table name -> the columns it is grouped by. Month is the month a file first entered the rollups
+ROLLUPS = {
+    "dataset": ["Dataset"],
+    "vendor": ["Vendor"],
+    "model": ["Vendor", "Model", "Instrument_Class"],
+    "mass_analyzer": ["Vendor", "Model", "Mass_Analyzer"],
+    "instrument_class": ["Instrument_Class"],
+    "dataset_instrument_class": ["Dataset", "Instrument_Class"],
+    "month": ["Month"],
+    "month_instrument_class": ["Month", "Instrument_Class"],
+}
+TOTAL_COLUMNS = ["Files"] + list(MEASURE_COLUMNS.values())
+
+
+def load_instrument_mapping(mapping_file=INSTRUMENT_MAPPING_FILE):
+    """Reads the model -> instrument class dict literal, keyed by lowercase model name."""
+    with open(mapping_file) as f:
+        mapping = ast.literal_eval(f.read())
+    return {model.lower(): instrument_class for model, instrument_class in mapping.items()}
+
+def _unique_parts(value):
+    """Distinct non-empty values of a field that joins one value per instrument configuration with '|'."""
+    parts = {}
+    for part in (value or '').split('|'):
+        part = part.strip()
+        if part != '' and part.lower() != 'unknown':
+            parts.setdefault(part, None)
+    return list(parts)
+
+def _alias(name, aliases):
+    lower_name = name.lower()
+    for substring, normalized in aliases:
+        if substring.lower() in lower_name:
+            return normalized
+    return None
+
+def normalize_vendor(vendor, model):
+    """Single spelling per vendor, taken from the model name when the vendor is missing."""
+    vendors = {}
+    for part in _unique_parts(vendor):
+        vendors.setdefault(_alias(part, VENDOR_ALIASES) or part, None)
+    if len(vendors) == 0:
+        for part in _unique_parts(model):
+            normalized = _alias(part, VENDOR_ALIASES) or _alias(part, MODEL_VENDOR_ALIASES)
+            if normalized is not None:
+                vendors.setdefault(normalized, None)
+    return '|'.join(vendors) or UNKNOWN
+
+def instrument_class(model, instrument_mapping):
+    classes = {}
+    for part in _unique_parts(model):
+        mapped_class = instrument_mapping.get(part.lower())
+        if mapped_class:
+            classes.setdefault(mapped_class, None)
+    return '|'.join(classes) or UNKNOWN
+
+def _parse_count(value):
+    """Integer count of a merged_results.tsv cell, None when it is empty or not a number."""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def _count(value):
+    count = _parse_count(value)
+    return count if count is not None else 0
+
+def has_counts(row):
+    """Whether a row carries MS level counts. Rows of --metadata_only runs leave them empty, and files msaccess could not
+    summarize are listed with -1, counting either as 0 would replace the stored counts of the file."""
+    counts = [_parse_count(row.get(column)) for column in MEASURE_COLUMNS]
+    return any(count is not None and count >= 0 for count in counts)
+
+def instrument_columns(vendor, model, mass_analyzer, instrument_mapping):
+    """Normalized Vendor, Model, Instrument_Class and Mass_Analyzer of a row."""
+    return (normalize_vendor(vendor, model),
+            '|'.join(_unique_parts(model)) or UNKNOWN,
+            instrument_class(model, instrument_mapping),
+            '|'.join(_unique_parts(mass_analyzer)) or UNKNOWN)
+
+def file_contribution(row, instrument_mapping, month, dataset_root=None, instrument_cache=None):
+    """Grouping columns and measures of a single merged_results.tsv row, in FILE_COLUMNS then TOTAL_COLUMNS order.
+
+    Args:
+        instrument_cache (dict): Normalized instrument columns by their raw values, a corpus only has a few hundred instruments
+    """
+    path = next((row.get(column) for column in tsv_merger.PATH_COLUMNS if row.get(column)), None)
+    raw_instrument = (row.get("Vendor"), row.get("Model"), row.get("Mass_Analyzer"))
+    instrument = instrument_cache.get(raw_instrument) if instrument_cache is not None else None
+    if instrument is None:
+        instrument = instrument_columns(*raw_instrument, instrument_mapping)
+        if instrument_cache is not None:
+            instrument_cache[raw_instrument] = instrument
+    return (tsv_merger.dataset_of_path(path, dataset_root) or UNKNOWN,
+            *instrument,
+            month,
+            1,
+            *[_count(row.get(column)) for column in MEASURE_COLUMNS])
+
+def _schema():
+    statements = ["CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, {}, {}, updated REAL NOT NULL);".format(
+                      ', '.join(f"{column} TEXT NOT NULL" for column in FILE_COLUMNS),
+                      ', '.join(f"{column} INTEGER NOT NULL" for column in TOTAL_COLUMNS))]
+    for name, columns in ROLLUPS.items():
+        statements.append("CREATE TABLE IF NOT EXISTS rollup_{} ({}, {}, PRIMARY KEY ({}));".format(
+            name,
+            ', '.join(f"{column} TEXT NOT NULL" for column in columns),
+            ', '.join(f"{column} INTEGER NOT NULL" for column in TOTAL_COLUMNS),
+            ', '.join(columns)))
+    return '\n'.join(statements)
+
+class RollupStore:
+    """Persistent SQLite rollups of the merged summaries, updated incrementally.
+
+    The contribution of every file (its grouping columns and counts) is kept in the files table. A row is compared with
+    the stored contribution of its file, and only new or changed files add their difference to the rollup tables, so
+    a run that re-merges cached rows touches no rollup. Files are never removed, like the rows of the result cache.
+    Rows without counts (see has_counts) are skipped, they leave the stored contribution of their file as it is.
+
+    Rows are compared in chunks of ROWS_PER_LOOKUP, with one query for the stored files of a chunk and one statement
+    for its new and changed files, so an update costs in proportion to its own rows.
+
+    Args:
+        rollup_db (str): Path to the SQLite database, created if it does not exist
+        dataset_root (str): Directory that datasets are top-level folders of, as for the Parquet Dataset partition
+        month (str): Month new files are counted in (YYYY-MM), defaults to the current month
+    """
+    def __init__(self, rollup_db, dataset_root=None, month=None, mapping_file=INSTRUMENT_MAPPING_FILE):
+        self.dataset_root = dataset_root
+        self.month = month if month is not None else time.strftime("%Y-%m")
+        self.instrument_mapping = load_instrument_mapping(mapping_file)
+        self._instrument_cache = {}
+        self.new_files = 0
+        self.changed_files = 0
+        self.unchanged_files = 0
+        self.skipped_files = 0
+        # Rollup name -> group key -> summed differences, applied to the tables by commit
+        self._deltas = {name: {} for name in ROLLUPS}
+        # (path, row) recorded by add_row and not yet compared with the stored files
+        self._pending_rows = []
+
+        self.connection = sqlite3.connect(rollup_db, timeout=ROLLUP_TIMEOUT_SECONDS)
+        self.connection.executescript(_schema())
+        self._select_files = "SELECT path, {} FROM files WHERE path IN ({{}})".format(', '.join(FILE_COLUMNS + TOTAL_COLUMNS))
+        self._replace_file = f"INSERT OR REPLACE INTO files VALUES ({', '.join('?' * (len(FILE_COLUMNS) + len(TOTAL_COLUMNS) + 2))})"
+
+    def close(self):
+        self.connection.close()
+
+    def clear(self):
+        """Forgets every file, e.g., to rebuild the rollups after the instrument mapping changed."""
+        with self.connection:
+            self.connection.execute("DELETE FROM files")
+            for name in ROLLUPS:
+                self.connection.execute(f"DELETE FROM rollup_{name}")
+
+    def _add_delta(self, contribution, sign):
+        file_values = dict(zip(FILE_COLUMNS, contribution))
+        totals = [sign * x for x in contribution[len(FILE_COLUMNS):]]
+        for name, columns in ROLLUPS.items():
+            key = tuple(file_values[column] for column in columns)
+            delta = self._deltas[name].setdefault(key, [0] * len(TOTAL_COLUMNS))
+            for i, total in enumerate(totals):
+                delta[i] += total
+
+    def add_row(self, row):
+        """Records a merged_results.tsv row, a file seen before only counts its difference to its stored row."""
+        path = next((row.get(column) for column in tsv_merger.PATH_COLUMNS if row.get(column)), None)
+        if path is None:
+            return
+        if not has_counts(row):
+            self.skipped_files += 1
+            return
+        self._pending_rows.append((path, row))
+        if len(self._pending_rows) >= ROWS_PER_LOOKUP:
+            self._compare_pending_rows()
+
+    def _compare_pending_rows(self):
+        """Compares the pending rows with the stored contributions of their files, looked up in a single query."""
+        if len(self._pending_rows) == 0:
+            return
+        paths = list({path: None for path, _ in self._pending_rows})
+        stored = {values[0]: tuple(values[1:])
+                  for values in self.connection.execute(self._select_files.format(', '.join('?' * len(paths))), paths)}
+
+        replaced_files = {}
+        for path, row in self._pending_rows:
+            # A file listed twice in the chunk is compared with the contribution of its earlier row
+            previous = stored.get(path)
+            # A file stays in the month it was first counted in
+            month = previous[FILE_COLUMNS.index("Month")] if previous is not None else self.month
+            contribution = file_contribution(row, self.instrument_mapping, month, self.dataset_root, self._instrument_cache)
+            if previous == contribution:
+                self.unchanged_files += 1
+                continue
+
+            if previous is not None:
+                self._add_delta(previous, -1)
+                self.changed_files += 1
+            else:
+                self.new_files += 1
+            self._add_delta(contribution, 1)
+            stored[path] = contribution
+            replaced_files[path] = (path, *contribution, time.time())
+        self.connection.executemany(self._replace_file, replaced_files.values())
+        self._pending_rows = []
+
+    def commit(self):
+        """Applies the differences of the recorded rows to the rollup tables, in the same transaction as the files."""
+        self._compare_pending_rows()
+        with self.connection:
+            for name, columns in ROLLUPS.items():
+                key_condition = ' AND '.join(f"{column} = ?" for column in columns)
+                update = "UPDATE rollup_{} SET {} WHERE {}".format(
+                    name, ', '.join(f"{column} = {column} + ?" for column in TOTAL_COLUMNS), key_condition)
+                insert = f"INSERT INTO rollup_{name} VALUES ({', '.join('?' * (len(columns) + len(TOTAL_COLUMNS)))})"
+                for key, delta in self._deltas[name].items():
+                    if not any(delta):
+                        continue
+                    if self.connection.execute(update, (*delta, *key)).rowcount == 0:
+                        self.connection.execute(insert, (*key, *delta))
+                # Groups whose files all moved to other groups
+                self.connection.execute(f"DELETE FROM rollup_{name} WHERE Files <= 0")
+        self._deltas = {name: {} for name in ROLLUPS}
+        print("Rollup files new", self.new_files, "changed", self.changed_files, "unchanged", self.unchanged_files,
+              "skipped without counts", self.skipped_files)
+
+    def rollup(self, name):
+        """Rows of a rollup table as dicts, the largest groups first."""
+        columns = ROLLUPS[name] + TOTAL_COLUMNS
+        query = f"SELECT {', '.join(columns)} FROM rollup_{name} ORDER BY Files DESC, {', '.join(ROLLUPS[name])}"
+        return [dict(zip(columns, values)) for values in self.connection.execute(query)]
+
+    def write_tables(self, output_folder):
+        """Writes every rollup table to <output_folder>/<name>.tsv."""
+        os.makedirs(output_folder, exist_ok=True)
+        for name in ROLLUPS:
+            with open(os.path.join(output_folder, f"{name}.tsv"), 'w', newline='') as output_file:
+                writer = csv.DictWriter(output_file, fieldnames=ROLLUPS[name] + TOTAL_COLUMNS, delimiter='\t', lineterminator='\n')
+                writer.writeheader()
+                writer.writerows(self.rollup(name))
+
+    def update(self, rows):
+        """Records all rows and commits them."""
+        for row in rows:
+            self.add_row(row)
+        self.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update the rollups of merged summaries with the rows of a merged_results.tsv')
+    parser.add_argument('merged_results', help='merged_results.tsv')
+    parser.add_argument('rollup_db', help='SQLite rollup database, created if it does not exist')
+    parser.add_argument('--output_folder', default=None, help='Folder to write every rollup table to as <name>.tsv')
+    parser.add_argument('--dataset_root', default=None, help='Directory that datasets are top-level folders of')
+    parser.add_argument('--month', default=None, help='Month new files are counted in (YYYY-MM), defaults to the current month')
+    parser.add_argument('--rebuild', action='store_true', help='Forget every file first, e.g., after instrument_mapping_dict.txt changed')
+    args = parser.parse_args()
+
+    store = RollupStore(args.rollup_db, dataset_root=args.dataset_root, month=args.month)
+    if args.rebuild:
+        store.clear()
+    store.update(tsv_merger.iter_rows([args.merged_results]))
+    if args.output_folder is not None:
+        store.write_tables(args.output_folder)
+    store.close()
+
+if __name__ == "__main__":
+    main()
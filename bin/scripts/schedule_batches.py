@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+import argparse
+import csv
+import math
+import os
+
+import discover_files
+
+# Batches are filled up to this many bytes or files, a larger file is a batch of its own
+DEFAULT_BATCH_BYTES = 2 * 1000 ** 3
+DEFAULT_BATCH_FILES = 200
+DEFAULT_BATCH_CPUS = 4
+
+# Memory estimate of a task: the interpreter and ontology, plus per worker a fixed amount and an amount per GB of the
+# largest file in the batch (the xml parsers are flat in file size, the msaccess fallback is not)
+MEMORY_BASE_MB = 512
+MEMORY_PER_WORKER_MB = 256
+MEMORY_PER_FILE_GB_MB = 256
+MEMORY_ROUND_MB = 256
+
+BATCH_INDEX_HEADERS = ["batch", "files", "bytes", "cpus", "memory_mb"]
+
+def batch_cpus(batch, max_cpus=DEFAULT_BATCH_CPUS):
+    """Files of a batch are summarized by parallel workers, a batch never needs more workers than files."""
+    return max(1, min(max_cpus, len(batch)))
+
+def _batch_duration(batch, max_cpus):
+    """Relative run time of a batch: its bytes spread over its workers, but never shorter than its largest file."""
+    return max(max(x['size'] for x in batch), sum(x['size'] for x in batch) / batch_cpus(batch, max_cpus))
+
+def pack_batches(entries, batch_bytes=DEFAULT_BATCH_BYTES, batch_files=DEFAULT_BATCH_FILES, max_cpus=DEFAULT_BATCH_CPUS):
+    """Packs manifest entries into batches, largest files first.
+
+    Files are taken in decreasing size and added to the current batch until it would exceed batch_bytes or
+    batch_files, so large files end up alone and small files share batches. batch_bytes None only limits the files.
+
+    Returns:
+        list: Batches (lists of manifest entries, largest file first), longest running first
+    """
+    batches = []
+    batch = []
+    batch_size = 0
+    for entry in sorted(entries, key=lambda x: (-x['size'], x['path'])):
+        if len(batch) > 0 and ((batch_bytes is not None and batch_size + entry['size'] > batch_bytes) or len(batch) >= batch_files):
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(entry)
+        batch_size += entry['size']
+    if len(batch) > 0:
+        batches.append(batch)
+    # Starting the longest batches first keeps them from becoming the tail of the run
+    batches.sort(key=lambda x: -_batch_duration(x, max_cpus))
+    return batches
+
+def estimate_memory_mb(batch, cpus, metadata_only=False):
+    # Reading only the header takes the same memory whatever the size of the file
+    largest_file_gb = max(entry['size'] for entry in batch) / 1e9 if not metadata_only else 0
+    memory_mb = MEMORY_BASE_MB + cpus * (MEMORY_PER_WORKER_MB + MEMORY_PER_FILE_GB_MB * largest_file_gb)
+    return int(math.ceil(memory_mb / MEMORY_ROUND_MB) * MEMORY_ROUND_MB)
+
+def write_batches(batches, output_folder, index_file, max_cpus=DEFAULT_BATCH_CPUS, metadata_only=False):
+    """Writes each batch as a manifest and an index of the batches in dispatch order with their resource requests.
+
+    Batch manifests keep the largest file first, so the workers of a batch also start on the longest files. The index
+    names batches by their file name in output_folder, so the batches can be staged anywhere along with the index.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    with open(index_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=BATCH_INDEX_HEADERS, delimiter='\t')
+        writer.writeheader()
+        for batch_index, batch in enumerate(batches):
+            batch_name = f"batch_{batch_index:05d}.tsv"
+            discover_files.write_manifest(batch, os.path.join(output_folder, batch_name), sort_by_path=False)
+            cpus = batch_cpus(batch, max_cpus)
+            writer.writerow({'batch': batch_name,
+                             'files': len(batch),
+                             'bytes': sum(x['size'] for x in batch),
+                             'cpus': cpus,
+                             'memory_mb': estimate_memory_mb(batch, cpus, metadata_only)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack a file manifest into batches dispatched largest first, with cpus and memory per batch')
+    parser.add_argument('manifest', help='Manifest from discover_files.py')
+    parser.add_argument('output_folder', help='Folder for the batch manifests')
+    parser.add_argument('batch_index', help='Index of the batches in dispatch order (TSV with batch, files, bytes, cpus, memory_mb), batch is the file name in output_folder')
+    parser.add_argument('--batch_gb', default=DEFAULT_BATCH_BYTES / 1e9, type=float, help='Batches are filled up to this many GB, larger files are a batch of their own')
+    parser.add_argument('--batch_files', default=DEFAULT_BATCH_FILES, type=int, help='Maximum number of files per batch')
+    parser.add_argument('--max_cpus', default=DEFAULT_BATCH_CPUS, type=int, help='Cores requested by a batch of several files')
+    parser.add_argument('--metadata_only', action='store_true', help='Files are summarized with xmlsummary_single.py --metadata_only, which only reads their headers, so batches are only limited by --batch_files')
+    args = parser.parse_args()
+
+    entries = discover_files.read_manifest(args.manifest)
+    batch_bytes = int(args.batch_gb * 1e9) if not args.metadata_only else None
+    batches = pack_batches(entries, batch_bytes=batch_bytes, batch_files=args.batch_files, max_cpus=args.max_cpus)
+    write_batches(batches, args.output_folder, args.batch_index, max_cpus=args.max_cpus, metadata_only=args.metadata_only)
+
+    total_bytes = sum(x['size'] for x in entries)
+    print(f"Files {len(entries)} bytes {total_bytes} batches {len(batches)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+import argparse
+import heapq
+import math
+import os
+
+import discover_files
+
+# Fixed cost of a file in bytes when balancing shards, so shards of many tiny files are not underestimated
+FILE_COST_BYTES = 16 * 1024 * 1024
+
+def _file_cost(entry):
+    return entry['size'] + FILE_COST_BYTES
+
+def shard_entries(entries, number_of_shards):
+    """Splits manifest entries into shards of about the same total cost.
+
+    The largest files are assigned first, each to the shard with the lowest cost so far, which keeps the
+    largest shard close to the average. Ties are broken by path, so the same manifest always gives the same shards.
+
+    Returns:
+        list: Shards, each a list of manifest entries. Empty shards are dropped
+    """
+    number_of_shards = max(1, number_of_shards)
+    shards = [[] for _ in range(number_of_shards)]
+    shard_costs = [(0, shard_index) for shard_index in range(number_of_shards)]
+    for entry in sorted(entries, key=lambda x: (-_file_cost(x), x['path'])):
+        shard_cost, shard_index = heapq.heappop(shard_costs)
+        shards[shard_index].append(entry)
+        heapq.heappush(shard_costs, (shard_cost + _file_cost(entry), shard_index))
+    return [x for x in shards if len(x) > 0]
+
+def number_of_shards_for(entries, shards=None, shard_bytes=None, shard_files=None):
+    """Number of shards from a fixed count, or from a target total size or number of files per shard (whichever needs more)."""
+    if shards is not None:
+        return shards
+    number_of_shards = 1
+    if shard_bytes is not None:
+        number_of_shards = max(number_of_shards, math.ceil(sum(_file_cost(x) for x in entries) / shard_bytes))
+    if shard_files is not None:
+        number_of_shards = max(number_of_shards, math.ceil(len(entries) / shard_files))
+    return number_of_shards
+
+def write_shards(shards, output_folder):
+    """Writes each shard as a manifest named shard_0000.tsv, shard_0001.tsv, ... in output_folder."""
+    os.makedirs(output_folder, exist_ok=True)
+    shard_files = []
+    for shard_index, shard in enumerate(shards):
+        shard_file = os.path.join(output_folder, f"shard_{shard_index:04d}.tsv")
+        discover_files.write_manifest(shard, shard_file)
+        shard_files.append(shard_file)
+    return shard_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split a file manifest into shards of about equal size, one task per shard')
+    parser.add_argument('manifest', help='Manifest from discover_files.py')
+    parser.add_argument('output_folder', help='Folder for the shard manifests')
+    parser.add_argument('--shards', default=None, type=int, help='Number of shards')
+    parser.add_argument('--shard_gb', default=None, type=float, help='Target total size of a shard in GB, if --shards is not given')
+    parser.add_argument('--shard_files', default=None, type=int, help='Maximum number of files per shard, if --shards is not given')
+    args = parser.parse_args()
+
+    entries = discover_files.read_manifest(args.manifest)
+    shard_bytes = int(args.shard_gb * 1e9) if args.shard_gb is not None else None
+    number_of_shards = number_of_shards_for(entries, shards=args.shards, shard_bytes=shard_bytes, shard_files=args.shard_files)
+
+    shards = shard_entries(entries, number_of_shards)
+    write_shards(shards, args.output_folder)
+
+    for shard_index, shard in enumerate(shards):
+        print(f"Shard {shard_index} files {len(shard)} bytes {sum(x['size'] for x in shard)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import bz2
+import gzip
+import os
+
+# Lower case extension -> format name used for dispatch
+SPECTRUM_FORMATS = {'.mzml': 'mzML',
+                    '.mzxml': 'mzXML',
+                    '.mgf': 'mgf'}
+
+# Lower case extension -> opener, these files are decompressed as a stream while they are parsed
+COMPRESSION_OPENERS = {'.gz': gzip.open,
+                       '.bz2': bz2.open}
+
+def split_compression(path):
+    """Splits a compression extension off a path.
+
+    Returns:
+        tuple: (path without the compression extension, lower case compression extension or None)
+    """
+    root, extension = os.path.splitext(path)
+    if extension.lower() in COMPRESSION_OPENERS:
+        return root, extension.lower()
+    return path, None
+
+def spectrum_format(path):
+    """Format of a spectrum file from its extension, case-insensitive and looking through .gz/.bz2.
+
+    Returns:
+        tuple: (format name from SPECTRUM_FORMATS or None if unsupported, compression extension or None)
+    """
+    uncompressed_path, compression = split_compression(path)
+    return SPECTRUM_FORMATS.get(os.path.splitext(uncompressed_path)[1].lower()), compression
+
+def is_spectrum_file(path):
+    return spectrum_format(path)[0] is not None
+
+def open_spectrum_file(path):
+    """Opens a spectrum file for binary reading, decompressing compressed files as they are read (no temporary files)."""
+    _, compression = split_compression(path)
+    if compression is not None:
+        return COMPRESSION_OPENERS[compression](path, 'rb')
+    return open(path, 'rb')
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import batch_summary
+import msaccess_runner
+import xmlsummary_single
+
+# Requests waiting for or running in a worker, per worker. Beyond this requests are turned away with 503
+DEFAULT_QUEUE_PER_WORKER = 4
+# Seconds a request may wait for its summary before it is answered with 504, the summary keeps running in its worker
+DEFAULT_REQUEST_TIMEOUT = 600
+# Largest request body accepted, a request only carries a path
+MAX_REQUEST_BYTES = 64 * 1024
+
+class SummaryService:
+    """Summarizes single files on a pool of worker processes that stay warm between requests.
+
+    The workers load the ontology once when they start, like the workers of batch_summary.process_batch, and files
+    are summarized with the same backends and fallback (summarize_routed when route is given).
+
+    Args:
+        ontology_file (str): psi-ms.obo or its compiled lookup, loaded by every worker at startup
+        parallelism (int): Number of worker processes
+        max_pending (int): Requests queued or running at once, further requests are rejected until one finishes
+        extra_metrics (tuple): From xmlsummary_single.parse_extra_metrics, added to every row
+        metadata_only (bool): Only read the headers, the MS level columns are left empty
+        route (dict): msaccess_binary and msaccess_timeout for summarize_routed, or None for summarize_file
+    """
+    def __init__(self, ontology_file=None, parallelism=1, max_pending=None, use_index=False, extra_metrics=(), route=None,
+                 metadata_only=False):
+        self.ontology_file = ontology_file
+        self.parallelism = max(1, parallelism)
+        self.max_pending = max_pending if max_pending is not None else self.parallelism * DEFAULT_QUEUE_PER_WORKER
+        self.use_index = use_index
+        self.extra_metrics = extra_metrics
+        self.route = route
+        self.metadata_only = metadata_only
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.pool = multiprocessing.Pool(self.parallelism, initializer=batch_summary._init_batch_worker, initargs=(ontology_file,))
+
+    def submit(self, input_file, original_path=None):
+        """Queues a file on the workers.
+
+        Returns:
+            multiprocessing.pool.AsyncResult of (summary row or None, error row or None, perf record), or None if the
+            queue is full
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return None
+        with self._lock:
+            self.pending += 1
+        batch_entry = (input_file, original_path if original_path is not None else input_file, self.ontology_file,
+                       self.use_index, self.extra_metrics, self.metadata_only, self.route, False)
+        # The slot is released when the worker finishes, not when the request gives up waiting, so a queue of slow
+        # files keeps turning requests away instead of piling up in the pool
+        return self.pool.apply_async(batch_summary._summarize_batch_entry, (batch_entry,),
+                                     callback=self._finished, error_callback=self._finished)
+
+    def _finished(self, result):
+        with self._lock:
+            self.pending -= 1
+            if isinstance(result, tuple) and result[0] is not None:
+                self.completed += 1
+            else:
+                self.failed += 1
+        self._slots.release()
+
+    def health(self):
+        with self._lock:
+            return {'status': 'ok',
+                    'workers': self.parallelism,
+                    'pending': self.pending,
+                    'max_pending': self.max_pending,
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'rejected': self.rejected}
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class SummaryRequestHandler(BaseHTTPRequestHandler):
+    """JSON API of the summary server.
+
+    GET  /health     -> 200 with the worker and queue counts
+    POST /summarize  {"path": ..., "original_path": ...} -> 200 {"row": {...}}, 400 for a bad request, 404 if the
+                     file does not exist, 422 {"error": ...} if no backend could summarize it, 503 if the queue is
+                     full (retry after Retry-After seconds), 504 if it did not finish within the request timeout
+    """
+    # Set on the subclass made by make_server
+    service = None
+    request_timeout = DEFAULT_REQUEST_TIMEOUT
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_json(404, {'error': f"Unknown endpoint {self.path}"})
+            return
+        self._send_json(200, self.service.health())
+
+    def do_POST(self):
+        if self.path != '/summarize':
+            self._send_json(404, {'error': f"Unknown endpoint {self.path}"})
+            return
+
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            if content_length > MAX_REQUEST_BYTES:
+                raise ValueError(f"Request body larger than {MAX_REQUEST_BYTES} bytes")
+            request = json.loads(self.rfile.read(content_length) or b'{}')
+            input_file = request['path']
+            original_path = request.get('original_path')
+            if not isinstance(input_file, str) or not (original_path is None or isinstance(original_path, str)):
+                raise ValueError("path and original_path must be strings")
+        except (ValueError, KeyError, TypeError) as request_error:
+            self._send_json(400, {'error': f"Bad request, expected JSON with a path: {request_error}"})
+            return
+
+        if not os.path.isfile(input_file):
+            self._send_json(404, {'error': f"No such file {input_file}"})
+            return
+
+        async_result = self.service.submit(input_file, original_path)
+        if async_result is None:
+            self._send_json(503, {'error': "Too many pending requests"}, headers={'Retry-After': '1'})
+            return
+        try:
+            output_dictionary, error_dictionary, _ = async_result.get(timeout=self.request_timeout)
+        except multiprocessing.TimeoutError:
+            self._send_json(504, {'error': f"Not summarized within {self.request_timeout} seconds"})
+            return
+        except Exception as any_exception:
+            self._send_json(500, {'error': f"{type(any_exception).__name__}: {any_exception}"})
+            return
+
+        if output_dictionary is None:
+            self._send_json(422, {'error': error_dictionary['Error']})
+            return
+        self._send_json(200, {'row': output_dictionary})
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} {format % args}")
+
+def make_server(service, host='127.0.0.1', port=0, request_timeout=DEFAULT_REQUEST_TIMEOUT):
+    """HTTP server answering with service, port 0 picks a free port (see server.server_address)."""
+    handler = type('BoundSummaryRequestHandler', (SummaryRequestHandler,), {'service': service, 'request_timeout': request_timeout})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize single files on demand over HTTP with a warm pool of workers')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on, only localhost by default')
+    parser.add_argument('--port', default=8765, type=int, help='Port to listen on, 0 picks a free port')
+    parser.add_argument('--ontology_file', default=None, help='psi-ms.obo or its compiled lookup from ontology_cache.py, loaded once per worker')
+    parser.add_argument('--parallelism', default=None, type=int, help='Number of worker processes, defaults to the available cores')
+    parser.add_argument('--max_pending', default=None, type=int, help=f'Requests queued or running at once before further requests get 503, defaults to {DEFAULT_QUEUE_PER_WORKER} per worker')
+    parser.add_argument('--request_timeout', default=DEFAULT_REQUEST_TIMEOUT, type=int, help='Seconds a request waits for its summary before it gets 504')
+    parser.add_argument('--use_index', action='store_true', help='Count ms levels through the byte-offset index (without --route)')
+    parser.add_argument('--extra_metrics', default='', help=f'Comma separated extra columns, any of {",".join(xmlsummary_single.EXTRA_METRIC_HEADERS)}')
+    parser.add_argument('--metadata_only', action='store_true', help='Only read the headers for the instrument columns, the MS level columns are left empty')
+    parser.add_argument('--route', action='store_true', help='Pick the cheapest backend per file with fallback, rows get a Backend column')
+    parser.add_argument('--msaccess_binary', default=None, help='With --route, msaccess is the last backend tried for every file')
+    parser.add_argument('--msaccess_timeout', default=msaccess_runner.DEFAULT_MSACCESS_TIMEOUT, type=int, help='Seconds before msaccess is killed for a single file')
+    args = parser.parse_args()
+
+    if args.metadata_only and args.extra_metrics:
+        parser.error("--extra_metrics need every spectrum, they cannot be combined with --metadata_only")
+
+    parallelism = args.parallelism if args.parallelism is not None else msaccess_runner.available_cores()
+    service = SummaryService(ontology_file=args.ontology_file,
+                             parallelism=parallelism,
+                             max_pending=args.max_pending,
+                             use_index=args.use_index,
+                             extra_metrics=xmlsummary_single.parse_extra_metrics(args.extra_metrics),
+                             route={'msaccess_binary': args.msaccess_binary, 'msaccess_timeout': args.msaccess_timeout} if args.route else None,
+                             metadata_only=args.metadata_only)
+    server = make_server(service, args.host, args.port, args.request_timeout)
+
+    # SIGTERM stops the server like Ctrl-C, so the workers are shut down cleanly
+    def stop(signal_number, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    host, port = server.server_address[:2]
+    print(f"Listening on http://{host}:{port} with {service.parallelism} workers", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == "__main__":
+    main()
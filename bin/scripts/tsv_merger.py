@@ -2,12 +2,263 @@
 
 
 import sys
-import getopt
 import os
-import pandas as pd
-from collections import defaultdict
+import csv
+import heapq
+import itertools
 import argparse
 import glob
+import queue
+import threading
+import collections
+import concurrent.futures
+
+
+# Number of input files read ahead of the one being merged
+DEFAULT_READ_AHEAD = 4
+# Rows handed from a reader thread to the merge at a time, and blocks a reader may be ahead of the merge per file
+ROWS_PER_BLOCK = 4096
+BLOCKS_PER_FILE = 4
+# Marks the end of the rows of a file
+_END_OF_FILE = None
+
+############## Columnar Output ##################
+# Columns written as integers and floats in the columnar output, every other column except the paths is a dictionary encoded string.
+# Includes the optional extra metric columns of xmlsummary_single.py
+INTEGER_COLUMNS = ["MS1s", "MS2s", "MS3+", "Unknown_MS_Level", "Pos_Scan_Count", "Neg_Scan_Count", "Total_Scans"]
+FLOAT_COLUMNS = ["RT_Min", "RT_Max"]
+# Partition column of the columnar output, the top-level dataset directory of each file
+DATASET_COLUMN = "Dataset"
+# Columns whose value is the path of the summarized file, in order of preference. These are unique per row, so they
+# are plain strings: an Arrow dictionary would be copied whole into every partition (Parquet still dictionary encodes per file)
+PATH_COLUMNS = ["Original_Path", "Filename"]
+# Rows per record batch handed to the Parquet writer
+PARQUET_BATCH_ROWS = 65536
+
+# Summary fields can be long (e.g., many instrument configurations)
+csv.field_size_limit(sys.maxsize)
+
+
+def read_header(results_file):
+    """Returns the column names of a TSV file, or an empty list if the file is empty."""
+    with open(results_file, 'r', newline='') as f:
+        header_line = f.readline()
+    if header_line.strip() == '':
+        return []
+    return next(csv.reader([header_line], delimiter='\t'))
+
+def union_headers(header_list):
+    """Union of all columns in first seen order, since the msaccess and xml summaries do not share a schema."""
+    columns = {}
+    for header in header_list:
+        for column in header:
+            columns.setdefault(column, None)
+    return list(columns)
+
+def _put(block_queue, item, stop_event):
+    """Puts an item on a bounded queue, giving up once the merge stopped reading."""
+    while not stop_event.is_set():
+        try:
+            block_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _read_blocks(results_file, block_queue, stop_event, rows_per_block):
+    """Streams the rows of a file onto block_queue in blocks, then _END_OF_FILE, or the exception that stopped it."""
+    try:
+        with open(results_file, 'r', newline='') as f:
+            reader = csv.DictReader(f, delimiter='\t')
+            block = []
+            for row in reader:
+                # DictReader puts the fields without a column under None
+                extra_fields = row.pop(None, None)
+                if extra_fields is not None:
+                    print(f"Row with more fields than the header in {results_file} line {reader.line_num}, dropped extra fields {extra_fields}")
+                block.append(row)
+                if len(block) >= rows_per_block:
+                    if not _put(block_queue, block, stop_event):
+                        return
+                    block = []
+            if len(block) > 0 and not _put(block_queue, block, stop_event):
+                return
+        _put(block_queue, _END_OF_FILE, stop_event)
+    except Exception as read_error:
+        _put(block_queue, read_error, stop_event)
+
+def iter_rows(results_files, read_ahead=DEFAULT_READ_AHEAD, rows_per_block=ROWS_PER_BLOCK):
+    """Yields the rows of every file as dicts, in file order.
+
+    Files are read row by row in background threads, the current file and up to read_ahead - 1 files after it, each
+    handing blocks of rows to the merge through a bounded queue. Memory is therefore bounded by read_ahead x
+    BLOCKS_PER_FILE x rows_per_block rows, whatever the size of the inputs. Fields beyond the header of
+    their file are dropped and the row is reported, rather than stopping the merge.
+    """
+    read_ahead = max(1, read_ahead)
+    stop_event = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=read_ahead) as executor:
+        # A reader holds its thread until its file is done, so at most read_ahead files are open at once
+        pending_queues = collections.deque()
+        results_file_iterator = iter(results_files)
+
+        def start_reader(results_file):
+            block_queue = queue.Queue(maxsize=BLOCKS_PER_FILE)
+            executor.submit(_read_blocks, results_file, block_queue, stop_event, rows_per_block)
+            pending_queues.append(block_queue)
+
+        for results_file in itertools.islice(results_file_iterator, read_ahead):
+            start_reader(results_file)
+        try:
+            while len(pending_queues) > 0:
+                block_queue = pending_queues.popleft()
+                while True:
+                    block = block_queue.get()
+                    if block is _END_OF_FILE:
+                        break
+                    if isinstance(block, Exception):
+                        raise block
+                    yield from block
+                next_results_file = next(results_file_iterator, None)
+                if next_results_file is not None:
+                    start_reader(next_results_file)
+        finally:
+            # Readers blocked on a full queue give up, e.g. when the merge failed or stopped early
+            stop_event.set()
+
+def _sort_key(value):
+    """Orders empty values first, then numbers by value, then any other strings."""
+    if value is None or value == '':
+        return (0, 0.0)
+    try:
+        return (1, float(value))
+    except ValueError:
+        return (2, value)
+
+def top_k_rows(rows, topk, key_column, sort_column):
+    """Keeps the topk rows with the largest sort_column for every key_column value.
+
+    Each key keeps a bounded min-heap, so memory scales with number of keys x topk rather than with
+    the number of rows. Rows are returned sorted by sort_column, largest first. Ties keep the earliest row.
+    """
+    heaps = {}
+    for row_number, row in enumerate(rows):
+        key = row.get(key_column)
+        if key is None or key == '':
+            # Matches pandas groupby, which drops missing keys
+            continue
+        heap = heaps.setdefault(key, [])
+        # Later rows get a smaller tie breaker, so they are evicted first on ties
+        entry = (_sort_key(row.get(sort_column)), -row_number, row)
+        if len(heap) < topk:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+
+    kept_entries = [entry for heap in heaps.values() for entry in heap]
+    kept_entries.sort(key=lambda entry: entry[:2], reverse=True)
+    return [entry[2] for entry in kept_entries]
+
+def dataset_of_path(path, dataset_root=None):
+    """Top-level directory of a file, relative to dataset_root when given.
+
+    Returns:
+        str: Dataset directory, or None if the file is not inside a directory under dataset_root
+    """
+    if path is None or path == '':
+        return None
+    path = os.path.normpath(path)
+    if dataset_root is not None:
+        root_prefix = os.path.normpath(dataset_root).rstrip(os.sep) + os.sep
+        if not path.startswith(root_prefix):
+            return None
+        path = path[len(root_prefix):]
+    parts = path.lstrip(os.sep).split(os.sep, 1)
+    if len(parts) < 2:
+        return None
+    return parts[0]
+
+def _parse_int(value):
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return int(float(value))
+        except ValueError:
+            return None
+
+def _parse_float(value):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def _record_batches(rows, columns, schema, dataset_root, batch_rows):
+    import pyarrow
+
+    def to_batch(batch_rows_list):
+        arrays = []
+        for column in columns:
+            values = [row.get(column) for row in batch_rows_list]
+            if column in INTEGER_COLUMNS:
+                arrays.append(pyarrow.array([_parse_int(value) for value in values], type=pyarrow.int64()))
+            elif column in FLOAT_COLUMNS:
+                arrays.append(pyarrow.array([_parse_float(value) for value in values], type=pyarrow.float64()))
+            else:
+                array = pyarrow.array([value if value != '' else None for value in values], type=pyarrow.string())
+                arrays.append(array if column in PATH_COLUMNS else array.dictionary_encode())
+        datasets = []
+        for row in batch_rows_list:
+            path = next((row.get(column) for column in PATH_COLUMNS if row.get(column)), None)
+            datasets.append(dataset_of_path(path, dataset_root))
+        arrays.append(pyarrow.array(datasets, type=pyarrow.string()))
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+    pending_rows = []
+    for row in rows:
+        pending_rows.append(row)
+        if len(pending_rows) >= batch_rows:
+            yield to_batch(pending_rows)
+            pending_rows = []
+    if len(pending_rows) > 0:
+        yield to_batch(pending_rows)
+
+def write_parquet_dataset(rows, columns, output_folder, dataset_root=None, batch_rows=PARQUET_BATCH_ROWS):
+    """Writes rows as a Parquet dataset partitioned by the top-level dataset directory of each file.
+
+    String columns are dictionary encoded and the MS level counts are typed integers, so readers can load
+    only the columns and Dataset=<name> partitions they need. Rows without a dataset go to the default partition.
+    """
+    # Only needed for the columnar output, the TSV merge does not depend on pyarrow
+    import pyarrow
+    import pyarrow.dataset
+
+    # The partition column is always derived from the file paths
+    columns = [column for column in columns if column != DATASET_COLUMN]
+    fields = []
+    for column in columns:
+        if column in INTEGER_COLUMNS:
+            fields.append(pyarrow.field(column, pyarrow.int64()))
+        elif column in FLOAT_COLUMNS:
+            fields.append(pyarrow.field(column, pyarrow.float64()))
+        elif column in PATH_COLUMNS:
+            fields.append(pyarrow.field(column, pyarrow.string()))
+        else:
+            fields.append(pyarrow.field(column, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())))
+    fields.append(pyarrow.field(DATASET_COLUMN, pyarrow.string()))
+    schema = pyarrow.schema(fields)
+
+    partitioning = pyarrow.dataset.partitioning(pyarrow.schema([pyarrow.field(DATASET_COLUMN, pyarrow.string())]), flavor="hive")
+    pyarrow.dataset.write_dataset(_record_batches(rows, columns, schema, dataset_root, batch_rows),
+                                  output_folder,
+                                  schema=schema,
+                                  format="parquet",
+                                  partitioning=partitioning,
+                                  existing_data_behavior="delete_matching")
 
 
 def main():
@@ -20,30 +271,69 @@ def main():
     parser.add_argument('--topk', default=None, help='When merging, we want to include the top k results for each unique key')
     parser.add_argument('--key_column', default=None, help='column of the key to group by')
     parser.add_argument('--sort_column', default=None, help='column of the to sort by')
+    parser.add_argument('--read_ahead', default=DEFAULT_READ_AHEAD, type=int, help='Number of input files read in parallel, the one being merged included')
+
+    # Optional columnar copy of the merged results, the TSV is always written
+    parser.add_argument('--parquet_output', default=None, help='Folder for a Parquet dataset of the merged results, partitioned by Dataset')
+    parser.add_argument('--dataset_root', default=None, help='Directory that datasets are top-level folders of, for the Dataset partition')
+
+    # Incremental rollups of the merged rows, see rollups.py
+    parser.add_argument('--rollup_db', default=None, help='SQLite rollup database that the merged rows are added to')
+    parser.add_argument('--rollup_output', default=None, help='Folder to write the rollup tables to as <name>.tsv, needs --rollup_db')
 
     args = parser.parse_args()
 
-    all_results_files = glob.glob(os.path.join(args.input_folder, "*.tsv"))
+    all_results_files = sorted(glob.glob(os.path.join(args.input_folder, "*.tsv")))
 
-    all_results_list = []
-    for i, results_file in enumerate(all_results_files):
-        temp_df = pd.read_csv(results_file, sep="\t")
+    # Only the header lines are read up front to union the schemas
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.read_ahead)) as executor:
+        header_list = list(executor.map(read_header, all_results_files))
 
-        if len(temp_df) > 0:
-            all_results_list.append(temp_df)
-    
-    # merging results
-    all_results_df = pd.concat(all_results_list, ignore_index=True)
+    columns = union_headers(header_list)
+
+    all_rows = iter_rows(all_results_files, read_ahead=args.read_ahead)
 
     # Filtering when appropriate
     if args.topk is not None:
-        topk_filter = int(args.topk)
+        all_rows = top_k_rows(all_rows, int(args.topk), args.key_column, args.sort_column)
+
+    rollup_store = None
+    if args.rollup_db is not None:
+        # Only needed for the rollups
+        import rollups
+        rollup_store = rollups.RollupStore(args.rollup_db, dataset_root=args.dataset_root)
 
-        all_results_df = all_results_df.sort_values(by=args.sort_column, ascending=False)
-        all_results_df = all_results_df.groupby(args.key_column).head(int(args.topk))
 
     # writing results
-    all_results_df.to_csv(args.output_file, sep="\t", index=False)
+    number_of_rows = 0
+    with open(args.output_file, 'w', newline='') as output_file:
+        if len(columns) > 0:
+            writer = csv.DictWriter(output_file, fieldnames=columns, delimiter='\t', restval='', extrasaction='ignore', lineterminator='\n')
+            writer.writeheader()
+
+            # Every row is written to the TSV and added to the rollups as it passes through to the columnar output
+            def written_rows():
+                nonlocal number_of_rows
+                for row in all_rows:
+                    writer.writerow(row)
+                    if rollup_store is not None:
+                        rollup_store.add_row(row)
+                    number_of_rows += 1
+                    yield row
+
+            if args.parquet_output is not None:
+                write_parquet_dataset(written_rows(), columns, args.parquet_output, dataset_root=args.dataset_root)
+            else:
+                for _ in written_rows():
+                    pass
+
+    if rollup_store is not None:
+        rollup_store.commit()
+        if args.rollup_output is not None:
+            rollup_store.write_tables(args.rollup_output)
+        rollup_store.close()
+
+    print("Merged rows", number_of_rows, "from files", len(all_results_files))
 
 if __name__ == "__main__":
     main()
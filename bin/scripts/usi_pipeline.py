@@ -0,0 +1,415 @@
+#!/usr/bin/python
+
+import argparse
+import csv
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+from urllib.parse import quote, unquote, urlparse
+
+import requests
+import yaml
+
+import batch_summary
+import msaccess_runner
+import spectrum_io
+import xmlsummary_single
+
+# Column that carries the USI of every row, so the summary needs no join with the download table
+USI_COLUMN = "usi"
+# Columns that add_usi.py appends to a summary, every row carries them so the output can replace includeUSI
+FILENAME_COLUMN = "filename"
+TARGET_PATH_COLUMN = "target_path"
+USI_SUMMARY_HEADERS = [USI_COLUMN, TARGET_PATH_COLUMN]
+
+# Endpoint download_public_data_usi.py resolves USIs with, it answers with the remote link of the file
+DEFAULT_URL_TEMPLATE = "https://dashboard.gnps2.org/downloadlink?usi={usi}"
+# Responses up to this size are checked for being a remote link rather than the file itself
+MAX_LINK_BYTES = 4096
+
+DEFAULT_DOWNLOAD_PARALLELISM = 4
+# Files downloaded but not yet summarized, and files waiting for a download. When full, the stage before waits
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_DOWNLOAD_TIMEOUT = 600
+DEFAULT_DOWNLOAD_RETRIES = 2
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+CONTENT_DISPOSITION_PATTERN = re.compile(r'filename\*?=(?:UTF-8\'\')?"?([^";]+)"?', re.IGNORECASE)
+
+# Marks the end of a queue
+_DONE = None
+
+def read_usis(usi_file):
+    """Reads USIs from a GNPS2 job parameters YAML (usi key, one per line), a TSV with a usi column, or a list with one per line.
+
+    Returns:
+        list: USIs in input order without duplicates
+    """
+    if os.path.splitext(usi_file)[1].lower() in ('.yaml', '.yml'):
+        with open(usi_file, 'r') as f:
+            parameters = yaml.safe_load(f) or {}
+        lines = str(parameters.get('usi') or '').splitlines()
+    else:
+        with open(usi_file, 'r', newline='') as f:
+            lines = f.read().splitlines()
+        if len(lines) > 0 and USI_COLUMN in lines[0].split('\t'):
+            lines = [row[USI_COLUMN] for row in csv.DictReader(lines, delimiter='\t')]
+    usis = [x.strip() for x in lines if x.strip() != '']
+    return list(dict.fromkeys(usis))
+
+def parse_usi(usi):
+    """Splits a USI (mzspec:<dataset>:<file>[:<index type>:<index>]) into its dataset and file.
+
+    Raises:
+        ValueError: If the USI has no dataset or file
+    """
+    parts = usi.split(':')
+    if len(parts) < 3 or parts[0].lower() != 'mzspec' or parts[1] == '' or parts[2] == '':
+        raise ValueError(f"Not a USI {usi}")
+    return parts[1], parts[2]
+
+def download_url(usi, url_template):
+    """URL of the file of a USI, url_template may use {usi}, {dataset} and {file}, each URL quoted."""
+    dataset, usi_file = parse_usi(usi)
+    return url_template.format(usi=quote(usi, safe=''), dataset=quote(dataset, safe=''), file=quote(usi_file, safe='/'))
+
+def _relative_target(dataset, usi_file):
+    """Download path of a file relative to the download folder, <dataset>/<file name> like download_public_data_usi.py --nestfiles nest."""
+    file_name = os.path.basename(usi_file.rstrip('/'))
+    if dataset in ('', '.', '..') or '/' in dataset or file_name in ('', '.', '..'):
+        raise ValueError(f"No download path for dataset {dataset} file {usi_file}")
+    return os.path.join(dataset, file_name)
+
+def _remote_link(response):
+    """The URL a link endpoint answered with, or None if the response is the file itself."""
+    content_length = response.headers.get('Content-Length')
+    if not response.headers.get('Content-Type', '').startswith('text/') or content_length is None or int(content_length) > MAX_LINK_BYTES:
+        return None
+    # Reads the (small) body, iter_content then yields it again if this turns out to be the file
+    body = response.text.strip()
+    if re.fullmatch(r'https?://\S+', body) is None:
+        return None
+    return body
+
+def _downloaded_name(default_name, response):
+    """Name a download is saved under, the first of the USI file, the Content-Disposition and the final URL with a spectrum format."""
+    candidates = [default_name]
+    content_disposition = CONTENT_DISPOSITION_PATTERN.search(response.headers.get('Content-Disposition', ''))
+    if content_disposition is not None:
+        candidates.append(os.path.basename(unquote(content_disposition.group(1))))
+    candidates.append(os.path.basename(unquote(urlparse(response.url).path)))
+    for candidate in candidates:
+        if candidate and spectrum_io.spectrum_format(candidate)[0] is not None:
+            return candidate
+    return default_name
+
+class DownloadJob:
+    """A file to download with every USI that points into it (e.g., several scans of one file)."""
+    def __init__(self, dataset, usi_file, usis, url):
+        self.dataset = dataset
+        self.usi_file = usi_file
+        self.usis = usis
+        self.url = url
+        self.path = None
+        self.error = None
+
+def plan_downloads(usis, url_template):
+    """Groups USIs by the file they point into, each file is downloaded and summarized once.
+
+    Returns:
+        tuple: (list of DownloadJob, list of (usi, error) for USIs that could not be parsed)
+    """
+    jobs = {}
+    invalid_usis = []
+    for usi in usis:
+        try:
+            dataset, usi_file = parse_usi(usi)
+            url = download_url(usi, url_template)
+        except (ValueError, KeyError, IndexError) as usi_error:
+            invalid_usis.append((usi, f"{type(usi_error).__name__}: {usi_error}"))
+            continue
+        if (dataset, usi_file) not in jobs:
+            jobs[(dataset, usi_file)] = DownloadJob(dataset, usi_file, [], url)
+        jobs[(dataset, usi_file)].usis.append(usi)
+
+    # Files of a dataset are saved by name, a second file with the same name would be summarized as the first one
+    targets = {}
+    for job in list(jobs.values()):
+        try:
+            target = _relative_target(job.dataset, job.usi_file)
+        except ValueError as target_error:
+            target, conflict = None, f"{type(target_error).__name__}: {target_error}"
+        else:
+            conflict = f"ValueError: Same file name as {targets[target].usi_file} in dataset {job.dataset}" if target in targets else None
+        if conflict is None:
+            targets[target] = job
+            continue
+        invalid_usis.extend((usi, conflict) for usi in job.usis)
+        del jobs[(job.dataset, job.usi_file)]
+    return list(jobs.values()), invalid_usis
+
+def download_file(job, download_folder, session, timeout=DEFAULT_DOWNLOAD_TIMEOUT, retries=DEFAULT_DOWNLOAD_RETRIES):
+    """Downloads the file of a job into download_folder/<dataset>/<file>, skipping files that are already there.
+
+    The file is written to <name>.part and only renamed once it is complete (and matches the Content-Length), so a
+    file under its final name always has its final size. A failed download removes its .part file.
+    When the URL answers with a remote link (like DEFAULT_URL_TEMPLATE), the file is downloaded from that link.
+
+    Returns:
+        str: Path of the downloaded file
+
+    Raises:
+        requests.RequestException, OSError, ValueError: If the download failed on every attempt
+    """
+    target = os.path.join(download_folder, _relative_target(job.dataset, job.usi_file))
+    if os.path.isfile(target) and spectrum_io.spectrum_format(target)[0] is not None:
+        return target
+
+    for attempt in range(retries + 1):
+        partial_target = None
+        try:
+            response = session.get(job.url, stream=True, timeout=timeout)
+            remote_link = _remote_link(response) if response.ok else None
+            if remote_link is not None:
+                response.close()
+                response = session.get(remote_link, stream=True, timeout=timeout)
+            with response:
+                response.raise_for_status()
+                target = os.path.join(os.path.dirname(target), _downloaded_name(os.path.basename(target), response))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                partial_target = target + ".part"
+                bytes_written = 0
+                with open(partial_target, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                        f.write(chunk)
+                        bytes_written += len(chunk)
+                expected_bytes = response.headers.get('Content-Length')
+                # A compressed transfer has a Content-Length of the compressed bytes, only check plain transfers
+                if expected_bytes is not None and 'Content-Encoding' not in response.headers and int(expected_bytes) != bytes_written:
+                    raise ValueError(f"Incomplete download, {bytes_written} of {expected_bytes} bytes")
+                os.replace(partial_target, target)
+                return target
+        except (requests.RequestException, OSError, ValueError) as download_error:
+            if partial_target is not None and os.path.exists(partial_target):
+                os.remove(partial_target)
+            # A file the server does not have will not appear on a retry
+            client_error = isinstance(download_error, requests.HTTPError) and download_error.response is not None and download_error.response.status_code < 500
+            if attempt == retries or client_error:
+                raise
+            print("Retrying download", job.url, download_error)
+            time.sleep(2 ** attempt)
+
+class UsiPipeline:
+    """Downloads USI files and summarizes each file as soon as its download completes.
+
+    Downloads run on download_parallelism threads and summaries on a pool of worker processes with the ontology loaded,
+    like batch_summary.process_batch. Both stages are connected by bounded queues, so downloads pause while
+    summaries fall behind instead of filling the disk, and summaries start long before the last download finished.
+
+    Rows and errors are written as they complete, every row once per USI of its file. Like the output of add_usi.py,
+    Filename is the path the file is reported under and every row ends with its filename (relative to
+    path_to_spectra), usi and target_path. With usi_summary_file, the USIs and their target_path are also written
+    like the summary of download_public_data_usi.py, with an empty target_path for USIs that failed to download.
+    """
+    def __init__(self, download_folder, result_file, error_file, ontology_file=None, parallelism=1,
+                 download_parallelism=DEFAULT_DOWNLOAD_PARALLELISM, queue_size=DEFAULT_QUEUE_SIZE,
+                 download_timeout=DEFAULT_DOWNLOAD_TIMEOUT, download_retries=DEFAULT_DOWNLOAD_RETRIES,
+                 extra_metrics=(), route=None, original_prefix=None, path_to_spectra=None, usi_summary_file=None):
+        self.download_folder = download_folder
+        self.ontology_file = ontology_file
+        self.parallelism = max(1, parallelism)
+        self.download_parallelism = max(1, download_parallelism)
+        self.queue_size = max(1, queue_size)
+        self.download_timeout = download_timeout
+        self.download_retries = download_retries
+        self.extra_metrics = extra_metrics
+        self.route = route
+        # Downloads are reported under this folder, e.g. where the download folder is published
+        self.original_prefix = original_prefix if original_prefix is not None else download_folder
+        # filename and target_path are relative to this folder, by default the one the downloads are published into
+        self.path_to_spectra = path_to_spectra if path_to_spectra is not None else os.path.dirname(os.path.normpath(self.original_prefix))
+
+        self._result_file = open(result_file, 'w', newline='')
+        self._error_file = open(error_file, 'w', newline='')
+        self._usi_summary_file = open(usi_summary_file, 'w', newline='') if usi_summary_file is not None else None
+        self._writer = csv.DictWriter(self._result_file,
+                                      fieldnames=xmlsummary_single.output_headers(extra_metrics, route is not None) + [FILENAME_COLUMN, USI_COLUMN, TARGET_PATH_COLUMN],
+                                      delimiter='\t', extrasaction='ignore')
+        self._error_writer = csv.DictWriter(self._error_file, fieldnames=[USI_COLUMN] + xmlsummary_single.ERROR_HEADERS, delimiter='\t')
+        self._writer.writeheader()
+        self._error_writer.writeheader()
+        self._usi_summary_writer = None
+        if self._usi_summary_file is not None:
+            self._usi_summary_writer = csv.DictWriter(self._usi_summary_file, fieldnames=USI_SUMMARY_HEADERS, delimiter='\t')
+            self._usi_summary_writer.writeheader()
+        self._write_lock = threading.Lock()
+        self.number_summarized = 0
+        self.number_failed = 0
+
+    def _write_rows(self, job, output_dictionary, error):
+        with self._write_lock:
+            # Path the download is published under, relative to the spectra folder, as in the summary rows
+            target_path = os.path.relpath(self._original_path(job), self.path_to_spectra) if job.path is not None else ''
+            if output_dictionary is not None:
+                output_dictionary = dict(output_dictionary, **{'Filename': self._original_path(job), FILENAME_COLUMN: target_path, TARGET_PATH_COLUMN: target_path})
+            for usi in job.usis:
+                if self._usi_summary_writer is not None:
+                    self._usi_summary_writer.writerow({USI_COLUMN: usi, TARGET_PATH_COLUMN: target_path})
+                if output_dictionary is not None:
+                    self._writer.writerow(dict(output_dictionary, **{USI_COLUMN: usi}))
+                else:
+                    self._error_writer.writerow({USI_COLUMN: usi,
+                                                 'Filename': os.path.basename(job.path or job.usi_file),
+                                                 'Original_Path': self._original_path(job) if job.path is not None else '',
+                                                 'Error': error})
+            if output_dictionary is not None:
+                self.number_summarized += 1
+            else:
+                self.number_failed += 1
+            self._result_file.flush()
+            self._error_file.flush()
+            if self._usi_summary_file is not None:
+                self._usi_summary_file.flush()
+
+    def _original_path(self, job):
+        return os.path.join(self.original_prefix, os.path.relpath(job.path, self.download_folder))
+
+    def _download_worker(self, download_queue, summary_queue):
+        with requests.Session() as session:
+            while True:
+                job = download_queue.get()
+                if job is _DONE:
+                    return
+                try:
+                    job.path = download_file(job, self.download_folder, session, self.download_timeout, self.download_retries)
+                except Exception as download_error:
+                    job.error = f"download: {type(download_error).__name__}: {download_error}"
+                    print("Download failed", job.url, download_error)
+                # Blocks while the summaries are behind
+                summary_queue.put(job)
+
+    def _summarize_downloads(self, pool, summary_queue):
+        # Summaries in the pool at once, the pool's own queue is unbounded
+        summary_slots = threading.BoundedSemaphore(self.parallelism * 2)
+        while True:
+            job = summary_queue.get()
+            if job is _DONE:
+                break
+            if job.error is not None:
+                self._write_rows(job, None, job.error)
+                continue
+
+            # The slot is released even if writing fails, otherwise the loop blocks on it forever
+            def finished(result, job=job):
+                try:
+                    output_dictionary, error_dictionary, _ = result
+                    self._write_rows(job, output_dictionary, error_dictionary['Error'] if error_dictionary is not None else None)
+                finally:
+                    summary_slots.release()
+
+            def failed(worker_error, job=job):
+                try:
+                    self._write_rows(job, None, f"{type(worker_error).__name__}: {worker_error}")
+                finally:
+                    summary_slots.release()
+
+            summary_slots.acquire()
+            batch_entry = (job.path, self._original_path(job), self.ontology_file, False, self.extra_metrics, False, self.route, False)
+            pool.apply_async(batch_summary._summarize_batch_entry, (batch_entry,), callback=finished, error_callback=failed)
+
+    def run(self, jobs):
+        """Downloads and summarizes every job.
+
+        Returns:
+            tuple: (number of files summarized, number of files that failed to download or summarize)
+        """
+        download_queue = queue.Queue(maxsize=self.queue_size)
+        summary_queue = queue.Queue(maxsize=self.queue_size)
+        pool = multiprocessing.Pool(self.parallelism, initializer=batch_summary._init_batch_worker, initargs=(self.ontology_file,))
+        try:
+            summarizer = threading.Thread(target=self._summarize_downloads, args=(pool, summary_queue))
+            summarizer.start()
+            downloaders = [threading.Thread(target=self._download_worker, args=(download_queue, summary_queue))
+                           for _ in range(self.download_parallelism)]
+            for downloader in downloaders:
+                downloader.start()
+
+            for job in jobs:
+                download_queue.put(job)
+            for _ in downloaders:
+                download_queue.put(_DONE)
+            for downloader in downloaders:
+                downloader.join()
+            summary_queue.put(_DONE)
+            summarizer.join()
+        finally:
+            pool.close()
+            pool.join()
+        return self.number_summarized, self.number_failed
+
+    def write_invalid_usis(self, invalid_usis):
+        with self._write_lock:
+            for usi, error in invalid_usis:
+                self._error_writer.writerow({USI_COLUMN: usi, 'Filename': '', 'Original_Path': '', 'Error': error})
+                if self._usi_summary_writer is not None:
+                    self._usi_summary_writer.writerow({USI_COLUMN: usi, TARGET_PATH_COLUMN: ''})
+
+    def close(self):
+        self._result_file.close()
+        self._error_file.close()
+        if self._usi_summary_file is not None:
+            self._usi_summary_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download USI files and summarize each one as soon as its download completes')
+    parser.add_argument('usi_file', help='USIs, as a GNPS2 job parameters YAML (usi), a TSV with a usi column, or one per line')
+    parser.add_argument('download_folder', help='Folder the files are downloaded to, as <dataset>/<file>')
+    parser.add_argument('result_file', help='Summary TSV with a usi column, one row per USI')
+    parser.add_argument('--url_template', default=DEFAULT_URL_TEMPLATE, help='Download URL of a USI, with {usi}, {dataset} and {file} replaced (URL quoted). It may answer with the file or with a remote link to it')
+    parser.add_argument('--error_name', default=None, help='Table of USIs that failed to download or summarize (TSV of usi, Filename, Original_Path, Error)')
+    parser.add_argument('--original_prefix', default=None, help='Folder the downloads are reported under in Filename and Original_Path, defaults to download_folder')
+    parser.add_argument('--path_to_spectra', default=None, help='Folder filename and target_path are relative to (as for add_usi.py), defaults to the parent of original_prefix')
+    parser.add_argument('--usi_summary', default=None, help='Table of usi and target_path like download_public_data_usi.py writes, target_path is empty for failed USIs')
+    parser.add_argument('--ontology_file', default=None, help='psi-ms.obo or its compiled lookup from ontology_cache.py')
+    parser.add_argument('--parallelism', default=None, type=int, help='Summary worker processes, defaults to the available cores')
+    parser.add_argument('--download_parallelism', default=DEFAULT_DOWNLOAD_PARALLELISM, type=int, help='Concurrent downloads')
+    parser.add_argument('--queue_size', default=DEFAULT_QUEUE_SIZE, type=int, help='Downloaded files waiting for a summary before downloads pause')
+    parser.add_argument('--download_timeout', default=DEFAULT_DOWNLOAD_TIMEOUT, type=int, help='Seconds without data before a download is abandoned')
+    parser.add_argument('--download_retries', default=DEFAULT_DOWNLOAD_RETRIES, type=int, help='Retries of a failed download')
+    parser.add_argument('--extra_metrics', default='', help=f'Comma separated extra columns, any of {",".join(xmlsummary_single.EXTRA_METRIC_HEADERS)}')
+    parser.add_argument('--route', action='store_true', help='Pick the cheapest backend per file with fallback, rows get a Backend column')
+    parser.add_argument('--msaccess_binary', default=None, help='With --route, msaccess is the last backend tried for every file')
+    parser.add_argument('--msaccess_timeout', default=msaccess_runner.DEFAULT_MSACCESS_TIMEOUT, type=int, help='Seconds before msaccess is killed for a single file')
+    args = parser.parse_args()
+
+    usis = read_usis(args.usi_file)
+    jobs, invalid_usis = plan_downloads(usis, args.url_template)
+    print("USIs", len(usis), "files", len(jobs), "invalid", len(invalid_usis))
+
+    os.makedirs(args.download_folder, exist_ok=True)
+    error_name = args.error_name if args.error_name is not None else os.path.splitext(args.result_file)[0] + "_errors.tsv"
+    pipeline = UsiPipeline(args.download_folder, args.result_file, error_name,
+                           ontology_file=args.ontology_file,
+                           parallelism=args.parallelism if args.parallelism is not None else msaccess_runner.available_cores(),
+                           download_parallelism=args.download_parallelism,
+                           queue_size=args.queue_size,
+                           download_timeout=args.download_timeout,
+                           download_retries=args.download_retries,
+                           extra_metrics=xmlsummary_single.parse_extra_metrics(args.extra_metrics),
+                           route={'msaccess_binary': args.msaccess_binary, 'msaccess_timeout': args.msaccess_timeout} if args.route else None,
+                           original_prefix=args.original_prefix,
+                           path_to_spectra=args.path_to_spectra,
+                           usi_summary_file=args.usi_summary)
+    try:
+        pipeline.write_invalid_usis(invalid_usis)
+        number_summarized, number_failed = pipeline.run(jobs)
+    finally:
+        pipeline.close()
+    print(f"Summarized {number_summarized} files, {number_failed} failed")
+
+if __name__ == "__main__":
+    main()
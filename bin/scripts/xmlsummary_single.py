@@ -1,14 +1,24 @@
 import argparse
+from collections import Counter
+from concurrent.futures.process import BrokenProcessPool
 from lxml import etree
-import obonet
-from pyteomics import mgf
-import networkx
 import csv
 import os
+import re
 import sys
 
+import backend_router
+import batch_summary
+import msaccess_runner
+import ontology_cache
+import perf_log
+import spectrum_io
+
 MAX_MS_LEVEL = 3
 
+# Bump whenever a change alters the summary rows, cached rows from other versions are then recomputed
+PARSER_VERSION = "3"
+
 HEADERS = ["Filename",
             "Original_Path",
             "Ion_Source",
@@ -19,94 +29,243 @@ HEADERS = ["Filename",
             "MS1s",
             "MS2s",
             "MS3+",   # Final entry should be f"MS{MAX_MS_LEVEL}+" (as for now must be hardcoded)
-            # "Pos_Scan_Count",   # TODO
-            # "Neg_Scan_Count",   # TODO
             ]
 
-def process_MGF(input_file, original_path, output_filename):
-    parsed_mgf = mgf.read(open(input_file, 'r'))
-    output_dictionary = {}
-    output_dictionary['Filename'] = os.path.basename(input_file)
-    output_dictionary['Original_Path'] = original_path
-    output_dictionary['Ion_Source'] = ''
-    output_dictionary['Mass_Analyzer'] = ''
-    output_dictionary['Mass_Detector'] = ''
-    output_dictionary['Model'] = ''
-    output_dictionary['Vendor'] = ''
-    
-    # Iterate over the scans and count the number of MS levels
-    ms_level_counts = [0 for _ in range(MAX_MS_LEVEL)]
-    for scan in parsed_mgf:
-        scan_ms_level = scan['params'].get('mslevel')
-        if scan_ms_level is None:
-            # TODO: Add an unknown ms level entry
-            continue
-        scan_ms_level = int(scan_ms_level)
-        if scan_ms_level >= MAX_MS_LEVEL:
-            ms_level_counts[MAX_MS_LEVEL-1] += 1
-        else:
-            ms_level_counts[scan_ms_level-1] += 1
-            
+############## Extra metrics ##################
+# Optional metrics collected in the same pass as the ms levels, metric -> columns appended to HEADERS
+EXTRA_METRIC_HEADERS = {'polarity': ["Pos_Scan_Count", "Neg_Scan_Count"],
+                        'rt': ["RT_Min", "RT_Max"],   # Retention time in seconds
+                        'total': ["Total_Scans"],
+                        'unknown': ["Unknown_MS_Level"]}   # Spectra without a (parsable) ms level
+# Metrics that need every spectrum to be parsed, the byte-offset index only yields ms levels
+PER_SPECTRUM_METRICS = ('polarity', 'rt')
+
+MZML_POSITIVE_SCAN = 'MS:1000130'
+MZML_NEGATIVE_SCAN = 'MS:1000129'
+MZML_SCAN_START_TIME = 'MS:1000016'
+MZML_MINUTE_UNITS = ('UO:0000031', 'minute')
+# xs:duration as used by the mzXML retentionTime attribute, e.g. PT1234.5S
+MZXML_RETENTION_TIME_PATTERN = re.compile(r'^-?P(?:\d+D)?T?(?:(\d+(?:\.\d*)?)H)?(?:(\d+(?:\.\d*)?)M)?(?:(\d+(?:\.\d*)?)S)?$')
+
+# Elements that the streaming parsers act on. Anything else is left to be freed along with its parent.
+MZML_STREAM_TAGS = ('{*}referenceableParamGroup', '{*}instrumentConfiguration', '{*}spectrumList', '{*}spectrum', '{*}chromatogram', '{*}offset')
+MZXML_STREAM_TAGS = ('{*}msInstrument', '{*}msRun', '{*}scan', '{*}offset')
+
+############## Byte-offset index support ##################
+# The index footer (indexListOffset / indexOffset) is always within the last few bytes of the file
+INDEX_FOOTER_BYTES = 4096
+# Number of bytes read at each spectrum/scan offset, extended up to INDEX_MAX_PEEK_BYTES if the ms level is not found
+INDEX_PEEK_BYTES = 512
+INDEX_MAX_PEEK_BYTES = 65536
+
+MZML_INDEX_FOOTER_PATTERN = re.compile(rb'<indexListOffset>\s*(\d+)\s*</indexListOffset>')
+MZML_INDEX_PATTERN = re.compile(rb'<index\s+name="spectrum"\s*>(.*?)</index>', re.DOTALL)
+# Matches the value of the ms level cvParam regardless of attribute order
+MZML_MS_LEVEL_PATTERN = re.compile(rb'<cvParam\b(?=[^>]*\b(?:accession="MS:1000511"|name="ms level"))[^>]*\bvalue="(\d+)"')
+
+MZXML_INDEX_FOOTER_PATTERN = re.compile(rb'<indexOffset>\s*(\d+)\s*</indexOffset>')
+MZXML_INDEX_PATTERN = re.compile(rb'<index\s+name="scan"\s*>(.*?)</index>', re.DOTALL)
+MZXML_MS_LEVEL_PATTERN = re.compile(rb'\bmsLevel="(\d+)"')
+
+# Where the ms level can no longer occur for the element at an offset: the end of the spectrum, its binary data, or
+# the start of the next spectrum (a spectrum without binary data may be followed by the next one within the window)
+MZML_SPECTRUM_END_PATTERN = re.compile(rb'</spectrum>|<binaryDataArrayList\b|<spectrum[\s>]')
+# msLevel is an attribute, so it has to be inside the scan start tag
+MZXML_SCAN_END_PATTERN = re.compile(rb'>')
+
+INDEX_OFFSET_PATTERN = re.compile(rb'<offset\b[^>]*>\s*(\d+)\s*</offset>')
+
+############## MGF scanning ##################
+MGF_READ_SIZE = 16 * 1024 * 1024
+# The only lines we need out of an MGF, peak lists are never parsed. Keys are case insensitive as in pyteomics.
+# Lines are anchored on the preceding newline, which is several times faster than a MULTILINE '^'.
+MGF_LINE_PATTERN = re.compile(rb'\n[ \t]*(?:(BEGIN IONS)|(END IONS)|[Mm][Ss][Ll][Ee][Vv][Ee][Ll]=[ \t]*(\S*))')
+# Only used when extra metrics are requested, so the default scan does not pay for the additional keys
+MGF_EXTRA_METRICS_LINE_PATTERN = re.compile(rb'\n[ \t]*(?:(BEGIN IONS)|(END IONS)|([A-Za-z_]+)=[ \t]*(\S*))')
+MGF_EXTRA_METRICS_KEYS = (b'MSLEVEL', b'RTINSECONDS', b'CHARGE', b'IONMODE')
+
+def _free_element(element):
+    """Clears an element once it has been handled and drops its already handled siblings,
+    which keeps memory flat while iterparsing regardless of file size.
+    """
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+def _parse_ms_level(ms_level):
+    """Converts an ms level attribute to an int, returning None when it is missing or malformed."""
+    try:
+        return int(ms_level)
+    except (TypeError, ValueError):
+        return None
+
+def _parse_mzML_ms_level(spectrum, referenceableParamGroupDict):
+    ms_level_element = spectrum.find("{*}cvParam[@name='ms level']")
+    if ms_level_element is not None:
+        return _parse_ms_level(ms_level_element.get('value'))
+    # Some writers move the ms level into a referenceableParamGroup
+    for group_ref in spectrum.findall("{*}referenceableParamGroupRef"):
+        ms_level = referenceableParamGroupDict.get(group_ref.get('ref'), {}).get('ms level')
+        if ms_level is not None:
+            return _parse_ms_level(ms_level)
+    return None
+
+def _fill_ms_level_counts(ms_level_counter, output_dictionary):
+    """Fills the MS level columns from a Counter of ms level -> number of spectra.
+
+    Spectra with an unknown ms level are counted under None, they are only reported with the 'unknown' extra metric.
+    """
     for mslevel in range(1,MAX_MS_LEVEL):
-        output_dictionary[f"MS{mslevel}s"] = ms_level_counts[mslevel-1]
-    output_dictionary[f"MS{MAX_MS_LEVEL}+"] = ms_level_counts[-1]
-    
+        output_dictionary[f"MS{mslevel}s"] = ms_level_counter[mslevel]
+    output_dictionary[f"MS{MAX_MS_LEVEL}+"] = sum(count for mslevel, count in ms_level_counter.items()
+                                                  if mslevel is not None and mslevel >= MAX_MS_LEVEL)
+
+def _fill_empty_ms_level_counts(output_dictionary):
+    """Leaves the MS level columns empty, for rows of a metadata only summary that did not count spectra."""
+    for mslevel in range(1,MAX_MS_LEVEL):
+        output_dictionary[f"MS{mslevel}s"] = ''
+    output_dictionary[f"MS{MAX_MS_LEVEL}+"] = ''
+
+def parse_extra_metrics(extra_metrics):
+    """Parses a comma separated list of extra metrics (e.g. 'polarity,rt') into a tuple in EXTRA_METRIC_HEADERS order."""
+    if not extra_metrics:
+        return ()
+    requested = {x.strip().lower() for x in extra_metrics.split(',') if x.strip() != ''}
+    unknown = requested - set(EXTRA_METRIC_HEADERS)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown extra metrics {sorted(unknown)}, supported are {list(EXTRA_METRIC_HEADERS)}")
+    return tuple(x for x in EXTRA_METRIC_HEADERS if x in requested)
+
+def output_headers(extra_metrics=(), route=False):
+    """Columns of the summary, routed summaries also name the backend of each row."""
+    headers = HEADERS + [header for metric in extra_metrics for header in EXTRA_METRIC_HEADERS[metric]]
+    return headers + [BACKEND_COLUMN] if route else headers
+
+class ExtraMetrics:
+    """Accumulates the selected extra metrics while the spectra are counted.
+
+    Parsers only look up polarity and retention time of a spectrum when the metric was requested,
+    Total_Scans and Unknown_MS_Level are derived from the ms level counts and cost nothing extra.
+
+    Args:
+        extra_metrics (tuple): Metrics from parse_extra_metrics
+    """
+    def __init__(self, extra_metrics):
+        self.extra_metrics = extra_metrics
+        self.polarity = 'polarity' in extra_metrics
+        self.rt = 'rt' in extra_metrics
+        self.polarity_counter = Counter()
+        self.rt_min = None
+        self.rt_max = None
+
+    @property
+    def per_spectrum(self):
+        return self.polarity or self.rt
+
+    def add_spectrum(self, polarity=None, rt_seconds=None):
+        """Adds a spectrum's polarity ('+', '-' or None when unspecified) and retention time in seconds (or None)."""
+        if polarity is not None:
+            self.polarity_counter[polarity] += 1
+        if rt_seconds is not None:
+            if self.rt_min is None or rt_seconds < self.rt_min:
+                self.rt_min = rt_seconds
+            if self.rt_max is None or rt_seconds > self.rt_max:
+                self.rt_max = rt_seconds
+
+    def fill(self, ms_level_counter, output_dictionary):
+        """Fills the extra metric columns, RT columns are left empty when no spectrum has a retention time."""
+        if self.polarity:
+            output_dictionary['Pos_Scan_Count'] = self.polarity_counter['+']
+            output_dictionary['Neg_Scan_Count'] = self.polarity_counter['-']
+        if self.rt:
+            output_dictionary['RT_Min'] = round(self.rt_min, 4) if self.rt_min is not None else ''
+            output_dictionary['RT_Max'] = round(self.rt_max, 4) if self.rt_max is not None else ''
+        if 'total' in self.extra_metrics:
+            output_dictionary['Total_Scans'] = sum(ms_level_counter.values())
+        if 'unknown' in self.extra_metrics:
+            output_dictionary['Unknown_MS_Level'] = ms_level_counter[None]
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _parse_mzML_polarity(spectrum, referenceableParamGroupDict):
+    if spectrum.find(f"{{*}}cvParam[@accession='{MZML_POSITIVE_SCAN}']") is not None:
+        return '+'
+    if spectrum.find(f"{{*}}cvParam[@accession='{MZML_NEGATIVE_SCAN}']") is not None:
+        return '-'
+    # Like the ms level, the polarity may be in a referenceableParamGroup
+    for group_ref in spectrum.findall("{*}referenceableParamGroupRef"):
+        group = referenceableParamGroupDict.get(group_ref.get('ref'), {})
+        if 'positive scan' in group:
+            return '+'
+        if 'negative scan' in group:
+            return '-'
+    return None
+
+def _parse_mzML_retention_time(spectrum):
+    """Scan start time of the first scan of a spectrum in seconds, or None."""
+    scan_start_time = spectrum.find(f"{{*}}scanList/{{*}}scan/{{*}}cvParam[@accession='{MZML_SCAN_START_TIME}']")
+    if scan_start_time is None:
+        return None
+    rt = _parse_float(scan_start_time.get('value'))
+    if rt is not None and (scan_start_time.get('unitAccession') in MZML_MINUTE_UNITS or scan_start_time.get('unitName') in MZML_MINUTE_UNITS):
+        rt *= 60
+    return rt
+
+def _parse_mzXML_retention_time(retention_time):
+    """Converts an mzXML retentionTime (xs:duration, e.g. PT1234.5S) to seconds, or None."""
+    match = MZXML_RETENTION_TIME_PATTERN.match(retention_time.strip()) if retention_time else None
+    if match is None or not any(match.groups()):
+        return None
+    hours, minutes, seconds = (float(x) if x else 0.0 for x in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+def _parse_mzXML_polarity(polarity):
+    return polarity if polarity in ('+', '-') else None
+
+def _parse_MGF_polarity(ion_mode, charge):
+    """Polarity of an MGF spectrum from IONMODE (e.g. positive), or else the sign of CHARGE (e.g. 2+). Unsigned charges are unspecified."""
+    if ion_mode:
+        ion_mode = ion_mode.lower()
+        if ion_mode.startswith(b'pos'):
+            return '+'
+        if ion_mode.startswith(b'neg'):
+            return '-'
+    if charge:
+        if charge.endswith(b'+') or charge.startswith(b'+'):
+            return '+'
+        if charge.endswith(b'-') or charge.startswith(b'-'):
+            return '-'
+    return None
+
+ERROR_HEADERS = ["Filename", "Original_Path", "Error"]
+# Column of routed rows naming the backend that produced the row
+BACKEND_COLUMN = "Backend"
+
+def _write_summary(output_dictionary, output_filename, extra_metrics=(), route=False):
     with open(output_filename, 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=HEADERS, delimiter='\t')
+        # Cached rows may carry a Backend column that unrouted summaries do not write
+        writer = csv.DictWriter(csvfile, fieldnames=output_headers(extra_metrics, route), delimiter='\t', extrasaction='ignore')
         writer.writeheader()
         writer.writerow(output_dictionary)
 
-def process_mzXML(input_file, original_path, output_filename):
-    lxml_tree = etree.parse(input_file)
-    output_dictionary = {}
-    output_dictionary['Filename'] = os.path.basename(input_file)
-    output_dictionary['Original_Path'] = original_path
-    
-    runs = lxml_tree.findall("//{*}msRun")
-    if len(runs) > 1:
-        raise NotImplementedError("Multiple runs not supported")
-    lxml_run = runs[0]
-    
-    ############## Parse Instrument Information ##################
-    instrument_configuration_list = lxml_run.findall('.//{*}msInstrument')
-    instrumentConfigurationDict = {}
-    
-    for config in instrument_configuration_list:
-        config_id = str(config.get('msInstrumentID'))
-        instrumentConfigurationDict[config_id] = {}
-        # Want: scan_precursor_analyzer, scan_precursor_ionization, scan_precursor_detector, scan_precursor_instrument_vendor, scan_precursor_model
-        # Get all lxml elements:
-        msAnalyzer      = config.findall('.//{*}msMassAnalyzer')
-        msIonization    = config.findall('.//{*}msIonisation')
-        msDetector      = config.findall('.//{*}msDetector')
-        msVendor        = config.findall('.//{*}msManufacturer')
-        msModel         = config.findall('.//{*}msModel')
-        
-        # Get names for each element:
-        msAnalyzer      = [x.get('value') for x in msAnalyzer]
-        msIonization    = [x.get('value') for x in msIonization]
-        msDetector      = [x.get('value') for x in msDetector]
-        msVendor        = [x.get('value') for x in msVendor]
-        msModel         = [x.get('value') for x in msModel]
-
-        if len(msIonization) > 0 :
-            instrumentConfigurationDict[config_id]['source']  = msIonization
-        if len(msAnalyzer) > 0 :
-            instrumentConfigurationDict[config_id]['analyzer'] = msAnalyzer
-        if len(msDetector) > 0 :
-            instrumentConfigurationDict[config_id]['detector'] = msDetector
-        if len(msVendor) == 1:
-            instrumentConfigurationDict[config_id]['vendor'] = [msVendor[0]]
-        if len(msVendor) > 1:
-            raise ValueError("Multiple instrument vendors not supported.")
-        if len(msModel) == 1:
-            instrumentConfigurationDict[config_id]['model'] = [msModel[0]]
-        elif len(msModel) > 1:
-            raise ValueError("Multiple instrument models not supported.")
-        
+def _join_instrument_configurations(instrumentConfigurationDict, output_dictionary):
+    """Joins the instrument columns of all configurations into output_dictionary.
+
+    For each field, we will seperate the instrument configurations by '|' and the components of each configuration by ;
+    This is probably best stored as a JSON, rather than a CSV, but this has downstream impact
+    """
+    # Join together each field within configuration by ';'
     for key in instrumentConfigurationDict.keys():
         for field in instrumentConfigurationDict[key].keys():
-            instrumentConfigurationDict[key][field] = ';'.join(instrumentConfigurationDict[key][field])
+            if instrumentConfigurationDict[key][field] is not None:
+                instrumentConfigurationDict[key][field] = [x for x in instrumentConfigurationDict[key][field] if x is not None]
+                instrumentConfigurationDict[key][field] = ';'.join(instrumentConfigurationDict[key][field])
+            else: 
+                 instrumentConfigurationDict[key][field] = ''
     # Join together each field by '|'. Note that the numner of '|' will be the same for each field, regardless of whether there is data
     output_dictionary['Ion_Source'] = '|'.join([instrumentConfigurationDict[x].get('source', '') for x in instrumentConfigurationDict.keys()])
     output_dictionary['Mass_Analyzer'] = '|'.join([instrumentConfigurationDict[x].get('analyzer', '') for x in instrumentConfigurationDict.keys()])
@@ -114,168 +273,605 @@ def process_mzXML(input_file, original_path, output_filename):
     output_dictionary['Model'] = '|'.join([instrumentConfigurationDict[x].get('model', '') for x in instrumentConfigurationDict.keys()])
     output_dictionary['Vendor'] = '|'.join([instrumentConfigurationDict[x].get('vendor', '') for x in instrumentConfigurationDict.keys()])
 
-    ############## Parse Spectrum Information ##################
-    all_spectra = lxml_run.findall('.//{*}scan')
-    all_ms_levels = [x.get('msLevel') for x in all_spectra] # List of ms levels as type str
-    # Get counts up to MS 9 and 10+
-    ms_level_counts = [all_ms_levels.count(str(x)) for x in range(1,10)] + [sum([int(x) > 9 for x in all_ms_levels])]
-    for mslevel in range(1,MAX_MS_LEVEL):
-        output_dictionary[f"MS{mslevel}s"] = ms_level_counts[mslevel-1]
-    output_dictionary[f"MS{MAX_MS_LEVEL}+"] = ms_level_counts[-1]
+def _parse_mzXML_instrument(config):
+    """Parses a single msInstrument element into a dict of field -> list of values."""
+    instrument = {}
+    # Want: scan_precursor_analyzer, scan_precursor_ionization, scan_precursor_detector, scan_precursor_instrument_vendor, scan_precursor_model
+    # Get all lxml elements:
+    msAnalyzer      = config.findall('.//{*}msMassAnalyzer')
+    msIonization    = config.findall('.//{*}msIonisation')
+    msDetector      = config.findall('.//{*}msDetector')
+    msVendor        = config.findall('.//{*}msManufacturer')
+    msModel         = config.findall('.//{*}msModel')
     
-    with open(output_filename, 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=HEADERS, delimiter='\t')
-        writer.writeheader()
-        writer.writerow(output_dictionary)
+    # Get names for each element:
+    msAnalyzer      = [x.get('value') for x in msAnalyzer]
+    msIonization    = [x.get('value') for x in msIonization]
+    msDetector      = [x.get('value') for x in msDetector]
+    msVendor        = [x.get('value') for x in msVendor]
+    msModel         = [x.get('value') for x in msModel]
+
+    if len(msIonization) > 0 :
+        instrument['source']  = msIonization
+    if len(msAnalyzer) > 0 :
+        instrument['analyzer'] = msAnalyzer
+    if len(msDetector) > 0 :
+        instrument['detector'] = msDetector
+    if len(msVendor) == 1:
+        instrument['vendor'] = [msVendor[0]]
+    if len(msVendor) > 1:
+        raise ValueError("Multiple instrument vendors not supported.")
+    if len(msModel) == 1:
+        instrument['model'] = [msModel[0]]
+    elif len(msModel) > 1:
+        raise ValueError("Multiple instrument models not supported.")
+    return instrument
+
+def _parse_mzML_instrument_configuration(config, referenceableParamGroupDict, model_names, instrument_vendor_names, input_file):
+    """Parses a single instrumentConfiguration element into a dict of field -> list of values."""
+    instrument = {}
+    ############## Looking for Model/Vendor ##################
+    #### Check if there is a referenceableParamGroupRef
+    # Will yield a list of dicts where each dict is cvParam_name: value
+    referencableParamGroupList = [referenceableParamGroupDict.get(x.get('ref'), {}) for x in config.findall(".//{*}referenceableParamGroupRef")]
+    
+    # Flatten
+    referencedParamNames = [item for sublist in referencableParamGroupList for item in sublist]
+    
+    #### Check accessions outside referenceableParamGroupRef
+    localParamNames = [x.get('name') for x in config.findall(".//{*}cvParam")]
+    
+    allParamNames = referencedParamNames + localParamNames
+    
+    #### Check for model/vendor
+    possible_instrument_models = [x for x in allParamNames if x in model_names]
+    possible_instrument_vendors = [x for x in allParamNames if x in instrument_vendor_names]
+    
+    # It appears that some software uses the old mzXML tagging in userParams
+    possible_instrument_models  += [x.get('value') for x in config.findall(".//{*}userParam[@name='msModel']")]
+    possible_instrument_vendors += [x.get('value') for x in config.findall(".//{*}userParam[@name='msManufacturer']")]
 
-def process_mzML(input_file, original_path, output_filename, ontology_file):
-    lxml_tree = etree.parse(input_file)
+    if len(possible_instrument_models) >= 1:
+        instrument['model'] = [possible_instrument_models[0]]
+    if len(possible_instrument_models) > 1:
+        print(f"Multiple instrument models not supported, taking the first for file {input_file}")
     
+    if len(possible_instrument_vendors) >= 1:
+        instrument['vendor'] = [possible_instrument_vendors[0]]
+    if len(possible_instrument_vendors) > 1:
+        print(f"Multiple instrument vendors not supported, taking the first for file {input_file}")
+    ##########################################################
+    componentList = config.find(".//{*}componentList")
+    if componentList is not None:
+        source = [x.get('name', '') for x in componentList.findall(".//{*}source//{*}cvParam")]
+        analyzer = [x.get('name', '') for x in componentList.findall(".//{*}analyzer//{*}cvParam")]
+        detector = [x.get('name', '') for x in componentList.findall(".//{*}detector//{*}cvParam")]
+        
+        # It appears that some software uses the old mzXML tagging in userParams
+        source   += [x.get('value', '') for x in componentList.findall(".//{*}source//{*}userParam[@name='msIonisation']")]
+        analyzer += [x.get('value', '') for x in componentList.findall(".//{*}analyzer//{*}userParam[@name='msMassAnalyzer']")]
+        detector += [x.get('value', '') for x in componentList.findall(".//{*}detector//{*}userParam[@name='msDetector']")]
+
+        if len(source) > 0 :
+            instrument['source'] = source
+        if len(analyzer) > 0 :
+            instrument['analyzer'] = analyzer
+        if len(detector) > 0 :
+            instrument['detector'] = detector
+    return instrument
+
+def _scan_MGF_blocks(input_file, scan):
+    """Calls scan on the raw bytes of an MGF in blocks of complete lines, each starting with the newline preceding its first line."""
+    # Every scanned buffer starts with the newline preceding its first line, including the first line of the file
+    remainder = b'\n'
+    with spectrum_io.open_spectrum_file(input_file) as mgf_file:
+        # MGF has no metadata to speak of, the whole scan counts spectra
+        perf_log.phase('spectrum_count')
+        while True:
+            block = mgf_file.read(MGF_READ_SIZE)
+            if not block:
+                break
+            # Only scan complete lines, the partial last line (with its leading newline) is carried into the next block
+            block = remainder + block
+            last_newline = block.rfind(b'\n')
+            scan(block[:last_newline])
+            remainder = block[last_newline:]
+    scan(remainder)
+
+def _scan_MGF_ms_levels(input_file, extra_metrics=None):
+    """Counts spectra per MSLEVEL by scanning the raw bytes of an MGF, without parsing any peaks.
+
+    Matches pyteomics semantics: an MSLEVEL before the first BEGIN IONS is a global parameter that applies
+    to every spectrum that does not set its own, and spectra without any MSLEVEL are counted under None.
+
+    Args:
+        extra_metrics (ExtraMetrics): Also collects polarity and RTINSECONDS per spectrum when requested
+
+    Returns:
+        Counter: ms level -> number of spectra
+    """
+    if extra_metrics is not None and extra_metrics.per_spectrum:
+        return _scan_MGF_extra_metrics(input_file, extra_metrics)
+
+    ms_level_counter = Counter()
+    header_ms_level = None
+    current_ms_level = None
+    in_spectrum = False
+
+    def scan(buffer):
+        nonlocal header_ms_level, current_ms_level, in_spectrum
+        for begin_ions, end_ions, ms_level in MGF_LINE_PATTERN.findall(buffer):
+            if begin_ions:
+                in_spectrum = True
+                current_ms_level = header_ms_level
+            elif end_ions:
+                if in_spectrum:
+                    ms_level_counter[current_ms_level] += 1
+                in_spectrum = False
+            elif in_spectrum:
+                current_ms_level = _parse_ms_level(ms_level)
+            else:
+                header_ms_level = _parse_ms_level(ms_level)
+
+    _scan_MGF_blocks(input_file, scan)
+    return ms_level_counter
+
+def _scan_MGF_extra_metrics(input_file, extra_metrics):
+    """Same as _scan_MGF_ms_levels, also reading MSLEVEL, RTINSECONDS, CHARGE and IONMODE of every spectrum.
+
+    As with MSLEVEL, keys before the first BEGIN IONS apply to every spectrum that does not set its own.
+    """
+    ms_level_counter = Counter()
+    header_params = {}
+    current_params = {}
+    in_spectrum = False
+
+    def scan(buffer):
+        nonlocal current_params, in_spectrum
+        for begin_ions, end_ions, key, value in MGF_EXTRA_METRICS_LINE_PATTERN.findall(buffer):
+            if begin_ions:
+                in_spectrum = True
+                current_params = dict(header_params)
+            elif end_ions:
+                if in_spectrum:
+                    ms_level_counter[_parse_ms_level(current_params.get(b'MSLEVEL'))] += 1
+                    extra_metrics.add_spectrum(
+                        _parse_MGF_polarity(current_params.get(b'IONMODE'), current_params.get(b'CHARGE')) if extra_metrics.polarity else None,
+                        _parse_float(current_params.get(b'RTINSECONDS')) if extra_metrics.rt else None)
+                in_spectrum = False
+            else:
+                key = key.upper()
+                if key in MGF_EXTRA_METRICS_KEYS:
+                    (current_params if in_spectrum else header_params)[key] = value
+
+    _scan_MGF_blocks(input_file, scan)
+    return ms_level_counter
+
+def process_MGF(input_file, original_path, extra_metrics=(), metadata_only=False):
+    metrics = ExtraMetrics(extra_metrics)
     output_dictionary = {}
     output_dictionary['Filename'] = os.path.basename(input_file)
     output_dictionary['Original_Path'] = original_path
+    output_dictionary['Ion_Source'] = ''
+    output_dictionary['Mass_Analyzer'] = ''
+    output_dictionary['Mass_Detector'] = ''
+    output_dictionary['Model'] = ''
+    output_dictionary['Vendor'] = ''
+
+    if metadata_only:
+        # MGF has no header with instrument metadata, so there is nothing to read beyond checking the file is there
+        perf_log.set_backend('mgf_header')
+        os.stat(input_file)
+        _fill_empty_ms_level_counts(output_dictionary)
+        return output_dictionary
     
-    ############## Parse Ontology Network ##################
-    graph = obonet.read_obo(str(ontology_file))
-    # Get all ids
-    model_ids = networkx.ancestors(graph, 'MS:1000031')
-    instrument_vendor_ids = ['MS:1001269'] # Seems that this is not always used
-   
-    # Convert to names
-    id_to_name = {id_: data.get('name') for id_, data in graph.nodes(data=True)}
-    model_names = [id_to_name[x] for x in model_ids]
-    instrument_vendor_names = [id_to_name[x] for x in instrument_vendor_ids]
-    
-    ############## Parse Instrument Information ##################
-    # Create a dictionary of the values contained in each referencable param group
-    referenceableParamGroupList = lxml_tree.findall(".//{*}referenceableParamGroupList//{*}referenceableParamGroup")
-    referenceableParamGroupDict = {}
-    for referenceableParamGroup in referenceableParamGroupList:
-        key = referenceableParamGroup.get('id')
-        referenceableParamGroupDict[key] = {}
-        for param in referenceableParamGroup:
-            referenceableParamGroupDict[key][param.get('name')] = param.get('value')
-    
-    instrument_configs = [x.findall(".//{*}instrumentConfiguration") for x in lxml_tree.findall("//{*}instrumentConfigurationList")]
-    # Flatten
-    instrument_configs = [item for sublist in instrument_configs for item in sublist]
+    perf_log.set_backend('mgf_scan')
+    ms_level_counter = _scan_MGF_ms_levels(input_file, metrics)
+
+    _fill_ms_level_counts(ms_level_counter, output_dictionary)
+    metrics.fill(ms_level_counter, output_dictionary)
+
+    return output_dictionary
+
+def _read_index_offsets(input_file, footer_pattern, index_pattern):
+    """Reads the byte offsets of every spectrum/scan from an indexedmzML or mzXML index.
 
+    Returns:
+        list: Byte offsets in index order, or None if the file has no usable index
+    """
+    file_size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as f:
+        f.seek(max(0, file_size - INDEX_FOOTER_BYTES))
+        footer_matches = footer_pattern.findall(f.read())
+        if len(footer_matches) == 0:
+            return None
+        index_offset = int(footer_matches[-1])
+        if index_offset >= file_size:
+            return None
+        f.seek(index_offset)
+        index_block = f.read(file_size - index_offset)
+
+    # The footer must point at the start of the index itself
+    if not index_block.lstrip().startswith(b'<index'):
+        return None
+    index_match = index_pattern.search(index_block)
+    if index_match is None:
+        return None
+    return [int(x) for x in INDEX_OFFSET_PATTERN.findall(index_match.group(1))]
+
+def _count_ms_levels_from_index(input_file, offsets, start_tag, end_pattern, ms_level_pattern):
+    """Seeks to each offset and reads only enough bytes around the start tag to find the ms level.
+
+    Args:
+        start_tag (bytes): Tag that every offset must point at, otherwise the index is considered corrupt
+        end_pattern (re.Pattern): End of the element, the ms level is only searched for before it
+        ms_level_pattern (re.Pattern): Pattern with the ms level as its first group
+
+    Returns:
+        Counter: ms level -> number of spectra, or None if any offset is invalid or its ms level is not found before
+        the end of its element within INDEX_MAX_PEEK_BYTES
+    """
+    ms_level_counter = Counter()
+    perf_log.phase('spectrum_count')
+    with open(input_file, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            window = f.read(INDEX_PEEK_BYTES)
+            element_start = len(window) - len(window.lstrip())
+            if not window.startswith(start_tag, element_start):
+                return None
+            # The end is searched for after the start tag, which would otherwise match as the next spectrum
+            body_start = element_start + len(start_tag)
+            while True:
+                end = end_pattern.search(window, body_start)
+                match = ms_level_pattern.search(window, body_start, end.start() if end is not None else len(window))
+                if match is not None or end is not None or len(window) >= INDEX_MAX_PEEK_BYTES:
+                    break
+                more = f.read(INDEX_PEEK_BYTES)
+                if not more:
+                    break
+                window += more
+            if match is None:
+                return None
+            ms_level_counter[int(match.group(1))] += 1
+    return ms_level_counter
+
+def _count_ms_levels_from_mzML_index(input_file, spectrum_count):
+    offsets = _read_index_offsets(input_file, MZML_INDEX_FOOTER_PATTERN, MZML_INDEX_PATTERN)
+    if offsets is None or spectrum_count is None or len(offsets) != spectrum_count:
+        return None
+    return _count_ms_levels_from_index(input_file, offsets, b'<spectrum', MZML_SPECTRUM_END_PATTERN, MZML_MS_LEVEL_PATTERN)
+
+def _count_ms_levels_from_mzXML_index(input_file, scan_count):
+    offsets = _read_index_offsets(input_file, MZXML_INDEX_FOOTER_PATTERN, MZXML_INDEX_PATTERN)
+    # scanCount is optional in mzXML, so only check it when it is present
+    if offsets is None or (scan_count is not None and len(offsets) != scan_count):
+        return None
+    return _count_ms_levels_from_index(input_file, offsets, b'<scan', MZXML_SCAN_END_PATTERN, MZXML_MS_LEVEL_PATTERN)
+
+def _walk_tree(element, localnames):
+    """Start and end events of the elements named localnames in document order, like iterparse over a parsed tree."""
+    matched = isinstance(element.tag, str) and etree.QName(element).localname in localnames
+    if matched:
+        yield 'start', element
+    # A copy of the children, handled elements are freed while the walk goes on
+    for child in list(element):
+        yield from _walk_tree(child, localnames)
+    if matched:
+        yield 'end', element
+
+def _parse_full_tree(input_file, tags):
+    """Parses the whole document with a recovering parser and yields the events of tags like _iterparse.
+
+    Malformed or truncated XML that stops iterparse is read up to where it breaks, at the memory cost of the whole tree.
+    """
+    parser = etree.XMLParser(recover=True, huge_tree=True)
+    with spectrum_io.open_spectrum_file(input_file) as spectrum_file:
+        root = etree.parse(spectrum_file, parser).getroot()
+    if root is None:
+        raise ValueError("No XML document")
+    yield from _walk_tree(root, {tag.split('}')[-1] for tag in tags})
+
+def _iterparse(input_file, tags, full_tree=False):
+    """Iterparses start and end events of tags, decompressing .gz/.bz2 files as a stream while they are parsed.
+
+    With full_tree, the whole document is parsed with a recovering parser instead (see _parse_full_tree).
+    """
+    if full_tree:
+        yield from _parse_full_tree(input_file, tags)
+        return
+    if spectrum_io.split_compression(input_file)[1] is None:
+        yield from etree.iterparse(input_file, events=('start', 'end'), tag=tags, huge_tree=True)
+        return
+    with spectrum_io.open_spectrum_file(input_file) as spectrum_file:
+        yield from etree.iterparse(spectrum_file, events=('start', 'end'), tag=tags, huge_tree=True)
+
+def _stream_mzXML(input_file, stop_at_first_scan=False, extra_metrics=None, full_tree=False):
+    """Iterparses an mzXML file, freeing each element as soon as it is handled.
+
+    With extra_metrics, the polarity and retention time of every scan are added to it as the scans are counted.
+
+    Returns:
+        tuple: (instrumentConfigurationDict, ms_level_counter, msRun scanCount or None)
+    """
     instrumentConfigurationDict = {}
+    ms_level_counter = Counter()
+    scan_count = None
+    number_of_runs = 0
+    counting_scans = False
 
-    for config in instrument_configs:
-        key = config.get('id')
-        instrumentConfigurationDict[key] = {}
-        ############## Looking for Model/Vendor ##################
-        #### Check if there is a referenceableParamGroupRef
-        # Will yield a list of dicts where each dict is cvParam_name: value
-        referencableParamGroupList = [referenceableParamGroupDict[x.get('ref')] for x in config.findall(".//{*}referenceableParamGroupRef")]
-        
-        referencedParamNames = [x.keys() for x in referencableParamGroupList]
-        # Flatten
-        referencedParamNames = [item for sublist in referencableParamGroupList for item in sublist]
-        
-        #### Check accessions outside referenceableParamGroupRef
-        localParamNames = [x.get('name') for x in config.findall(".//{*}cvParam")]
-        
-        allParamNames = referencedParamNames + localParamNames
-        
-        #### Check for model/vendor
-        possible_instrument_models = [x for x in allParamNames if x in model_names]
-        possible_instrument_vendors = [x for x in allParamNames if x in instrument_vendor_names]
-        
-        # It appears that some software uses the old mzXML tagging in userParams
-        possible_instrument_models  += [x.get('value') for x in config.findall(".//{*}userParam[@name='msModel']")]
-        possible_instrument_vendors += [x.get('value') for x in config.findall(".//{*}userParam[@name='msManufacturer']")]
+    perf_log.phase('metadata_parse')
+    for event, element in _iterparse(input_file, MZXML_STREAM_TAGS, full_tree=full_tree):
+        tag = etree.QName(element).localname
+        if event == 'start':
+            if tag == 'msRun':
+                number_of_runs += 1
+                if number_of_runs > 1:
+                    raise NotImplementedError("Multiple runs not supported")
+                scan_count = _parse_ms_level(element.get('scanCount'))
+            elif tag == 'scan' and not counting_scans:
+                if stop_at_first_scan:
+                    break
+                # The instrument precedes the scans, from here on the parse is counting spectra
+                counting_scans = True
+                perf_log.phase('spectrum_count')
+            continue
 
-        if len(possible_instrument_models) >= 1:
-            instrumentConfigurationDict[key]['model'] = [possible_instrument_models[0]]
-        if len(possible_instrument_models) > 1:
-            print(f"Multiple instrument models not supported, taking the first for file {input_file}")
-        
-        if len(possible_instrument_vendors) >= 1:
-            instrumentConfigurationDict[key]['vendor'] = [possible_instrument_vendors[0]]
-        if len(possible_instrument_vendors) > 1:
-            print(f"Multiple instrument vendors not supported, taking the first for file {input_file}")
-        ##########################################################
-        componentList = config.find(".//{*}componentList")
-        if componentList is not None:
-            source = [x.get('name', '') for x in componentList.findall(".//{*}source//{*}cvParam")]
-            analyzer = [x.get('name', '') for x in componentList.findall(".//{*}analyzer//{*}cvParam")]
-            detector = [x.get('name', '') for x in componentList.findall(".//{*}detector//{*}cvParam")]
-            
-            # It appears that some software uses the old mzXML tagging in userParams
-            source   += [x.get('value', '') for x in componentList.findall(".//{*}source//{*}userParam[@name='msIonisation']")]
-            analyzer += [x.get('value', '') for x in componentList.findall(".//{*}analyzer//{*}userParam[@name='msMassAnalyzer']")]
-            detector += [x.get('value', '') for x in componentList.findall(".//{*}detector//{*}userParam[@name='msDetector']")]
+        if tag == 'scan':
+            # Nested scans (e.g., MS2 within MS1) end before their parent, so each scan is counted exactly once
+            ms_level_counter[_parse_ms_level(element.get('msLevel'))] += 1
+            if extra_metrics is not None:
+                extra_metrics.add_spectrum(
+                    _parse_mzXML_polarity(element.get('polarity')) if extra_metrics.polarity else None,
+                    _parse_mzXML_retention_time(element.get('retentionTime')) if extra_metrics.rt else None)
+        elif tag == 'msInstrument':
+            ############## Parse Instrument Information ##################
+            instrumentConfigurationDict[str(element.get('msInstrumentID'))] = _parse_mzXML_instrument(element)
+        elif tag == 'msRun':
+            # Keep the run itself, it is our only handle on scanCount
+            continue
+        _free_element(element)
 
-        
-            if len(source) > 0 :
-                instrumentConfigurationDict[key]['source'] = source
-            if len(analyzer) > 0 :
-                instrumentConfigurationDict[key]['analyzer'] = analyzer
-            if len(detector) > 0 :
-                instrumentConfigurationDict[key]['detector'] = detector
+    return instrumentConfigurationDict, ms_level_counter, scan_count
 
-            
-    # For each field, we will seperate the instrument configurations by '|' and the components of each configuration by ;
-    # This is probably best stored as a JSON, rather than a CSV, but this has downstream impact
-    # Join together each field within configuration by ';'
-    for key in instrumentConfigurationDict.keys():
-        for field in instrumentConfigurationDict[key].keys():
-            print(instrumentConfigurationDict[key][field])
-            if instrumentConfigurationDict[key][field] is not None:
-                instrumentConfigurationDict[key][field] = [x for x in instrumentConfigurationDict[key][field] if x is not None]
-                instrumentConfigurationDict[key][field] = ';'.join(instrumentConfigurationDict[key][field])
-            else: 
-                 instrumentConfigurationDict[key][field] = ''
-    # Join together each field by '|'. Note that the numner of '|' will be the same for each field, regardless of whether there is data
-    output_dictionary['Ion_Source'] = '|'.join([instrumentConfigurationDict[x].get('source', '') for x in instrumentConfigurationDict.keys()])
-    output_dictionary['Mass_Analyzer'] = '|'.join([instrumentConfigurationDict[x].get('analyzer', '') for x in instrumentConfigurationDict.keys()])
-    output_dictionary['Mass_Detector'] = '|'.join([instrumentConfigurationDict[x].get('detector', '') for x in instrumentConfigurationDict.keys()])
-    output_dictionary['Model'] = '|'.join([instrumentConfigurationDict[x].get('model', '') for x in instrumentConfigurationDict.keys()])
-    output_dictionary['Vendor'] = '|'.join([instrumentConfigurationDict[x].get('vendor', '') for x in instrumentConfigurationDict.keys()])
+def _stream_mzML(input_file, model_names, instrument_vendor_names, stop_at_spectrum_list=False, extra_metrics=None, full_tree=False):
+    """Iterparses an mzML file, freeing each element as soon as it is handled.
+
+    The referenceableParamGroupList and instrumentConfigurationList precede the run,
+    so each element can be parsed and freed as soon as its end tag is seen.
+    With extra_metrics, the polarity and retention time of every spectrum are added to it as the spectra are counted.
+
+    Returns:
+        tuple: (instrumentConfigurationDict, ms_level_counter, spectrumList count or None)
+    """
+    referenceableParamGroupDict = {}
+    instrumentConfigurationDict = {}
+    ms_level_counter = Counter()
+    spectrum_count = None
+
+    perf_log.phase('metadata_parse')
+    for event, element in _iterparse(input_file, MZML_STREAM_TAGS, full_tree=full_tree):
+        tag = etree.QName(element).localname
+        if event == 'start':
+            if tag == 'spectrumList':
+                spectrum_count = _parse_ms_level(element.get('count'))
+                if stop_at_spectrum_list:
+                    break
+                perf_log.phase('spectrum_count')
+            continue
+
+        if tag == 'spectrum':
+            ############## Parse Spectrum Information ##################
+            ms_level_counter[_parse_mzML_ms_level(element, referenceableParamGroupDict)] += 1
+            if extra_metrics is not None:
+                extra_metrics.add_spectrum(
+                    _parse_mzML_polarity(element, referenceableParamGroupDict) if extra_metrics.polarity else None,
+                    _parse_mzML_retention_time(element) if extra_metrics.rt else None)
+        elif tag == 'referenceableParamGroup':
+            # Create a dictionary of the values contained in each referencable param group
+            key = element.get('id')
+            referenceableParamGroupDict[key] = {}
+            for param in element:
+                referenceableParamGroupDict[key][param.get('name')] = param.get('value')
+        elif tag == 'instrumentConfiguration':
+            ############## Parse Instrument Information ##################
+            instrumentConfigurationDict[element.get('id')] = _parse_mzML_instrument_configuration(element,
+                                                                                                 referenceableParamGroupDict,
+                                                                                                 model_names,
+                                                                                                 instrument_vendor_names,
+                                                                                                 input_file)
+        elif tag == 'spectrumList':
+            continue
+        # Chromatograms and index offsets are only freed, they carry nothing we summarize
+        _free_element(element)
+
+    return instrumentConfigurationDict, ms_level_counter, spectrum_count
+
+def process_mzXML(input_file, original_path, use_index=False, extra_metrics=(), require_index=False, metadata_only=False, full_tree=False):
+    metrics = ExtraMetrics(extra_metrics)
+    output_dictionary = {}
+    output_dictionary['Filename'] = os.path.basename(input_file)
+    output_dictionary['Original_Path'] = original_path
+
+    if metadata_only:
+        # The instruments precede the scans, nothing after the first scan is read
+        perf_log.set_backend('xml_header')
+        instrumentConfigurationDict, _, _ = _stream_mzXML(input_file, stop_at_first_scan=True)
+        _join_instrument_configurations(instrumentConfigurationDict, output_dictionary)
+        _fill_empty_ms_level_counts(output_dictionary)
+        return output_dictionary
+
+    ms_level_counter = None
+    # The index only yields ms levels, polarity and retention time need the full parse
+    if use_index and not metrics.per_spectrum:
+        # Only read the header, then seek to every scan using the index
+        instrumentConfigurationDict, _, scan_count = _stream_mzXML(input_file, stop_at_first_scan=True)
+        ms_level_counter = _count_ms_levels_from_mzXML_index(input_file, scan_count)
+        if ms_level_counter is None and require_index:
+            raise ValueError("No usable scan index")
+        if ms_level_counter is None:
+            print(f"No usable scan index for file {input_file}, falling back to full parse")
+    if ms_level_counter is None:
+        perf_log.set_backend('xml_full' if full_tree else 'xml_stream')
+        instrumentConfigurationDict, ms_level_counter, _ = _stream_mzXML(input_file, extra_metrics=metrics if metrics.per_spectrum else None,
+                                                                         full_tree=full_tree)
+    else:
+        perf_log.set_backend('xml_index')
+
+    _join_instrument_configurations(instrumentConfigurationDict, output_dictionary)
+
+    ############## Parse Spectrum Information ##################
+    _fill_ms_level_counts(ms_level_counter, output_dictionary)
+    metrics.fill(ms_level_counter, output_dictionary)
+
+    return output_dictionary
+
+def process_mzML(input_file, original_path, ontology_file, use_index=False, extra_metrics=(), require_index=False, metadata_only=False,
+                 full_tree=False):
+    metrics = ExtraMetrics(extra_metrics)
+    output_dictionary = {}
+    output_dictionary['Filename'] = os.path.basename(input_file)
+    output_dictionary['Original_Path'] = original_path
     
+    ############## Parse Ontology Network ##################
+    # Compiled once per ontology and cached per process, membership checks are against frozensets
+    ontology = ontology_cache.load_ontology(ontology_file)
+    model_names = ontology.model_names
+    instrument_vendor_names = ontology.vendor_names
+
+    if metadata_only:
+        # The instrument configurations precede the run, nothing after the start of the spectrumList is read
+        perf_log.set_backend('xml_header')
+        instrumentConfigurationDict, _, _ = _stream_mzML(input_file, model_names, instrument_vendor_names,
+                                                         stop_at_spectrum_list=True)
+        _join_instrument_configurations(instrumentConfigurationDict, output_dictionary)
+        _fill_empty_ms_level_counts(output_dictionary)
+        return output_dictionary
+
+    ms_level_counter = None
+    # The index only yields ms levels, polarity and retention time need the full parse
+    if use_index and not metrics.per_spectrum:
+        # Only read up to the spectrumList, then seek to every spectrum using the index
+        instrumentConfigurationDict, _, spectrum_count = _stream_mzML(input_file, model_names, instrument_vendor_names,
+                                                                      stop_at_spectrum_list=True)
+        ms_level_counter = _count_ms_levels_from_mzML_index(input_file, spectrum_count)
+        if ms_level_counter is None and require_index:
+            raise ValueError("No usable spectrum index")
+        if ms_level_counter is None:
+            print(f"No usable spectrum index for file {input_file}, falling back to full parse")
+    if ms_level_counter is None:
+        perf_log.set_backend('xml_full' if full_tree else 'xml_stream')
+        instrumentConfigurationDict, ms_level_counter, _ = _stream_mzML(input_file, model_names, instrument_vendor_names,
+                                                                      extra_metrics=metrics if metrics.per_spectrum else None,
+                                                                      full_tree=full_tree)
+    else:
+        perf_log.set_backend('xml_index')
+
+    _join_instrument_configurations(instrumentConfigurationDict, output_dictionary)
+
     ############## Parse Spectrum Information ##################
-    all_spectra = lxml_tree.findall("//{*}spectrum")
-    all_ms_level_elements = [x.findall(".//{*}cvParam[@name='ms level']") for x in all_spectra]
-    # Flatten
-    all_ms_level_elements = [item for sublist in all_ms_level_elements for item in sublist]
-    # Remove Nones
-    all_ms_level_elements = [x for x in all_ms_level_elements if x is not None]
-    all_ms_levels = [x.get('value') for x in all_ms_level_elements] # List of ms levels as type str
-    # Get counts up to MS 9 and 10+
-    ms_level_counts = [all_ms_levels.count(str(x)) for x in range(1,10)] + [sum([int(x) > 9 for x in all_ms_levels])]
-    for mslevel in range(1,MAX_MS_LEVEL):
-        output_dictionary[f"MS{mslevel}s"] = ms_level_counts[mslevel-1]
-    output_dictionary[f"MS{MAX_MS_LEVEL}+"] = ms_level_counts[-1]
+    _fill_ms_level_counts(ms_level_counter, output_dictionary)
+    metrics.fill(ms_level_counter, output_dictionary)
 
-    with open(output_filename, 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=HEADERS, delimiter='\t')
-        writer.writeheader()
-        writer.writerow(output_dictionary)
+    return output_dictionary
+
+def summarize_file(input_file, original_path, ontology_file=None, use_index=False, extra_metrics=(), require_index=False,
+                   metadata_only=False, full_tree=False):
+    """Summarizes a single mzML, mzXML, or MGF file, which may be gzip or bzip2 compressed.
+
+    Args:
+        extra_metrics (tuple): Extra metrics from parse_extra_metrics, collected in the same pass
+        require_index (bool): With use_index, raise a ValueError instead of falling back to a full parse when there is no usable index
+        metadata_only (bool): Only read the header up to the first spectrum and leave the MS level columns (and extra
+            metrics) empty, so the time taken depends on the header rather than the file size
+        full_tree (bool): Parse mzML/mzXML as a whole document with a recovering parser rather than streaming it, for
+            files the streaming parse rejects
+
+    Returns:
+        dict: Summary row keyed by output_headers(extra_metrics), or None if the filetype is not supported
+    """
+    file_format, compression = spectrum_io.spectrum_format(input_file)
+    if compression is not None:
+        # Index offsets point into the uncompressed stream, seeking to them would decompress the whole file anyway
+        use_index = False
+
+    if file_format == 'mzML':
+        return process_mzML(input_file, original_path, ontology_file, use_index=use_index, extra_metrics=extra_metrics,
+                            require_index=require_index, metadata_only=metadata_only, full_tree=full_tree)
+    elif file_format == 'mzXML':
+        return process_mzXML(input_file, original_path, use_index=use_index, extra_metrics=extra_metrics, require_index=require_index,
+                             metadata_only=metadata_only, full_tree=full_tree)
+    elif file_format == 'mgf':
+        return process_MGF(input_file, original_path, extra_metrics=extra_metrics, metadata_only=metadata_only)
+    return None
 
 def process_file(command_line_args):
-    """Processes an mzML, mzXML, or MGF file and summarizes all scans in a CSV file.
+    """Processes an mzML, mzXML, or MGF file (optionally .gz or .bz2) and summarizes all scans in a CSV file.
 
     Args:
         command_line_args (Namespace): Command line arguments form main
-            should contain input_spectrum_file, original_path, result_file, and obo_file (only for mzML)
+            should contain input_spectrum_file, original_path, result_file, obo_file (only for mzML), use_index,
+            cache_db/fingerprint for the persistent result cache, perf_log for per-file instrumentation,
+            extra_metrics (comma separated) for the optional columns, metadata_only to only read the header, and route/msaccess_binary/msaccess_timeout
+            to pick the backend per file with fallback
             
     """
     input_file = command_line_args.input_spectrum_file
     original_path = command_line_args.original_path
     output_filename = command_line_args.result_file
-    
-    if input_file.endswith(".mzML"):
-        ontology_file = command_line_args.ontology_file
-        process_mzML(input_file, original_path, output_filename, ontology_file)
-    elif input_file.endswith(".mzXML"):
-        process_mzXML(input_file, original_path, output_filename)
-    elif input_file.endswith(".mgf"):
-        process_MGF(input_file, original_path, output_filename)
-    else:
-        print(f"Unknown filetype for file {original_path}")
-        sys.exit()  # Exit cleanly so we don't show errors in nextflow for this
+
+    if command_line_args.perf_log is None:
+        _process_file(command_line_args, input_file, original_path, output_filename)
+        return
+
+    perf_record = perf_log.begin(input_file, original_path)
+    try:
+        _process_file(command_line_args, input_file, original_path, output_filename)
+    except Exception as any_exception:
+        perf_record.error = f"{type(any_exception).__name__}: {any_exception}"
+        raise
+    finally:
+        perf_log.write_records(command_line_args.perf_log, [perf_log.end()])
+
+def _process_file(command_line_args, input_file, original_path, output_filename):
+    extra_metrics = parse_extra_metrics(command_line_args.extra_metrics)
+    cache = None
+    output_dictionary = None
+    # Without an original path the file is cached under the path it was read from
+    cache_key = original_path if original_path is not None else input_file
+    if command_line_args.cache_db is not None:
+        cache = batch_summary.open_result_cache(command_line_args.cache_db, command_line_args.ontology_file, command_line_args.fingerprint,
+                                                extra_metrics=extra_metrics, metadata_only=command_line_args.metadata_only)
+        output_dictionary = cache.lookup(cache_key, stat_path=input_file)
+        if output_dictionary is not None:
+            perf_log.set_backend('cache')
+            output_dictionary = batch_summary._retarget_row(output_dictionary, input_file, original_path)
+
+    if output_dictionary is None and command_line_args.route:
+        output_dictionary, error = backend_router.summarize_routed(input_file, original_path,
+                                                                   ontology_file=command_line_args.ontology_file,
+                                                                   extra_metrics=extra_metrics,
+                                                                   msaccess_binary=command_line_args.msaccess_binary,
+                                                                   msaccess_timeout=command_line_args.msaccess_timeout,
+                                                                   metadata_only=command_line_args.metadata_only)
+        if output_dictionary is None:
+            raise ValueError(error)
+        if cache is not None:
+            cache.store(cache_key, output_dictionary, output_dictionary[BACKEND_COLUMN], stat_path=input_file)
+    elif output_dictionary is None:
+        output_dictionary = summarize_file(input_file, original_path,
+                                           ontology_file=command_line_args.ontology_file,
+                                           use_index=command_line_args.use_index,
+                                           extra_metrics=extra_metrics,
+                                           metadata_only=command_line_args.metadata_only)
+        if output_dictionary is None:
+            print(f"Unknown filetype for file {original_path}")
+            sys.exit()  # Exit cleanly so we don't show errors in nextflow for this
+        if cache is not None:
+            cache.store(cache_key, output_dictionary, 'xml', stat_path=input_file)
+
+    perf_log.phase('write')
+    _write_summary(output_dictionary, output_filename, extra_metrics, command_line_args.route)
 
 
 def main():
@@ -283,18 +879,54 @@ def main():
     parser.add_argument('--input_spectrum_file', help='input_spectrum_file')
     parser.add_argument('--original_path', help='original_path')
     parser.add_argument('--result_file', help='result_file')
-    parser.add_argument('--ontology_file', default=None, help='obo_file')
-    parser.add_argument('--error_name', default=None, help='File path for error file')
+    parser.add_argument('--ontology_file', default=None, help='psi-ms.obo or its compiled lookup from ontology_cache.py')
+    parser.add_argument('--error_name', default=None, help='Error table (TSV of Filename, Original_Path, Error), in batch mode with a row per failed file')
+    parser.add_argument('--use_index', action='store_true', help='Count ms levels by seeking through the indexedmzML/mzXML byte-offset index, falling back to a full parse if it is missing or corrupt')
+    parser.add_argument('--manifest', default=None, help='Batch mode: TSV with path and original_path columns, all files are summarized into result_file')
+    parser.add_argument('--parallelism', default=1, type=int, help='Batch mode: number of worker processes')
+    parser.add_argument('--cache_db', default=None, help='SQLite result cache, unchanged files are not summarized again')
+    parser.add_argument('--fingerprint', action='store_true', help='Also match cached files by content fingerprint so identical files under different paths are summarized once')
+    parser.add_argument('--perf_log', default=None, help='Append per-file timings per phase, bytes read, and peak RSS to this JSON lines file')
+    parser.add_argument('--extra_metrics', default='', help=f'Comma separated extra columns collected in the same pass, any of {",".join(EXTRA_METRIC_HEADERS)}. polarity and rt parse every spectrum, so the index is not used for them')
+    parser.add_argument('--metadata_only', action='store_true', help='Only read the header up to the spectrumList (mzML) or first scan (mzXML) for the instrument columns, the MS level columns are left empty')
+    parser.add_argument('--route', action='store_true', help='Pick the cheapest backend per file (xml_index, xml_stream, xml_full, mgf_scan, msaccess) and fall back to the next one on failure, rows get a Backend column')
+    parser.add_argument('--msaccess_binary', default=None, help='With --route, msaccess is the last backend tried for every file')
+    parser.add_argument('--msaccess_timeout', default=msaccess_runner.DEFAULT_MSACCESS_TIMEOUT, type=int, help='Seconds before msaccess is killed for a single file')
     args = parser.parse_args()
 
+    if args.metadata_only and args.extra_metrics:
+        parser.error("--extra_metrics need every spectrum, they cannot be combined with --metadata_only")
+
+    if args.manifest is not None:
+        error_name = args.error_name if args.error_name is not None else os.path.splitext(args.result_file)[0] + "_errors.tsv"
+        try:
+            batch_summary.process_batch(args.manifest, args.result_file, error_name,
+                                        ontology_file=args.ontology_file,
+                                        use_index=args.use_index,
+                                        parallelism=args.parallelism,
+                                        cache_db=args.cache_db,
+                                        use_fingerprint=args.fingerprint,
+                                        perf_log_file=args.perf_log,
+                                        extra_metrics=parse_extra_metrics(args.extra_metrics),
+                                        route={'msaccess_binary': args.msaccess_binary, 'msaccess_timeout': args.msaccess_timeout} if args.route else None,
+                                        metadata_only=args.metadata_only)
+        except BrokenProcessPool as broken_pool:
+            # Exits like a task killed for its memory, so the workflow retries the batch with more
+            print(f"A worker was killed, likely out of memory: {broken_pool}", file=sys.stderr)
+            sys.exit(batch_summary.WORKER_KILLED_EXIT_CODE)
+        return
+
     try:
         process_file(args)
     except Exception as any_exception:
         if args.error_name is None:
             raise any_exception
-        with open(args.error_name, 'w') as f:
-            f.write("Error processing file: {args.input}")
-            f.write(str(any_exception))
+        with open(args.error_name, 'w', newline='') as f:
+            error_writer = csv.DictWriter(f, fieldnames=ERROR_HEADERS, delimiter='\t')
+            error_writer.writeheader()
+            error_writer.writerow({'Filename': os.path.basename(args.input_spectrum_file),
+                                   'Original_Path': args.original_path,
+                                   'Error': f"{type(any_exception).__name__}: {any_exception}"})
             
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
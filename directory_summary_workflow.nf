@@ -4,6 +4,45 @@ nextflow.enable.dsl=2
 params.input_spectra = "./data"
 
 params.xml_parse = false
+// Files are dispatched largest first, packed into xml_summary_batch tasks of up to this many files or GB (a larger file
+// is a task of its own). Tasks of several files use up to xml_batch_cpus cores, memory is estimated from the file sizes
+params.xml_batch_size = 200
+params.xml_batch_gb = 2
+params.xml_batch_cpus = 4
+
+// File discovery: files smaller than this many bytes are skipped, and how symlinks are treated (none, files, or all, see discover_files.py)
+params.min_file_size = 0
+params.discover_symlinks = "files"
+
+// Files passed to a single msaccess invocation by filesummary_folder, a batch that fails is split until the failing file runs on its own
+params.msaccess_batch_size = 16
+
+// Persistent SQLite result cache (absolute path), empty disables it. Unchanged files of this run are not summarized again,
+// their cached rows are reused. SQLite locking is unreliable on network filesystems (NFS, Lustre), so the cache must be
+// on a local filesystem of the node every task runs on, e.g. with the local executor
+params.cache_db = ""
+params.cache_fingerprint = false
+
+// Also write merged_results_parquet/, a Parquet copy of merged_results.tsv partitioned by top-level dataset folder
+params.parquet_output = false
+
+// Persistent SQLite rollup database (absolute path on a shared filesystem), empty disables it. The merge adds the new
+// and changed files of this run to it and writes its rollup tables (per dataset, vendor, model, instrument class and month) to merged_rollups/.
+// Runs with --metadata_only have no counts, they leave the rollups untouched
+params.rollup_db = ""
+
+// Write per-file perf records (phase timings, bytes read, peak RSS) and aggregate them into nf_output/perf_report.json
+params.perf_log = false
+
+// Comma separated extra columns collected by the xml parser in the same pass, any of polarity, rt, total, unknown (xml_parse only)
+params.extra_metrics = ""
+
+// Instrument census: only read the header of each file for the instrument columns and leave the MS level columns empty
+// (xml_parse only, cannot be combined with extra_metrics)
+params.metadata_only = false
+
+// xml_parse picks the cheapest backend per file and falls back to the next one on failure, msaccess is the last resort when enabled
+params.msaccess_fallback = true
 
 // Workflow Boiler Plate
 params.OMETALINKING_YAML = "flow_filelinking.yaml"
@@ -15,7 +54,7 @@ params.cache_directory = "data/cache"
 
 TOOL_FOLDER = "$baseDir/bin"
 
-include {xml_summary} from './nf_workflow.nf'
+include {xml_summary_batch} from './nf_workflow.nf'
 include {collect_obonet} from './nf_workflow.nf'
 
 // downloading all the files
@@ -47,6 +86,50 @@ process prepInputFiles {
     """
 }
 
+// Walks params.input_spectra once and lists every spectrum file with its size, mtime and format
+process discoverFiles {
+    publishDir "./nf_output", mode: 'copy'
+
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    // The tree may have changed since the last run, unchanged files still resume their summaries
+    cache false
+
+    output:
+    path 'file_manifest.tsv'
+
+    """
+    python $TOOL_FOLDER/scripts/discover_files.py \
+    "${file(params.input_spectra)}" \
+    file_manifest.tsv \
+    --min_size $params.min_file_size \
+    --symlinks $params.discover_symlinks
+    """
+}
+
+// Packs the manifest into batches for xml_summary_batch, in dispatch order with the cores and memory of each batch
+process scheduleBatches {
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    input:
+    path file_manifest
+
+    output:
+    path 'batch_index.tsv', emit: index
+    path 'batches/*.tsv', emit: batches
+
+    """
+    python $TOOL_FOLDER/scripts/schedule_batches.py \
+    $file_manifest \
+    batches \
+    batch_index.tsv \
+    --batch_gb $params.xml_batch_gb \
+    --batch_files $params.xml_batch_size \
+    --max_cpus $params.xml_batch_cpus \
+    ${params.metadata_only ? "--metadata_only" : ""}
+    """
+}
+
 process listInputFiles {
 
     conda "$TOOL_FOLDER/conda_env.yml"
@@ -80,13 +163,17 @@ process filesummary_folder {
     output:
     file 'merged_results.tsv' optional true
 
+    script:
+    def cache_args = params.cache_db ? "--cache_db \"${params.cache_db}\"" + (params.cache_fingerprint ? " --fingerprint" : "") : ""
     """
     python $TOOL_FOLDER/scripts/filesummary.py \
     "$input_folder" \
     merged_results.tsv \
     $TOOL_FOLDER/binaries/msaccess \
     --parallelism 24 \
-    --usi_folder "$input_usi_folder"
+    --batch_size $params.msaccess_batch_size \
+    --usi_folder "$input_usi_folder" \
+    $cache_args
     """
 }
 
@@ -122,12 +209,18 @@ process filesummary_single {
     val ready
 
     output:
-    file 'summaryresult.tsv'
+    file 'summaryresult.tsv', emit: summaries
+    path 'perf.jsonl', optional true, emit: perf
 
+    script:
+    def perf_args = params.perf_log ? "--perf_log perf.jsonl" : ""
+    def cache_args = params.cache_db ? "--cache_db \"${params.cache_db}\"" + (params.cache_fingerprint ? " --fingerprint" : "") : ""
     """
     python $TOOL_FOLDER/scripts/filesummary.py \
     $inputSpectra summaryresult.tsv \
-    $TOOL_FOLDER/binaries/msaccess
+    $TOOL_FOLDER/binaries/msaccess \
+    $perf_args \
+    $cache_args
     """
 }
 
@@ -159,28 +252,71 @@ process mergeResults {
 
     output:
     path 'merged_results.tsv'
+    path 'merged_results_parquet', optional true
+    path 'merged_rollups', optional true
 
+    script:
+    def parquet_args = params.parquet_output ? "--parquet_output merged_results_parquet" : ""
+    def rollup_args = (params.rollup_db && !params.metadata_only) ? "--rollup_db \"${params.rollup_db}\" --rollup_output merged_rollups" : ""
     """
     python $TOOL_FOLDER/scripts/tsv_merger.py \
     results \
-    merged_results.tsv
+    merged_results.tsv \
+    --dataset_root "${file(params.input_spectra)}" \
+    $parquet_args \
+    $rollup_args
+    """
+}
+
+// Aggregates the per-file perf records of all tasks into a report of slow files, throughput per format, and memory outliers
+process perfReport {
+    publishDir "./nf_output", mode: 'copy'
+
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    input:
+    path 'perf.jsonl', stageAs: './perf/perf_???????.jsonl'
+
+    output:
+    path 'perf_report.json'
+
+    """
+    python $TOOL_FOLDER/scripts/perf_report.py \
+    perf \
+    perf_report.json
     """
 }
 
 
 workflow {
-    mzML_ch = Channel.fromPath(params.input_spectra + "/**/*.mzML")
-    mzXML_ch = Channel.fromPath(params.input_spectra + "/**/*.mzXML")
-    input_spectra_ch = mzML_ch.concat(mzXML_ch)
+    if (params.metadata_only && !params.xml_parse) {
+        error "--metadata_only needs the xml parser (--xml_parse true)"
+    }
+
+    // mzML, mzXML, and MGF files in any letter case, also when gzip or bzip2 compressed (they are decompressed as a stream)
+    file_manifest = discoverFiles()
     // Create tuple of file, value
-    input_spectra_ch = input_spectra_ch.map { [it, it.toString()] }
+    input_spectra_ch = file_manifest.splitCsv(header: true, sep: '\t').map { [file(it.path), it.path] }
 
     // File summaries
     if (params.xml_parse) {
-        ontology_file = collect_obonet()   
-        all_summaries_ch = xml_summary(input_spectra_ch, ontology_file)
+        ontology_file = collect_obonet()
+        // Batches of [batch manifest, cpus, memory in MB], longest running first. The index names the batch manifests,
+        // which are staged as outputs of scheduleBatches (a single batch is emitted as a path rather than a list)
+        scheduleBatches(file_manifest)
+        batch_files_ch = scheduleBatches.out.batches.map { batches -> (batches instanceof List ? batches : [batches]).collectEntries { [it.name, it] } }
+        batched_spectra_ch = scheduleBatches.out.index.splitCsv(header: true, sep: '\t')
+                                                      .combine(batch_files_ch)
+                                                      .map { batch, batch_files -> [batch_files[batch.batch], batch.cpus, batch.memory_mb] }
+        xml_summary_batch(batched_spectra_ch, ontology_file)
+        all_summaries_ch = xml_summary_batch.out.summaries
+        // Files that failed every backend, with the error of each backend
+        xml_summary_batch.out.errors.collectFile(name: 'summary_errors.tsv', keepHeader: true, skip: 1, storeDir: './nf_output')
+        perf_ch = xml_summary_batch.out.perf
     } else {
-        all_summaries_ch = filesummary_single(true, input_spectra_ch)
+        filesummary_single(input_spectra_ch.map { it[0] }, true)
+        all_summaries_ch = filesummary_single.out.summaries
+        perf_ch = filesummary_single.out.perf
     }
 
     // Merging together
@@ -188,4 +324,8 @@ workflow {
        
     // Collect all the batched results and merge them at the end
     merged_results = mergeResults(chunked_results.collect())
+
+    if (params.perf_log) {
+        perfReport(perf_ch.collect())
+    }
 }
\ No newline at end of file
@@ -11,8 +11,53 @@ params.OMETAPARAM_YAML = "job_parameters.yaml"
 params.download_usi_filename = params.OMETAPARAM_YAML // This can be changed if you want to run locally
 params.cache_directory = "data/cache"
 
+// Pipelined USI mode: each USI file is summarized as soon as its download completes instead of after all downloads,
+// and every row carries its USI. usi_url_template is the download URL of a USI with {usi}, {dataset} and {file} replaced,
+// by default the endpoint download_public_data_usi.py resolves USIs with
+params.pipelined_usi = false
+params.usi_url_template = ""
+
+// PSI-MS ontology, the pinned copy in bin/ontology avoids downloading it at run time. If the file does not exist the latest release is downloaded.
+params.obo_file = "$baseDir/bin/ontology/psi-ms.obo"
+
+// Persistent SQLite result cache (absolute path), empty disables it. SQLite locking is unreliable on network filesystems
+// (NFS, Lustre), so the cache must be on a local filesystem of the node every task runs on, e.g. with the local executor
+params.cache_db = ""
+params.cache_fingerprint = false
+
+// msaccess summaries are split into shards of about equal size, each summarized by one task sized to a node
+params.shards = 8
+params.shard_cpus = 24
+// Files passed to a single msaccess invocation, which amortizes its startup over small files. A batch that fails is split until the failing file runs on its own
+params.msaccess_batch_size = 16
+// Shared directory for the checkpoint journals of the shards, a restarted shard skips the files it already finished. Empty disables them
+params.checkpoint_dir = ""
+
+// Write per-file perf records (phase timings, bytes read, peak RSS) and aggregate them into nf_output/perf_report.json
+params.perf_log = false
+
+// Comma separated extra columns collected by the xml parser in the same pass, any of polarity, rt, total, unknown. Empty for the default columns only
+params.extra_metrics = ""
+
+// Only read the header of each file for the instrument columns, the MS level columns are left empty
+params.metadata_only = false
+
+// The xml parser picks the cheapest backend per file and falls back to the next one on failure, with msaccess
+// ($baseDir/bin/binaries/msaccess, if present) as the last resort for files that no xml backend can read
+params.msaccess_fallback = true
+
 TOOL_FOLDER = "$baseDir/bin"
 
+// Exit codes of tasks killed for exceeding their memory (kernel OOM killer and SGE/LSF memory limits). 143 (SIGTERM)
+// is left out, it is also how walltime limits and cancelled jobs end, and retrying those would only repeat them
+OOM_EXIT_CODES = [137, 140]
+
+// Arguments of xmlsummary_single.py for picking the backend per file, msaccess is only added when the binary is deployed
+def routeArgs() {
+    def msaccess_binary = file("$TOOL_FOLDER/binaries/msaccess")
+    return "--route" + ((params.msaccess_fallback && msaccess_binary.exists()) ? " --msaccess_binary $msaccess_binary" : "")
+}
+
 // downloading all the files
 process prepInputFiles {
     publishDir "$params.input_spectra", mode: 'copyNoFollow' // Warning, this is kind of a hack, it'll copy files back to the input folder
@@ -42,6 +87,45 @@ process prepInputFiles {
     """
 }
 
+// Downloads the USIs and summarizes each file as soon as its download is complete, with the USI in every row
+process usiPipeline {
+    publishDir "./nf_output", mode: 'copy', pattern: '*.tsv'
+    publishDir "$params.input_spectra", mode: 'copyNoFollow', pattern: 'usi_{downloads,summary.tsv}'
+
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    cpus params.shard_cpus
+
+    input:
+    file input_parameters
+    path ontology_file
+
+    output:
+    path 'summaryresult_with_usi.tsv'
+    path 'summary_errors.tsv'
+    path 'usi_downloads'
+    path 'usi_summary.tsv'
+
+    script:
+    def extra_metrics_args = params.extra_metrics ? "--extra_metrics ${params.extra_metrics}" : ""
+    def url_template_args = params.usi_url_template ? "--url_template \"${params.usi_url_template}\"" : ""
+    """
+    python $TOOL_FOLDER/scripts/usi_pipeline.py \
+    $input_parameters \
+    usi_downloads \
+    summaryresult_with_usi.tsv \
+    --error_name summary_errors.tsv \
+    --usi_summary usi_summary.tsv \
+    --original_prefix "${file(params.input_spectra)}/usi_downloads" \
+    --path_to_spectra "${file(params.input_spectra)}" \
+    --ontology_file $ontology_file \
+    --parallelism $task.cpus \
+    ${routeArgs()} \
+    $url_template_args \
+    $extra_metrics_args
+    """
+}
+
 process listInputFiles {
 
     conda "$TOOL_FOLDER/conda_env.yml"
@@ -75,13 +159,76 @@ process filesummary_folder {
     output:
     file 'merged_results.tsv' optional true
 
+    script:
+    def cache_args = params.cache_db ? "--cache_db \"${params.cache_db}\"" + (params.cache_fingerprint ? " --fingerprint" : "") : ""
     """
     python $TOOL_FOLDER/scripts/filesummary.py \
     "$input_folder" \
     merged_results.tsv \
     $TOOL_FOLDER/binaries/msaccess \
     --parallelism 24 \
+    --batch_size $params.msaccess_batch_size \
+    --usi_folder "$input_usi_folder" \
+    $cache_args
+    """
+}
+
+// Lists the input spectra and the USI downloads once and splits them into shards of about equal size
+process shardInputFiles {
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    // The tree may have changed since the last run, unchanged shards still resume
+    cache false
+
+    input:
+    val ready_flag
+    file input_usi_folder
+
+    output:
+    path 'shards/shard_*.tsv'
+
+    """
+    python $TOOL_FOLDER/scripts/discover_files.py \
+    "${file(params.input_spectra)}" \
+    file_manifest.tsv \
     --usi_folder "$input_usi_folder"
+
+    python $TOOL_FOLDER/scripts/shard_manifest.py \
+    file_manifest.tsv \
+    shards \
+    --shards $params.shards
+    """
+}
+
+// Summarizes one shard with msaccess, appending every summarized file to the shard's checkpoint journal
+process filesummary_shard {
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    cache "lenient"
+
+    cpus params.shard_cpus
+
+    input:
+    path shard_manifest
+
+    output:
+    path 'shard_summary.tsv'
+
+    script:
+    def cache_args = params.cache_db ? "--cache_db \"${params.cache_db}\"" + (params.cache_fingerprint ? " --fingerprint" : "") : ""
+    def journal_args = params.checkpoint_dir ? "--journal \"${params.checkpoint_dir}/${shard_manifest.baseName}.journal.jsonl\"" : ""
+    def make_checkpoint_dir = params.checkpoint_dir ? "mkdir -p \"${params.checkpoint_dir}\"" : ""
+    """
+    $make_checkpoint_dir
+    python $TOOL_FOLDER/scripts/filesummary.py \
+    "${file(params.input_spectra)}" \
+    shard_summary.tsv \
+    $TOOL_FOLDER/binaries/msaccess \
+    --manifest $shard_manifest \
+    --parallelism $task.cpus \
+    --batch_size $params.msaccess_batch_size \
+    $cache_args \
+    $journal_args
     """
 }
 
@@ -93,7 +240,7 @@ process includeUSI {
     input:
     file input_summary
     file usi_summary
-    file input_spectra
+    val input_spectra
 
     output:
     file 'summaryresult_with_usi.tsv'
@@ -102,7 +249,7 @@ process includeUSI {
     python $TOOL_FOLDER/scripts/add_usi.py \
     $input_summary \
     $usi_summary \
-    $input_spectra \
+    "$input_spectra" \
     summaryresult_with_usi.tsv
     """
 }
@@ -126,44 +273,108 @@ process filesummary_single {
     """
 }
 
-// Collect ontology file for parsing mzML files 
+// Collect ontology file for parsing mzML files and compile it into a lookup that every summary task loads directly
 process collect_obonet {
+    conda "$TOOL_FOLDER/conda_env.yml"
+
     cache 'lenient'
     memory '4 GB'
     output:
-    path "psi-ms.obo"
-
-    """
-    wget https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo
-    """
+    path "psi-ms.compiled.json"
+
+    script:
+    def local_obo = file(params.obo_file)
+    if (local_obo.exists())
+        """
+        cp "$local_obo" psi-ms.obo
+        python $TOOL_FOLDER/scripts/ontology_cache.py psi-ms.obo psi-ms.compiled.json
+        """
+    else
+        """
+        wget https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo
+        python $TOOL_FOLDER/scripts/ontology_cache.py psi-ms.obo psi-ms.compiled.json
+        """
 }
 
 process xml_summary {
     conda "$TOOL_FOLDER/conda_env.yml"
 
-    errorStrategy 'ignore'
-
     cache 'lenient'
 
+    // Memory from the file size, retried with more memory when the task is killed for exceeding it. Files that fail are
+    // already rows of the error table, so any other failure of the task is a crash that fails the run (after the running
+    // tasks finish) rather than files silently missing from the merged results
     cpus 1
-    memory '3906 MB'
+    memory { "${((768 + 256 * input_spectrum_file.size() / 1e9) * task.attempt) as long} MB" }
+    errorStrategy { task.exitStatus in OOM_EXIT_CODES ? 'retry' : 'finish' }
+    maxRetries 3
 
     input:
     tuple file(input_spectrum_file), val(relative_path)
     path(ontology_file)
 
     output:
-    file 'summaryresult.tsv' optional true
+    path 'summaryresult.tsv', optional true, emit: summaries
+    path 'summary_errors.tsv', optional true, emit: errors // Only written when every backend failed
 
+    script:
+    def extra_metrics_args = params.extra_metrics ? "--extra_metrics ${params.extra_metrics}" : ""
+    def metadata_only_args = params.metadata_only ? "--metadata_only" : ""
     """
     python $TOOL_FOLDER/scripts/xmlsummary_single.py \
     --input_spectrum_file $input_spectrum_file \
     --original_path "$relative_path" \
     --result_file summaryresult.tsv \
-    --ontology_file $ontology_file
+    --error_name summary_errors.tsv \
+    --ontology_file $ontology_file \
+    ${routeArgs()} \
+    $extra_metrics_args \
+    $metadata_only_args
     """    
 }
 
+// Summarizes a batch of files in one task so interpreter startup and ontology loading are paid once per batch.
+// Batches come from schedule_batches.py with their cores and memory, files are read in place from the batch manifest
+process xml_summary_batch {
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    cache 'lenient'
+
+    // Retried with more memory when the task is killed for exceeding its estimate, any other failure fails the run like xml_summary
+    cpus { batch_cpus as int }
+    memory { "${(batch_memory_mb as long) * task.attempt} MB" }
+    errorStrategy { task.exitStatus in OOM_EXIT_CODES ? 'retry' : 'finish' }
+    maxRetries 3
+
+    input:
+    tuple path(batch_manifest), val(batch_cpus), val(batch_memory_mb)
+    path(ontology_file)
+
+    output:
+    path 'summaryresult.tsv', emit: summaries
+    path 'summary_errors.tsv', emit: errors
+    path 'perf.jsonl', optional true, emit: perf
+
+    script:
+    def cache_args = params.cache_db ? "--cache_db \"${params.cache_db}\"" + (params.cache_fingerprint ? " --fingerprint" : "") : ""
+    def perf_args = params.perf_log ? "--perf_log perf.jsonl" : ""
+    def extra_metrics_args = params.extra_metrics ? "--extra_metrics ${params.extra_metrics}" : ""
+    def metadata_only_args = params.metadata_only ? "--metadata_only" : ""
+    """
+    python $TOOL_FOLDER/scripts/xmlsummary_single.py \
+    --manifest $batch_manifest \
+    --result_file summaryresult.tsv \
+    --error_name summary_errors.tsv \
+    --ontology_file $ontology_file \
+    --parallelism $task.cpus \
+    $cache_args \
+    $perf_args \
+    ${routeArgs()} \
+    $extra_metrics_args \
+    $metadata_only_args
+    """
+}
+
 process chunkResults {
     conda "$TOOL_FOLDER/conda_env.yml"
 
@@ -202,14 +413,21 @@ process mergeResults {
 
 
 workflow {
-    // Downloads input data
-    (_download_ready, _usi_downloads_ch, _usi_summary_ch) = prepInputFiles(Channel.fromPath(params.download_usi_filename), Channel.fromPath(params.cache_directory))
-
-    // Doing it on everything
-    _summary_results_ch = filesummary_folder(Channel.fromPath(params.input_spectra), _usi_downloads_ch, _download_ready)
-
-    // Enriching with USI
-    _results_with_usi_ch = includeUSI(_summary_results_ch, _usi_summary_ch, Channel.fromPath(params.input_spectra))
+    if (params.pipelined_usi) {
+        // Downloads and summaries overlap, and rows already carry their USI so there is no includeUSI join
+        usiPipeline(Channel.fromPath(params.download_usi_filename), collect_obonet())
+    } else {
+        // Downloads input data
+        (_download_ready, _usi_downloads_ch, _usi_summary_ch) = prepInputFiles(Channel.fromPath(params.download_usi_filename), Channel.fromPath(params.cache_directory))
+
+        // Doing it on everything, one task per shard and gathered by the streaming merge
+        _shards_ch = shardInputFiles(_download_ready, _usi_downloads_ch).flatten()
+        _shard_summaries_ch = filesummary_shard(_shards_ch)
+        _summary_results_ch = mergeResults(_shard_summaries_ch.collect())
+
+        // Enriching with USI, summaries name files by their absolute path
+        _results_with_usi_ch = includeUSI(_summary_results_ch, _usi_summary_ch, file(params.input_spectra).toString())
+    }
 
     // Below we tried doing it in parallel, but its got problems with the USI downloads
 
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The scripts import their siblings directly, as they do when run from bin/scripts
+sys.path.insert(0, os.path.join(REPO_FOLDER, "bin", "scripts"))
+sys.path.insert(0, os.path.join(REPO_FOLDER, "benchmarks"))
+
+# Pinned PSI-MS ontology, see params.obo_file
+OBO_FILE = os.path.join(REPO_FOLDER, "bin", "ontology", "psi-ms.obo")
+
+@pytest.fixture(scope="session", autouse=True)
+def cache_home(tmp_path_factory):
+    """Compiled ontologies go to a cache folder of the test session, not the home folder (see ontology_cache.cache_folder)."""
+    previous = os.environ.get("XDG_CACHE_HOME")
+    os.environ["XDG_CACHE_HOME"] = str(tmp_path_factory.mktemp("cache"))
+    yield os.environ["XDG_CACHE_HOME"]
+    if previous is None:
+        del os.environ["XDG_CACHE_HOME"]
+    else:
+        os.environ["XDG_CACHE_HOME"] = previous
@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import REPO_FOLDER
+
+ADD_USI = os.path.join(REPO_FOLDER, "bin", "scripts", "add_usi.py")
+
+def _add_usi(tmp_path, summary_text, usi_summary_text):
+    (tmp_path / "summary.tsv").write_text(summary_text)
+    (tmp_path / "usi_summary.tsv").write_text(usi_summary_text)
+    subprocess.run([sys.executable, ADD_USI, str(tmp_path / "summary.tsv"), str(tmp_path / "usi_summary.tsv"), "/spectra",
+                    str(tmp_path / "output.tsv")], check=True, capture_output=True)
+    return (tmp_path / "output.tsv").read_text().splitlines()
+
+@pytest.mark.parametrize("usi_summary_text", ["usi\ttarget_path\nmzspec:MSV1:a.mzML\tusi_downloads/MSV1/a.mzML\n", ""])
+@pytest.mark.parametrize("summary_text, header", [
+    ("Filename\tVendor\tMS1s\n", "Filename\tVendor\tMS1s\tfilename\tusi\ttarget_path"),
+    ("", "Filename\tfilename\tusi\ttarget_path"),
+])
+def test_summary_without_rows_keeps_the_usi_columns(tmp_path, summary_text, header, usi_summary_text):
+    assert _add_usi(tmp_path, summary_text, usi_summary_text) == [header]
+
+def test_empty_usi_summary_leaves_the_usi_columns_empty(tmp_path):
+    output_lines = _add_usi(tmp_path, "Filename\tVendor\n/spectra/usi_downloads/MSV1/a.mzML\tThermo\n", "")
+
+    assert output_lines == ["Filename\tVendor\tfilename\tusi\ttarget_path",
+                            "/spectra/usi_downloads/MSV1/a.mzML\tThermo\tusi_downloads/MSV1/a.mzML\t\t"]
@@ -0,0 +1,65 @@
+import shutil
+
+import pytest
+
+import backend_router
+import synthetic_corpus
+from conftest import OBO_FILE
+
+@pytest.fixture(scope="module")
+def ontology_file(tmp_path_factory):
+    ontology_file = tmp_path_factory.mktemp("ontology") / "psi-ms.obo"
+    shutil.copyfile(OBO_FILE, ontology_file)
+    return str(ontology_file)
+
+def _truncated_copy(input_file, output_file, fraction):
+    with open(input_file, 'rb') as f:
+        data = f.read()
+    with open(output_file, 'wb') as f:
+        f.write(data[:int(len(data) * fraction)])
+
+def test_plan_has_full_xml_between_streaming_and_msaccess(tmp_path):
+    input_file = str(tmp_path / "run.mzML")
+    synthetic_corpus.write_mzML(input_file, num_spectra=6, peaks_per_spectrum=2, indexed=False)
+
+    assert backend_router.plan_backends(input_file, msaccess_binary="msaccess") == ['xml_stream', 'xml_full', 'msaccess']
+    assert backend_router.plan_backends(str(tmp_path / "run.mgf"), msaccess_binary="msaccess") == ['mgf_scan', 'msaccess']
+
+def test_metadata_only_plans_header_backends_without_msaccess(tmp_path):
+    for filename, backends in [("run.mzML", ['xml_header']), ("run.mzXML.gz", ['xml_header']), ("run.mgf", ['mgf_header']), ("run.raw", [])]:
+        assert backend_router.plan_backends(str(tmp_path / filename), msaccess_binary="msaccess", metadata_only=True) == backends
+
+def test_metadata_only_summary_is_routed_to_the_header(tmp_path, ontology_file):
+    input_file = str(tmp_path / "run.mzML")
+    synthetic_corpus.write_mzML(input_file, num_spectra=6, peaks_per_spectrum=2, indexed=True)
+
+    output_dictionary, error = backend_router.summarize_routed(input_file, input_file, ontology_file=ontology_file,
+                                                               msaccess_binary="msaccess", metadata_only=True)
+
+    assert error is None
+    assert output_dictionary['Backend'] == 'xml_header'
+    assert output_dictionary['Model'] != '' and output_dictionary['MS1s'] == ''
+
+@pytest.mark.parametrize("filename, writer", [("run.mzML", synthetic_corpus.write_mzML), ("run.mzXML", synthetic_corpus.write_mzXML)])
+def test_truncated_file_falls_back_to_full_xml(tmp_path, ontology_file, filename, writer):
+    complete_file = str(tmp_path / ("complete_" + filename))
+    writer(complete_file, num_spectra=60, peaks_per_spectrum=5, indexed=False, ms2_per_ms1=5)
+    input_file = str(tmp_path / filename)
+    _truncated_copy(complete_file, input_file, 0.5)
+
+    output_dictionary, error = backend_router.summarize_routed(input_file, input_file, ontology_file=ontology_file)
+
+    assert error is None
+    assert output_dictionary['Backend'] == 'xml_full'
+    # The spectra before the cut are counted
+    assert 0 < output_dictionary['MS1s'] + output_dictionary['MS2s'] < 60
+    assert output_dictionary['Model'] != ''
+
+def test_file_no_backend_reads_lists_every_backend(tmp_path, ontology_file):
+    input_file = tmp_path / "broken.mzML"
+    input_file.write_bytes(b"\x00\x01 not xml at all")
+
+    output_dictionary, error = backend_router.summarize_routed(str(input_file), str(input_file), ontology_file=ontology_file)
+
+    assert output_dictionary is None
+    assert error.startswith("xml_stream: ") and "; xml_full: " in error
@@ -0,0 +1,69 @@
+import csv
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import batch_summary
+import synthetic_corpus
+
+def _kill_worker(batch_entry):
+    # Stands in for a worker killed by the OOM killer
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def _write_manifest(tmp_path, spectrum_files):
+    manifest_file = str(tmp_path / "manifest.tsv")
+    with open(manifest_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(["path", "original_path"])
+        for spectrum_file in spectrum_files:
+            writer.writerow([spectrum_file, "dataset/" + os.path.basename(spectrum_file)])
+    return manifest_file
+
+def _read_tsv(tsv_file):
+    with open(tsv_file, newline='') as f:
+        return list(csv.DictReader(f, delimiter='\t'))
+
+def test_batch_writes_rows_and_errors(tmp_path):
+    spectrum_files = []
+    for name in ["a.mgf", "b.mgf"]:
+        spectrum_files.append(str(tmp_path / name))
+        synthetic_corpus.write_MGF(spectrum_files[-1], num_spectra=12, peaks_per_spectrum=2, ms2_per_ms1=5)
+    broken_file = tmp_path / "broken.mzXML"
+    broken_file.write_text("<mzXML><msRun><scan")
+    manifest_file = _write_manifest(tmp_path, spectrum_files + [str(broken_file)])
+
+    number_summarized, number_failed = batch_summary.process_batch(manifest_file, str(tmp_path / "summary.tsv"), str(tmp_path / "errors.tsv"),
+                                                                   parallelism=2)
+
+    assert (number_summarized, number_failed) == (2, 1)
+    rows = _read_tsv(tmp_path / "summary.tsv")
+    assert [(row['Original_Path'], row['MS1s'], row['MS2s']) for row in rows] == [("dataset/a.mgf", "2", "10"), ("dataset/b.mgf", "2", "10")]
+    assert [row['Original_Path'] for row in _read_tsv(tmp_path / "errors.tsv")] == ["dataset/broken.mzXML"]
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason="The stub entry reaches the workers by forking")
+def test_killed_worker_ends_the_batch(tmp_path, monkeypatch):
+    spectrum_files = []
+    for name in ["a.mgf", "b.mgf", "c.mgf"]:
+        spectrum_files.append(str(tmp_path / name))
+        synthetic_corpus.write_MGF(spectrum_files[-1], num_spectra=6, peaks_per_spectrum=2)
+    manifest_file = _write_manifest(tmp_path, spectrum_files)
+    monkeypatch.setattr(batch_summary, "_summarize_batch_entry", _kill_worker)
+
+    outcome = {}
+    def run_batch():
+        try:
+            batch_summary.process_batch(manifest_file, str(tmp_path / "summary.tsv"), str(tmp_path / "errors.tsv"), parallelism=2)
+        except BrokenProcessPool as broken_pool:
+            outcome['error'] = broken_pool
+    batch_thread = threading.Thread(target=run_batch, daemon=True)
+    batch_thread.start()
+    batch_thread.join(timeout=60)
+
+    # The batch fails rather than waiting forever for the entry the killed worker held
+    assert not batch_thread.is_alive()
+    assert isinstance(outcome.get('error'), BrokenProcessPool)
+    assert not os.path.exists(tmp_path / "summary.tsv")
@@ -0,0 +1,92 @@
+import os
+import subprocess
+import sys
+
+import discover_files
+from conftest import REPO_FOLDER
+
+DISCOVER_FILES = os.path.join(REPO_FOLDER, "bin", "scripts", "discover_files.py")
+
+def _write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"0" * size)
+
+def _tree(tmp_path):
+    spectra_folder = tmp_path / "spectra"
+    _write(str(spectra_folder / "MSV1" / "a.mzML"), 100)
+    _write(str(spectra_folder / "MSV1" / "peak" / "b.mzXML.gz"), 200)
+    _write(str(spectra_folder / "MSV2" / "c.MGF"), 10)
+    _write(str(spectra_folder / "MSV2" / "notes.txt"), 100)
+    _write(str(spectra_folder / "MSV2" / "d.raw"), 100)
+    return spectra_folder
+
+def _relative_paths(entries, folder):
+    return sorted(os.path.relpath(entry["path"], str(folder)) for entry in entries)
+
+def test_discovers_spectrum_files_with_their_format(tmp_path):
+    spectra_folder = _tree(tmp_path)
+    stats = discover_files.DiscoveryStats()
+
+    entries = list(discover_files.discover_spectrum_files([str(spectra_folder)], parallelism=2, stats=stats))
+
+    assert _relative_paths(entries, spectra_folder) == ["MSV1/a.mzML", "MSV1/peak/b.mzXML.gz", "MSV2/c.MGF"]
+    assert {os.path.basename(entry["path"]): (entry["format"], entry["size"]) for entry in entries} == \
+        {"a.mzML": ("mzML", 100), "b.mzXML.gz": ("mzXML.gz", 200), "c.MGF": ("mgf", 10)}
+    assert all(entry["original_path"] == entry["path"] for entry in entries)
+    assert (stats.directories, stats.matched) == (4, 3)
+
+def test_format_and_size_filters(tmp_path):
+    spectra_folder = _tree(tmp_path)
+
+    entries = discover_files.discover_spectrum_files([str(spectra_folder)], formats=discover_files._parse_formats("mzml,MGF"))
+    assert _relative_paths(entries, spectra_folder) == ["MSV1/a.mzML", "MSV2/c.MGF"]
+
+    stats = discover_files.DiscoveryStats()
+    entries = discover_files.discover_spectrum_files([str(spectra_folder)], min_size=50, max_size=150, stats=stats)
+    assert _relative_paths(entries, spectra_folder) == ["MSV1/a.mzML"]
+    assert stats.skipped_size == 2
+
+def test_symlink_policies(tmp_path):
+    spectra_folder = _tree(tmp_path)
+    os.symlink(str(spectra_folder / "MSV1" / "a.mzML"), str(spectra_folder / "MSV2" / "linked.mzML"))
+    # A symlinked directory, and a loop back to the root
+    os.symlink(str(spectra_folder / "MSV1"), str(spectra_folder / "MSV2" / "linked_dataset"))
+    os.symlink(str(spectra_folder), str(spectra_folder / "MSV1" / "peak" / "loop"))
+    # A broken symlink is counted as an error, not raised
+    os.symlink(str(tmp_path / "missing.mzML"), str(spectra_folder / "MSV2" / "broken.mzML"))
+
+    def discover(symlinks):
+        return _relative_paths(discover_files.discover_spectrum_files([str(spectra_folder)], symlinks=symlinks), spectra_folder)
+
+    assert discover("none") == ["MSV1/a.mzML", "MSV1/peak/b.mzXML.gz", "MSV2/c.MGF"]
+    assert discover("files") == ["MSV1/a.mzML", "MSV1/peak/b.mzXML.gz", "MSV2/c.MGF", "MSV2/linked.mzML"]
+    # Every directory is walked once, through whichever path is listed first
+    all_entries = discover("all")
+    assert len(all_entries) == 4
+    assert sorted(os.path.basename(path) for path in all_entries) == ["a.mzML", "b.mzXML.gz", "c.MGF", "linked.mzML"]
+
+def test_downloads_are_reported_under_their_published_path(tmp_path):
+    spectra_folder = _tree(tmp_path)
+    usi_folder = tmp_path / "usi_downloads"
+    _write(str(usi_folder / "MSV3" / "e.mzML"), 100)
+    # A published copy of the same download that is already in the spectra folder
+    _write(str(spectra_folder / "usi_downloads" / "MSV3" / "e.mzML"), 100)
+
+    entries = discover_files.discover_with_downloads(str(spectra_folder), str(usi_folder))
+
+    assert [os.path.relpath(entry["path"], str(tmp_path)) for entry in entries if entry["path"] != entry["original_path"]] == ["usi_downloads/MSV3/e.mzML"]
+    assert _relative_paths([{"path": entry["original_path"]} for entry in entries], spectra_folder) == \
+        ["MSV1/a.mzML", "MSV1/peak/b.mzXML.gz", "MSV2/c.MGF", "usi_downloads/MSV3/e.mzML"]
+
+def test_manifest_is_sorted_and_round_trips(tmp_path):
+    spectra_folder = _tree(tmp_path)
+    manifest_file = str(tmp_path / "manifest.tsv")
+
+    subprocess.run([sys.executable, DISCOVER_FILES, str(spectra_folder), manifest_file, "--parallelism", "2"], check=True, capture_output=True)
+
+    entries = discover_files.read_manifest(manifest_file)
+    assert [os.path.relpath(entry["path"], str(spectra_folder)) for entry in entries] == ["MSV1/a.mzML", "MSV1/peak/b.mzXML.gz", "MSV2/c.MGF"]
+    assert entries[0]["size"] == 100 and isinstance(entries[0]["mtime"], float)
+    # Paths listed twice are written once
+    assert discover_files.write_manifest(entries + entries[:1], manifest_file) == 3
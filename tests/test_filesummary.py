@@ -0,0 +1,57 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+
+import filesummary
+import synthetic_corpus
+from conftest import REPO_FOLDER
+
+FILESUMMARY = os.path.join(REPO_FOLDER, "bin", "scripts", "filesummary.py")
+FAKE_MSACCESS = os.path.join(REPO_FOLDER, "benchmarks", "fake_msaccess.py")
+
+def _run_filesummary(spectra_folder, result_file, journal_file, perf_log_file, env):
+    subprocess.run([sys.executable, FILESUMMARY, spectra_folder, result_file, FAKE_MSACCESS,
+                    "--timeout", "1", "--journal", journal_file, "--perf_log", perf_log_file],
+                   check=True, env=env, stdout=subprocess.DEVNULL)
+    with open(result_file, newline="") as f:
+        rows = {os.path.basename(row["Filename"]): row for row in csv.DictReader(f, delimiter="\t")}
+    with open(perf_log_file) as f:
+        backends = {os.path.basename(record["path"]): record["backend"] for record in map(json.loads, f)}
+    return rows, backends
+
+def test_restart_skips_journaled_files_and_retries_failures(tmp_path):
+    spectra_folder = tmp_path / "spectra"
+    spectra_folder.mkdir()
+    for name in ["a.mgf", "hang.mgf", "c.mgf"]:
+        synthetic_corpus.write_MGF(str(spectra_folder / name), num_spectra=6, peaks_per_spectrum=2)
+    journal_file = str(tmp_path / "shard.journal.jsonl")
+
+    env = dict(os.environ, FAKE_MSACCESS_HANG="hang.mgf")
+    rows, _ = _run_filesummary(str(spectra_folder), str(tmp_path / "first.tsv"), journal_file, str(tmp_path / "first.jsonl"), env)
+
+    # The timed out file is listed without a summary, but only the summarized files are journaled
+    assert rows["hang.mgf"]["MS1s"] == "-1"
+    assert sorted(os.path.basename(path) for path in filesummary.read_journal(journal_file)) == ["a.mgf", "c.mgf"]
+
+    # The restart reuses the journaled files and summarizes the one that timed out again
+    env = dict(os.environ)
+    env.pop("FAKE_MSACCESS_HANG", None)
+    rows, backends = _run_filesummary(str(spectra_folder), str(tmp_path / "second.tsv"), journal_file, str(tmp_path / "second.jsonl"), env)
+
+    assert backends == {"a.mgf": "journal", "hang.mgf": "msaccess", "c.mgf": "journal"}
+    assert sorted(rows) == ["a.mgf", "c.mgf", "hang.mgf"]
+    assert all(row["MS1s"] != "-1" for row in rows.values())
+    assert rows["hang.mgf"]["MS1s"] == rows["a.mgf"]["MS1s"]
+
+def test_read_journal_skips_truncated_and_failed_records(tmp_path):
+    journal_file = tmp_path / "shard.journal.jsonl"
+    complete = {"path": "/data/a.mgf", "size": 10, "mtime": 1.0, "ok": True, "rows": [{"Filename": "a.mgf"}]}
+    # Written before the ok flag, when failed files were journaled too
+    unflagged = {"path": "/data/b.mgf", "size": 10, "mtime": 1.0, "rows": [{"Filename": "b.mgf", "MS1s": -1}]}
+    truncated = json.dumps({"path": "/data/c.mgf", "size": 10, "mtime": 1.0, "ok": True, "rows": []})[:30]
+    journal_file.write_text(json.dumps(complete) + "\n" + json.dumps(unflagged) + "\n" + truncated)
+
+    assert filesummary.read_journal(str(journal_file)) == {"/data/a.mgf": complete}
+    assert filesummary.read_journal(str(tmp_path / "missing.jsonl")) == {}
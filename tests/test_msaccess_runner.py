@@ -0,0 +1,39 @@
+import os
+
+import msaccess_runner
+import synthetic_corpus
+from conftest import REPO_FOLDER
+
+FAKE_MSACCESS = os.path.join(REPO_FOLDER, "benchmarks", "fake_msaccess.py")
+
+def _write_files(tmp_path, names):
+    spectrum_files = []
+    for name in names:
+        spectrum_file = str(tmp_path / name)
+        synthetic_corpus.write_MGF(spectrum_file, num_spectra=6, peaks_per_spectrum=2)
+        spectrum_files.append(spectrum_file)
+    return spectrum_files
+
+def test_batch_timeout_scales_with_its_files(tmp_path, monkeypatch):
+    spectrum_files = _write_files(tmp_path, ["a.mgf", "b.mgf", "c.mgf"])
+    # Every file takes most of the timeout, the batch as a whole takes longer than it
+    monkeypatch.setenv("FAKE_MSACCESS_DELAY", "0.6")
+
+    results = list(msaccess_runner.run_msaccess_batch(FAKE_MSACCESS, spectrum_files, timeout=1))
+
+    assert [(spectrum_file, error, invocation.number_of_files) for spectrum_file, _, error, invocation in results] == \
+        [(spectrum_file, None, 3) for spectrum_file in spectrum_files]
+
+def test_timed_out_batch_runs_files_on_their_own(tmp_path, monkeypatch):
+    spectrum_files = _write_files(tmp_path, ["a.mgf", "hang.mgf", "c.mgf", "d.mgf"])
+    monkeypatch.setenv("FAKE_MSACCESS_HANG", "hang.mgf")
+    # Rows are written as each file is done, like a table that msaccess got partway through
+    monkeypatch.setenv("PYTHONUNBUFFERED", "1")
+
+    results = list(msaccess_runner.run_msaccess_batch(FAKE_MSACCESS, spectrum_files, timeout=1))
+
+    # The file done before the batch timed out keeps its row, every other file runs once on its own rather than
+    # halving the batch down to the hung file
+    assert [(spectrum_file, error, invocation.number_of_files) for spectrum_file, _, error, invocation in results] == \
+        [(spectrum_files[0], None, 4), (spectrum_files[1], "Timeout", 1), (spectrum_files[2], None, 1), (spectrum_files[3], None, 1)]
+    assert all(len(rows) == 1 for spectrum_file, rows, error, _ in results if error is None)
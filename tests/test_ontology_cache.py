@@ -0,0 +1,25 @@
+import os
+
+import ontology_cache
+from conftest import OBO_FILE
+
+def test_compiled_ontology_goes_to_the_cache_folder(cache_home, monkeypatch):
+    monkeypatch.setattr(ontology_cache, "_LOADED_ONTOLOGIES", {})
+    obo_files_before = sorted(os.listdir(os.path.dirname(OBO_FILE)))
+
+    lookup = ontology_cache.load_ontology(OBO_FILE)
+
+    compiled_file = ontology_cache.compiled_ontology_path(OBO_FILE, lookup.obo_sha256)
+    assert os.path.dirname(compiled_file) == os.path.join(cache_home, "filesummary_workflow")
+    assert os.path.exists(compiled_file)
+    # Nothing is written into bin/ontology
+    assert sorted(os.listdir(os.path.dirname(OBO_FILE))) == obo_files_before
+    assert "Q Exactive" in lookup.model_names
+
+def test_unwritable_cache_folder_compiles_in_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(ontology_cache, "_LOADED_ONTOLOGIES", {})
+    not_a_folder = tmp_path / "cache"
+    not_a_folder.write_text("")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(not_a_folder))
+
+    assert "Q Exactive" in ontology_cache.load_ontology(OBO_FILE).model_names
@@ -0,0 +1,89 @@
+import os
+import shutil
+
+import pytest
+
+import result_cache
+
+ROW = {"Filename": "run.mzML", "MS1s": 10, "MS2s": 50}
+
+@pytest.fixture
+def spectrum_file(tmp_path):
+    spectrum_file = tmp_path / "run.mzML"
+    spectrum_file.write_bytes(b"<mzML>" + b"0" * 4096 + b"</mzML>")
+    return str(spectrum_file)
+
+def _cache(tmp_path, version="1", ontology_hash="", use_fingerprint=False):
+    return result_cache.ResultCache(str(tmp_path / "cache.db"), "xmlsummary", version, ontology_hash=ontology_hash,
+                                    use_fingerprint=use_fingerprint)
+
+def test_unchanged_file_is_a_hit(tmp_path, spectrum_file):
+    cache = _cache(tmp_path)
+    cache.store(spectrum_file, ROW, "xml_index")
+    cache.close()
+
+    # Another run opening the same database
+    cache = _cache(tmp_path)
+    assert cache.lookup(spectrum_file) == ROW
+    cache.close()
+
+def test_changed_size_or_mtime_is_a_miss(tmp_path, spectrum_file):
+    cache = _cache(tmp_path)
+    cache.store(spectrum_file, ROW, "xml_index")
+    file_stat = os.stat(spectrum_file)
+
+    os.utime(spectrum_file, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1000000000))
+    assert cache.lookup(spectrum_file) is None
+
+    os.utime(spectrum_file, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+    assert cache.lookup(spectrum_file) == ROW
+    # Same mtime, but the file grew
+    with open(spectrum_file, "ab") as f:
+        f.write(b"\n")
+    os.utime(spectrum_file, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+    assert cache.lookup(spectrum_file) is None
+    cache.close()
+
+def test_version_or_ontology_change_is_a_miss(tmp_path, spectrum_file):
+    cache = _cache(tmp_path, version="1", ontology_hash="a")
+    cache.store(spectrum_file, ROW, "xml_index")
+    cache.close()
+
+    # A parser version bump, and the same version resolved with another ontology
+    for version, ontology_hash in [("2", "a"), ("1", "b")]:
+        cache = _cache(tmp_path, version=version, ontology_hash=ontology_hash)
+        assert cache.lookup(spectrum_file) is None
+        cache.close()
+
+    # Rows of other versions are kept side by side, the old version still hits
+    cache = _cache(tmp_path, version="1", ontology_hash="a")
+    assert cache.lookup(spectrum_file) == ROW
+    cache.close()
+
+def test_fingerprint_matches_copies_but_not_other_content(tmp_path, spectrum_file):
+    cache = _cache(tmp_path, use_fingerprint=True)
+    cache.store(spectrum_file, ROW, "xml_index")
+
+    copied_file = str(tmp_path / "copy.mzML")
+    shutil.copyfile(spectrum_file, copied_file)
+    assert cache.lookup(copied_file) == ROW
+
+    # Same size, different content
+    other_file = tmp_path / "other.mzML"
+    other_file.write_bytes(b"<mzML>" + b"1" * 4096 + b"</mzML>")
+    assert cache.lookup(str(other_file)) is None
+    cache.close()
+
+    # Without fingerprints only the path matches
+    cache = _cache(tmp_path)
+    assert cache.lookup(copied_file) is None
+    cache.close()
+
+def test_several_rows_of_a_file_are_returned_together(tmp_path, spectrum_file):
+    cache = _cache(tmp_path)
+    rows = [dict(ROW, Sample="1"), dict(ROW, Sample="2")]
+    cache.store_rows(spectrum_file, rows, "msaccess")
+
+    assert cache.lookup_rows(spectrum_file) == rows
+    assert cache.lookup_rows(str(tmp_path / "missing.mzML")) is None
+    cache.close()
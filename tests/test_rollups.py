@@ -0,0 +1,45 @@
+import rollups
+import xmlsummary_single
+
+def _row(path, ms1s, ms2s, ms3_plus, vendor=""):
+    """merged_results.tsv row with the columns of xmlsummary_single, mzML usually leaves the vendor empty."""
+    row = dict.fromkeys(xmlsummary_single.HEADERS, "")
+    row.update({"Filename": path, "Original_Path": path, "Vendor": vendor, "Model": "Q Exactive", "Mass_Analyzer": "orbitrap",
+                "MS1s": ms1s, "MS2s": ms2s, "MS3+": ms3_plus})
+    return row
+
+def test_rows_without_counts_keep_the_stored_contribution(tmp_path):
+    store = rollups.RollupStore(str(tmp_path / "rollups.db"), dataset_root="/data", month="2026-01")
+    store.update([_row("/data/MSV1/a.mzML", "10", "50", "0"), _row("/data/MSV1/b.mzML", "5", "20", "2")])
+
+    # A metadata-only run of the same files, and a file msaccess could not summarize
+    store.update([_row("/data/MSV1/a.mzML", "", "", ""), _row("/data/MSV1/b.mzML", "", "", ""), _row("/data/MSV1/c.raw", "-1", "-1", "")])
+
+    assert store.skipped_files == 3
+    assert store.rollup("dataset") == [{"Dataset": "MSV1", "Files": 2, "MS1s": 15, "MS2s": 70, "MS3_Plus": 2}]
+    store.close()
+
+def test_changed_counts_move_only_their_difference(tmp_path):
+    store = rollups.RollupStore(str(tmp_path / "rollups.db"), dataset_root="/data", month="2026-01")
+    store.update([_row("/data/MSV1/a.mzML", "10", "50", "0"), _row("/data/MSV2/b.mzML", "5", "20", "2")])
+
+    store.update([_row("/data/MSV1/a.mzML", "12", "50", "0"), _row("/data/MSV2/b.mzML", "5", "20", "2")])
+
+    assert (store.changed_files, store.unchanged_files) == (1, 1)
+    assert store.rollup("dataset") == [{"Dataset": "MSV1", "Files": 1, "MS1s": 12, "MS2s": 50, "MS3_Plus": 0},
+                                       {"Dataset": "MSV2", "Files": 1, "MS1s": 5, "MS2s": 20, "MS3_Plus": 2}]
+    store.close()
+
+def test_lookups_span_several_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(rollups, "ROWS_PER_LOOKUP", 3)
+    store = rollups.RollupStore(str(tmp_path / "rollups.db"), dataset_root="/data", month="2026-01")
+    store.update([_row(f"/data/MSV1/{index}.mzML", "1", "2", "0") for index in range(7)])
+
+    # The same file twice within a chunk only counts once, with the counts of its last row
+    store.update([_row("/data/MSV1/0.mzML", "1", "2", "0"), _row("/data/MSV1/7.mzML", "1", "2", "0"), _row("/data/MSV1/7.mzML", "3", "2", "0"),
+                  _row("/data/MSV1/1.raw", "4", "4", "0", vendor="Thermo Scientific")])
+
+    assert (store.new_files, store.changed_files, store.unchanged_files) == (9, 1, 1)
+    assert store.rollup("dataset") == [{"Dataset": "MSV1", "Files": 9, "MS1s": 1 * 7 + 3 + 4, "MS2s": 2 * 8 + 4, "MS3_Plus": 0}]
+    assert store.rollup("vendor") == [{"Vendor": "Thermo Fisher Scientific", "Files": 9, "MS1s": 14, "MS2s": 20, "MS3_Plus": 0}]
+    store.close()
@@ -0,0 +1,59 @@
+import csv
+import os
+import shutil
+
+import discover_files
+import schedule_batches
+
+GB = 1000 ** 3
+
+def _entries(sizes_gb):
+    return [{"path": f"/data/file_{index:02d}.mzML", "original_path": f"/data/file_{index:02d}.mzML",
+             "size": int(size_gb * GB), "mtime": 1.0, "format": "mzML"} for index, size_gb in enumerate(sizes_gb)]
+
+# A file over the batch size, then files that share 2 GB batches of at most 3 files
+SIZES_GB = [0.1, 3.0, 0.2, 1.5, 0.1, 0.4, 0.1, 0.3, 0.1]
+
+def _sizes_gb(batch):
+    return [entry["size"] / GB for entry in batch]
+
+def test_pack_batches_largest_first():
+    batches = schedule_batches.pack_batches(_entries(SIZES_GB), batch_bytes=2 * GB, batch_files=3, max_cpus=4)
+
+    # The 3 GB file is alone, and the batches are dispatched by how long they run rather than by size alone
+    assert [_sizes_gb(batch) for batch in batches] == [[3.0], [1.5, 0.4], [0.3, 0.2, 0.1], [0.1, 0.1, 0.1]]
+    assert [schedule_batches.batch_cpus(batch, 4) for batch in batches] == [1, 2, 3, 3]
+
+def test_metadata_only_batches_are_only_limited_by_files():
+    batches = schedule_batches.pack_batches(_entries(SIZES_GB), batch_bytes=None, batch_files=4, max_cpus=4)
+
+    assert [len(batch) for batch in batches] == [4, 4, 1]
+
+def test_memory_estimate():
+    batch = _entries([1.5, 0.4])
+
+    # 512 + 2 * (256 + 256 * 1.5) = 1792, already a multiple of 256
+    assert schedule_batches.estimate_memory_mb(batch, 2) == 1792
+    # 512 + 1 * (256 + 256 * 1.5) = 1152, rounded up to 1280
+    assert schedule_batches.estimate_memory_mb(batch, 1) == 1280
+    # Only the headers are read, the file size does not matter
+    assert schedule_batches.estimate_memory_mb(batch, 2, metadata_only=True) == 1024
+
+def test_index_names_batches_relative_to_their_folder(tmp_path):
+    batches = schedule_batches.pack_batches(_entries(SIZES_GB), batch_bytes=2 * GB, batch_files=3, max_cpus=4)
+    schedule_batches.write_batches(batches, str(tmp_path / "batches"), str(tmp_path / "batch_index.tsv"), max_cpus=4)
+
+    # Staged somewhere else, like the work folder of the task that reads the index
+    staged_folder = str(tmp_path / "work" / "batches")
+    shutil.move(str(tmp_path / "batches"), staged_folder)
+    with open(tmp_path / "batch_index.tsv", newline="") as f:
+        index = list(csv.DictReader(f, delimiter="\t"))
+
+    assert [row["batch"] for row in index] == [f"batch_{batch_index:05d}.tsv" for batch_index in range(4)]
+    assert [(row["files"], row["cpus"], row["memory_mb"]) for row in index] == \
+        [("1", "1", "1536"), ("2", "2", "1792"), ("3", "3", "1536"), ("3", "3", "1536")]
+    for row, batch in zip(index, batches):
+        staged_batch = discover_files.read_manifest(os.path.join(staged_folder, row["batch"]))
+        # Batch manifests keep the largest file first
+        assert [entry["path"] for entry in staged_batch] == [entry["path"] for entry in batch]
+        assert int(row["bytes"]) == sum(entry["size"] for entry in staged_batch)
@@ -0,0 +1,53 @@
+import os
+
+import discover_files
+import shard_manifest
+
+MB = 1024 * 1024
+
+def _entries(sizes):
+    return [{"path": f"/data/file_{index:03d}.mzML", "size": size} for index, size in enumerate(sizes)]
+
+def _shard_costs(shards):
+    return [sum(shard_manifest._file_cost(entry) for entry in shard) for shard in shards]
+
+def test_shards_are_balanced_by_cost():
+    entries = _entries([900 * MB, 500 * MB, 400 * MB, 300 * MB, 200 * MB] + [1 * MB] * 40)
+
+    shards = shard_manifest.shard_entries(entries, 3)
+
+    assert len(shards) == 3
+    assert sorted(entry["path"] for shard in shards for entry in shard) == sorted(entry["path"] for entry in entries)
+    shard_costs = _shard_costs(shards)
+    # Largest first onto the cheapest shard keeps every shard within one file of the others
+    largest_file_cost = 900 * MB + shard_manifest.FILE_COST_BYTES
+    assert max(shard_costs) - min(shard_costs) <= largest_file_cost
+    # The many small files are spread out rather than all landing on one shard
+    assert all(sum(entry["size"] == 1 * MB for entry in shard) > 0 for shard in shards)
+
+def test_shards_are_deterministic_and_empty_shards_dropped():
+    entries = _entries([100 * MB] * 4)
+
+    assert shard_manifest.shard_entries(entries, 2) == shard_manifest.shard_entries(list(reversed(entries)), 2)
+    assert len(shard_manifest.shard_entries(entries, 10)) == 4
+    assert len(shard_manifest.shard_entries(entries, 0)) == 1
+
+def test_number_of_shards_for_size_and_file_targets():
+    entries = _entries([1 * MB] * 10)
+
+    assert shard_manifest.number_of_shards_for(entries, shards=3) == 3
+    assert shard_manifest.number_of_shards_for(entries, shard_files=4) == 3
+    total_cost = sum(shard_manifest._file_cost(entry) for entry in entries)
+    assert shard_manifest.number_of_shards_for(entries, shard_bytes=total_cost // 5) == 5
+    assert shard_manifest.number_of_shards_for(entries) == 1
+
+def test_write_shards_round_trips_through_manifests(tmp_path):
+    entries = [dict(entry, original_path=entry["path"], mtime=1.0, format="mzML")
+               for entry in _entries([300 * MB, 200 * MB, 100 * MB])]
+
+    shard_files = shard_manifest.write_shards(shard_manifest.shard_entries(entries, 2), str(tmp_path / "shards"))
+
+    assert [os.path.basename(f) for f in shard_files] == ["shard_0000.tsv", "shard_0001.tsv"]
+    read_back = [discover_files.read_manifest(f) for f in shard_files]
+    assert sorted(entry["path"] for shard in read_back for entry in shard) == sorted(entry["path"] for entry in entries)
+    assert sorted(sum(entry["size"] for entry in shard) for shard in read_back) == [300 * MB, 300 * MB]
@@ -0,0 +1,89 @@
+import json
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import summary_server
+import synthetic_corpus
+from conftest import OBO_FILE
+
+# Seconds the only worker is kept busy while the backpressure test fills the queue
+BUSY_SECONDS = 3
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    ontology_file = tmp_path_factory.mktemp("ontology") / "psi-ms.obo"
+    shutil.copyfile(OBO_FILE, ontology_file)
+    # A single slot, so one request in flight is enough to turn the next one away
+    service = summary_server.SummaryService(ontology_file=str(ontology_file), parallelism=1, max_pending=1)
+    server = summary_server.make_server(service, port=0)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+def _post(server, payload):
+    """POSTs payload to /summarize, returning the status, the JSON response, and the response headers."""
+    host, port = server.server_address[:2]
+    request = urllib.request.Request(f"http://{host}:{port}/summarize", data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status, json.loads(response.read()), response.headers
+    except urllib.error.HTTPError as http_error:
+        return http_error.code, json.loads(http_error.read()), http_error.headers
+
+def test_summarize_returns_row(server, tmp_path):
+    input_file = str(tmp_path / "spectra.mzML")
+    synthetic_corpus.write_mzML(input_file, num_spectra=12, peaks_per_spectrum=5, ms2_per_ms1=5)
+
+    status, response, _ = _post(server, {'path': input_file, 'original_path': 'dataset/spectra.mzML'})
+
+    assert status == 200
+    assert response['row']['Original_Path'] == 'dataset/spectra.mzML'
+    assert (response['row']['MS1s'], response['row']['MS2s']) == (2, 10)
+
+def test_missing_file_is_404(server, tmp_path):
+    status, response, _ = _post(server, {'path': str(tmp_path / "missing.mzML")})
+
+    assert status == 404
+    assert 'missing.mzML' in response['error']
+
+def test_unparsable_file_is_422(server, tmp_path):
+    input_file = tmp_path / "broken.mzML"
+    input_file.write_text("<mzML><run><spectrumList count=\"1\"><spectrum")
+
+    status, response, _ = _post(server, {'path': str(input_file)})
+
+    assert status == 422
+    assert response['error'] != ''
+
+def test_full_queue_is_503(server, tmp_path):
+    input_file = str(tmp_path / "spectra.mgf")
+    synthetic_corpus.write_MGF(input_file, num_spectra=6, peaks_per_spectrum=5)
+    service = server.RequestHandlerClass.service
+
+    # The worker is kept busy, so the queued file holds the only slot until it is done
+    busy_result = service.pool.apply_async(time.sleep, (BUSY_SECONDS,))
+    queued_result = service.submit(input_file)
+    assert queued_result is not None
+
+    status, response, headers = _post(server, {'path': input_file})
+    assert status == 503
+    assert headers['Retry-After'] == '1'
+    assert service.health()['rejected'] >= 1
+
+    # Once the slot is released, requests are accepted again
+    busy_result.get(timeout=60)
+    queued_result.get(timeout=60)
+    deadline = time.time() + 10
+    while service.health()['pending'] > 0 and time.time() < deadline:
+        time.sleep(0.05)
+    status, response, _ = _post(server, {'path': input_file})
+    assert status == 200
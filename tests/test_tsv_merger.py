@@ -0,0 +1,118 @@
+import os
+import random
+import subprocess
+import sys
+
+import pandas as pd
+
+import tsv_merger
+from conftest import REPO_FOLDER
+
+TSV_MERGER = os.path.join(REPO_FOLDER, "bin", "scripts", "tsv_merger.py")
+
+def _write_tsv(tsv_file, header, rows):
+    with open(tsv_file, 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(x) for x in row) + '\n')
+
+def _merge(input_folder, output_file, *args):
+    subprocess.run([sys.executable, TSV_MERGER, str(input_folder), str(output_file), *args], check=True, capture_output=True)
+    return pd.read_csv(output_file, sep='\t', dtype=str, keep_default_na=False) if os.path.getsize(output_file) > 0 else None
+
+def test_streamed_rows_keep_file_order_across_blocks(tmp_path):
+    results_files = []
+    for file_index in range(5):
+        results_files.append(str(tmp_path / f"chunk_{file_index}.tsv"))
+        _write_tsv(results_files[-1], ["Filename", "MS1s"], [(f"{file_index}_{row_index}.mzML", row_index) for row_index in range(23)])
+
+    rows = list(tsv_merger.iter_rows(results_files, read_ahead=2, rows_per_block=5))
+
+    assert [row['Filename'] for row in rows] == [f"{file_index}_{row_index}.mzML" for file_index in range(5) for row_index in range(23)]
+
+def test_rows_with_extra_fields_are_kept_without_them(tmp_path):
+    results_file = tmp_path / "chunk.tsv"
+    results_file.write_text("Filename\tMS1s\na.mzML\t1\textra\nb.mzML\t2\n")
+
+    assert list(tsv_merger.iter_rows([str(results_file)])) == [{"Filename": "a.mzML", "MS1s": "1"}, {"Filename": "b.mzML", "MS1s": "2"}]
+
+def test_top_k_matches_sort_and_group_head(tmp_path):
+    rng = random.Random(0)
+    scores = rng.sample(range(100000), 600)
+    rows = [{"key": rng.choice(["a", "b", "c", "d", ""]), "score": str(score), "row": str(row_index)} for row_index, score in enumerate(scores)]
+
+    kept_rows = tsv_merger.top_k_rows(iter(rows), 7, "key", "score")
+
+    # The pandas merge this replaces
+    df = pd.DataFrame(rows).replace({"key": {"": None}})
+    df["score"] = df["score"].astype(int)
+    expected_df = df.sort_values(by="score", ascending=False).groupby("key").head(7)
+    assert [row["row"] for row in kept_rows] == list(expected_df["row"])
+
+def test_merge_unions_schemas(tmp_path):
+    input_folder = tmp_path / "results"
+    input_folder.mkdir()
+    _write_tsv(input_folder / "a.tsv", ["Filename", "Vendor", "Model", "MS1s", "MS2s"], [("/data/a.raw", "Thermo", "Q Exactive", 1, 2)])
+    _write_tsv(input_folder / "b.tsv", ["Filename", "Original_Path", "Model", "MS1s", "MS2s", "MS3+"], [("b.mzML", "/data/b.mzML", "maXis", 3, 4, 5)])
+
+    merged_df = _merge(input_folder, tmp_path / "merged.tsv")
+
+    assert list(merged_df.columns) == ["Filename", "Vendor", "Model", "MS1s", "MS2s", "Original_Path", "MS3+"]
+    assert merged_df.to_dict('records') == [
+        {"Filename": "/data/a.raw", "Vendor": "Thermo", "Model": "Q Exactive", "MS1s": "1", "MS2s": "2", "Original_Path": "", "MS3+": ""},
+        {"Filename": "b.mzML", "Vendor": "", "Model": "maXis", "MS1s": "3", "MS2s": "4", "Original_Path": "/data/b.mzML", "MS3+": "5"}]
+
+def test_merge_of_empty_chunks(tmp_path):
+    # pd.concat([]) raised when every chunk was empty
+    input_folder = tmp_path / "results"
+    input_folder.mkdir()
+    _write_tsv(input_folder / "a.tsv", ["Filename", "MS1s"], [])
+    (input_folder / "b.tsv").write_text("")
+
+    merged_df = _merge(input_folder, tmp_path / "merged.tsv", "--topk", "2", "--key_column", "Filename", "--sort_column", "MS1s")
+    assert list(merged_df.columns) == ["Filename", "MS1s"] and len(merged_df) == 0
+
+    (input_folder / "a.tsv").write_text("")
+    assert _merge(input_folder, tmp_path / "merged.tsv") is None
+    # No inputs at all
+    (input_folder / "a.tsv").unlink()
+    (input_folder / "b.tsv").unlink()
+    assert _merge(input_folder, tmp_path / "merged.tsv") is None
+
+def test_dataset_of_path():
+    assert tsv_merger.dataset_of_path("/data/MSV000000001/peak/run.mzML", "/data") == "MSV000000001"
+    assert tsv_merger.dataset_of_path("/data//MSV000000001/run.mzML", "/data/") == "MSV000000001"
+    # Outside of the root, directly in it, or without a path
+    assert tsv_merger.dataset_of_path("/other/MSV000000001/run.mzML", "/data") is None
+    assert tsv_merger.dataset_of_path("/data/run.mzML", "/data") is None
+    assert tsv_merger.dataset_of_path("", "/data") is None
+    # Without a root the first directory of the path
+    assert tsv_merger.dataset_of_path("MSV000000002/run.mzML") == "MSV000000002"
+
+def test_parquet_output_is_partitioned_by_dataset(tmp_path):
+    import pyarrow
+    import pyarrow.dataset
+
+    input_folder = tmp_path / "results"
+    input_folder.mkdir()
+    _write_tsv(input_folder / "a.tsv", ["Filename", "Original_Path", "Model", "MS1s", "MS2s", "RT_Max"],
+               [("a.mzML", "/data/MSV1/a.mzML", "Q Exactive", 10, 50, 3600.5), ("b.mzML", "/data/MSV2/b.mzML", "maXis", "", 20, "")])
+    _write_tsv(input_folder / "b.tsv", ["Filename", "Model", "MS1s", "MS2s"], [("/elsewhere/c.mzML", "Q Exactive", 1, 2)])
+
+    merged_df = _merge(input_folder, tmp_path / "merged.tsv", "--parquet_output", str(tmp_path / "parquet"), "--dataset_root", "/data")
+
+    partitioning = pyarrow.dataset.partitioning(flavor="hive")
+    table = pyarrow.dataset.dataset(str(tmp_path / "parquet"), format="parquet", partitioning=partitioning).to_table()
+    assert table.num_rows == len(merged_df) == 3
+    # Counts are typed, strings other than paths dictionary encoded
+    assert table.schema.field("MS1s").type == pyarrow.int64()
+    assert table.schema.field("RT_Max").type == pyarrow.float64()
+    assert pyarrow.types.is_dictionary(table.schema.field("Model").type)
+    assert table.schema.field("Original_Path").type == pyarrow.string()
+
+    rows = {row["Filename"]: row for row in table.to_pylist()}
+    assert (rows["a.mzML"]["Dataset"], rows["a.mzML"]["MS1s"], rows["a.mzML"]["RT_Max"]) == ("MSV1", 10, 3600.5)
+    assert (rows["b.mzML"]["Dataset"], rows["b.mzML"]["MS1s"], rows["b.mzML"]["MS2s"]) == ("MSV2", None, 20)
+    # Outside of the dataset root, in the default partition
+    assert rows["/elsewhere/c.mzML"]["Dataset"] is None
+    assert sorted(os.listdir(tmp_path / "parquet")) == ["Dataset=MSV1", "Dataset=MSV2", "Dataset=__HIVE_DEFAULT_PARTITION__"]
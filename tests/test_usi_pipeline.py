@@ -0,0 +1,115 @@
+import csv
+import os
+import shutil
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+import pytest
+
+import synthetic_corpus
+import usi_pipeline
+from conftest import OBO_FILE
+
+class LinkRequestHandler(SimpleHTTPRequestHandler):
+    """Serves the files of a folder, and answers /downloadlink?usi=... with their link like the USI download endpoint.
+
+    Files named truncated* are cut off before their Content-Length.
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/downloadlink':
+            dataset, usi_file = usi_pipeline.parse_usi(parse_qs(url.query)['usi'][0])
+            body = f"http://{self.headers['Host']}/{quote(dataset)}/{quote(os.path.basename(usi_file))}".encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if os.path.basename(url.path).startswith('truncated'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', '100000')
+            self.end_headers()
+            self.wfile.write(b"BEGIN IONS\n")
+            self.close_connection = True
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def file_server(tmp_path):
+    served_folder = tmp_path / "served"
+    (served_folder / "MSV000000001").mkdir(parents=True)
+    synthetic_corpus.write_mzML(str(served_folder / "MSV000000001" / "run1.mzML"), num_spectra=12, peaks_per_spectrum=5)
+    synthetic_corpus.write_MGF(str(served_folder / "MSV000000001" / "run2.mgf"), num_spectra=6, peaks_per_spectrum=5)
+
+    handler = lambda *args, **kwargs: LinkRequestHandler(*args, directory=str(served_folder), **kwargs)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+def _read_tsv(tsv_file):
+    with open(tsv_file, newline='') as f:
+        return list(csv.DictReader(f, delimiter='\t'))
+
+def test_pipeline_rows_carry_usi(tmp_path, file_server):
+    ontology_file = tmp_path / "psi-ms.obo"
+    shutil.copyfile(OBO_FILE, ontology_file)
+    usis = ["mzspec:MSV000000001:peak/run1.mzML:scan:1",
+            "mzspec:MSV000000001:peak/run1.mzML:scan:2",
+            "mzspec:MSV000000001:run2.mgf",
+            "mzspec:MSV000000001:missing.mzML",
+            "mzspec:MSV000000001:truncated.mzML",
+            "not a usi"]
+    jobs, invalid_usis = usi_pipeline.plan_downloads(usis, file_server + "/downloadlink?usi={usi}")
+
+    spectra_folder = tmp_path / "spectra"
+    download_folder = spectra_folder / "usi_downloads"
+    pipeline = usi_pipeline.UsiPipeline(str(download_folder), str(tmp_path / "summary.tsv"), str(tmp_path / "errors.tsv"),
+                                        ontology_file=str(ontology_file), parallelism=2, download_parallelism=2,
+                                        download_retries=0, usi_summary_file=str(tmp_path / "usi_summary.tsv"))
+    try:
+        pipeline.write_invalid_usis(invalid_usis)
+        number_summarized, number_failed = pipeline.run(jobs)
+    finally:
+        pipeline.close()
+
+    assert (number_summarized, number_failed) == (2, 2)
+
+    rows = _read_tsv(tmp_path / "summary.tsv")
+    assert len(rows) == 3
+    assert sorted(row['usi'] for row in rows) == sorted(usis[:3])
+    # The columns add_usi.py adds, relative to the folder the downloads are in
+    assert all(row['filename'] == row['target_path'] == os.path.relpath(row['Filename'], str(spectra_folder)) for row in rows)
+    assert {row['target_path'] for row in rows} == {"usi_downloads/MSV000000001/run1.mzML", "usi_downloads/MSV000000001/run2.mgf"}
+
+    error_rows = _read_tsv(tmp_path / "errors.tsv")
+    assert sorted(row['usi'] for row in error_rows) == sorted(usis[3:])
+
+    usi_summary_rows = _read_tsv(tmp_path / "usi_summary.tsv")
+    assert sorted(row['usi'] for row in usi_summary_rows) == sorted(usis)
+    # Downloaded files are listed under the same relative path as in the summary rows, failed downloads without one
+    usi_target_paths = {row['usi']: row['target_path'] for row in usi_summary_rows}
+    assert all(usi_target_paths[row['usi']] == row['target_path'] for row in rows)
+    assert [usi_target_paths[usi] for usi in usis[3:]] == ['', '', '']
+
+
+    # Neither the truncated nor any other download leaves a partial file behind
+    downloaded_files = [os.path.join(folder, name) for folder, _, names in os.walk(download_folder) for name in names]
+    assert not any(x.endswith('.part') for x in downloaded_files)
+    assert sorted(os.path.relpath(x, str(download_folder)) for x in downloaded_files) == ["MSV000000001/run1.mzML", "MSV000000001/run2.mgf"]
+
+def test_same_file_name_in_a_dataset_is_rejected():
+    jobs, invalid_usis = usi_pipeline.plan_downloads(["mzspec:MSV000000001:a/run1.mzML", "mzspec:MSV000000001:b/run1.mzML"],
+                                                     usi_pipeline.DEFAULT_URL_TEMPLATE)
+
+    assert [job.usi_file for job in jobs] == ["a/run1.mzML"]
+    assert [usi for usi, _ in invalid_usis] == ["mzspec:MSV000000001:b/run1.mzML"]
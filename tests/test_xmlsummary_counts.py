@@ -0,0 +1,101 @@
+import collections
+import shutil
+
+import pytest
+from pyteomics import mgf, mzml, mzxml
+
+import synthetic_corpus
+import xmlsummary_single
+from conftest import OBO_FILE
+
+NUM_SPECTRA = 250
+
+def _pyteomics_counts(spectra, ms_level_of):
+    """MS1s, MS2s, MS3+ and Unknown_MS_Level of the spectra as counted by pyteomics."""
+    ms_levels = collections.Counter()
+    for spectrum in spectra:
+        ms_level = ms_level_of(spectrum)
+        ms_levels[int(ms_level) if ms_level is not None else None] += 1
+    return {"MS1s": ms_levels[1],
+            "MS2s": ms_levels[2],
+            "MS3+": sum(count for ms_level, count in ms_levels.items() if ms_level is not None and ms_level >= 3),
+            "Unknown_MS_Level": ms_levels[None]}
+
+def _expected_counts(input_file, file_format):
+    if file_format == "mzML":
+        with mzml.MzML(input_file, decode_binary=False) as spectra:
+            return _pyteomics_counts(spectra, lambda spectrum: spectrum.get("ms level"))
+    if file_format == "mzXML":
+        with mzxml.MzXML(input_file, decode_binary=False) as spectra:
+            return _pyteomics_counts(spectra, lambda spectrum: spectrum.get("msLevel"))
+    with mgf.MGF(input_file) as spectra:
+        return _pyteomics_counts(spectra, lambda spectrum: spectrum["params"].get("mslevel"))
+
+@pytest.fixture(scope="module")
+def ontology_file(tmp_path_factory):
+    ontology_file = tmp_path_factory.mktemp("ontology") / "psi-ms.obo"
+    shutil.copyfile(OBO_FILE, ontology_file)
+    return str(ontology_file)
+
+@pytest.mark.parametrize("file_format, filename, write_kwargs", [
+    ("mzML", "plain.mzML", {"indexed": False}),
+    ("mzML", "indexed.mzML", {"indexed": True}),
+    ("mzXML", "plain.mzXML", {"indexed": False}),
+    ("mzXML", "indexed.mzXML", {"indexed": True}),
+    ("mgf", "spectra.mgf", {"missing_mslevel_every": 7}),
+])
+@pytest.mark.parametrize("use_index", [False, True])
+def test_ms_level_counts_match_pyteomics(tmp_path, ontology_file, file_format, filename, write_kwargs, use_index):
+    input_file = str(tmp_path / filename)
+    writer = {"mzML": synthetic_corpus.write_mzML, "mzXML": synthetic_corpus.write_mzXML, "mgf": synthetic_corpus.write_MGF}[file_format]
+    writer(input_file, num_spectra=NUM_SPECTRA, peaks_per_spectrum=5, ms2_per_ms1=5, ms3_every=2, **write_kwargs)
+
+    summary = xmlsummary_single.summarize_file(input_file, input_file, ontology_file=ontology_file, use_index=use_index,
+                                               extra_metrics=("unknown",))
+
+    expected_counts = _expected_counts(input_file, file_format)
+    assert sum(expected_counts.values()) == NUM_SPECTRA
+    assert {column: summary[column] for column in expected_counts} == expected_counts
+
+def test_index_is_used_for_indexed_files(tmp_path, ontology_file):
+    for filename, writer in [("indexed.mzML", synthetic_corpus.write_mzML), ("indexed.mzXML", synthetic_corpus.write_mzXML)]:
+        input_file = str(tmp_path / filename)
+        writer(input_file, num_spectra=NUM_SPECTRA, peaks_per_spectrum=5, indexed=True, ms3_every=2)
+        # require_index fails rather than falling back to a full parse, so the counts below come from the index
+        summary = xmlsummary_single.summarize_file(input_file, input_file, ontology_file=ontology_file, use_index=True,
+                                                   require_index=True, extra_metrics=("unknown",))
+        file_format = "mzML" if filename.endswith(".mzML") else "mzXML"
+        assert {column: summary[column] for column in ["MS1s", "MS2s", "MS3+", "Unknown_MS_Level"]} == _expected_counts(input_file, file_format)
+
+@pytest.mark.parametrize("filename, writer, first_spectrum", [
+    ("run.mzML", synthetic_corpus.write_mzML, b"<spectrum "),
+    ("run.mzXML", synthetic_corpus.write_mzXML, b"<scan "),
+])
+def test_metadata_only_reads_only_the_header(tmp_path, ontology_file, filename, writer, first_spectrum):
+    complete_file = str(tmp_path / ("complete_" + filename))
+    writer(complete_file, num_spectra=NUM_SPECTRA, peaks_per_spectrum=5, indexed=False)
+    full_summary = xmlsummary_single.summarize_file(complete_file, complete_file, ontology_file=ontology_file)
+
+    # Cut just after the start tag of the first spectrum, a full parse of this file fails
+    with open(complete_file, "rb") as f:
+        data = f.read()
+    input_file = str(tmp_path / filename)
+    with open(input_file, "wb") as f:
+        f.write(data[:data.index(b">", data.index(first_spectrum)) + 10])
+
+    summary = xmlsummary_single.summarize_file(input_file, input_file, ontology_file=ontology_file, metadata_only=True)
+
+    instrument_columns = ["Ion_Source", "Mass_Analyzer", "Mass_Detector", "Model", "Vendor"]
+    assert {column: summary[column] for column in instrument_columns} == {column: full_summary[column] for column in instrument_columns}
+    assert summary["Model"] != ''
+    assert (summary["MS1s"], summary["MS2s"], summary["MS3+"]) == ('', '', '')
+
+def test_metadata_only_mgf_has_no_instrument_or_counts(tmp_path):
+    input_file = str(tmp_path / "spectra.mgf")
+    synthetic_corpus.write_MGF(input_file, num_spectra=NUM_SPECTRA, peaks_per_spectrum=5)
+
+    summary = xmlsummary_single.summarize_file(input_file, input_file, metadata_only=True)
+
+    assert (summary["Model"], summary["MS1s"], summary["MS2s"], summary["MS3+"]) == ('', '', '', '')
+    with pytest.raises(OSError):
+        xmlsummary_single.summarize_file(str(tmp_path / "missing.mgf"), "missing.mgf", metadata_only=True)